@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+"""
+Micro-benchmarks of the procutils command runner against bare subprocess.
+
+    $ python benchmarks/bench_procutils.py -n 200
+"""
+
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+from tabulate import tabulate
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from virtbmc import procutils
+
+
+BIG_OUTPUT = ['head', '-c', str(16 * 1024 * 1024), '/dev/zero']
+
+
+def bare(cmd):
+    # procutils returns stripped lines, the baseline pays for the same split
+    return map(str.strip, subprocess.check_output(cmd).split('\n'))
+
+
+def per_call(func, rounds):
+    started = time.time()
+    for _ in range(rounds):
+        func()
+    return (time.time() - started) / rounds
+
+
+def main():
+    parser = argparse.ArgumentParser(description='procutils micro-benchmarks')
+    parser.add_argument('-n', '--rounds', type=int, default=200,
+                        help='calls per measurement')
+    parser.add_argument('--concurrency', type=int, default=32,
+                        help='commands run by one check_output_many call')
+    args = parser.parse_args()
+    rounds = args.rounds
+
+    cases = [
+        ('true', lambda: bare(['true']),
+         lambda: procutils.check_output(['true'])),
+        ('true, timeout=10', lambda: bare(['true']),
+         lambda: procutils.check_output(['true'], timeout=10)),
+        ('echo', lambda: bare(['echo', 'hello']),
+         lambda: procutils.check_output(['echo', 'hello'])),
+        ('16MB output', lambda: bare(BIG_OUTPUT),
+         lambda: procutils.check_output(BIG_OUTPUT)),
+    ]
+    data_series = []
+    for name, baseline, runner in cases:
+        n = max(rounds // 20, 1) if 'MB' in name else rounds
+        bare_t = per_call(baseline, n)
+        runner_t = per_call(runner, n)
+        data_series.append([name, n, '{:.3f}'.format(bare_t * 1000),
+                            '{:.3f}'.format(runner_t * 1000),
+                            '{:.2f}'.format(runner_t / bare_t)])
+
+    cmds = [['sleep', '0.05']] * args.concurrency
+    sequential = per_call(lambda: [procutils.check_output(cmd) for cmd in cmds], 1)
+    many = per_call(lambda: procutils.check_output_many(cmds), 1)
+    data_series.append(['{} x sleep 0.05'.format(args.concurrency), 1,
+                        '{:.3f}'.format(sequential * 1000), '{:.3f}'.format(many * 1000),
+                        '{:.2f}'.format(many / sequential)])
+
+    print(tabulate(data_series, ['Case', 'Calls', 'Baseline(ms)', 'procutils(ms)', 'Ratio'],
+                   tablefmt="psql"))
+    print('Baseline is subprocess.check_output split into lines, or sequential '
+          'check_output calls for check_output_many.')
+
+
+if __name__ == '__main__':
+    main()
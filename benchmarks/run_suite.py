@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+
+"""
+End to end benchmark of create/start/list/stop/delete against the stand-ins
+in benchmarks/stubs instead of QEMU and OpenIPMI.
+
+Every node count runs in its own process and workspace (VBMC_WORKSPACE) and
+reports wall time and DB queries per phase, per node latency percentiles of
+each operation and the peak RSS of the CLI, BMC engine and supervisor:
+
+    $ python benchmarks/run_suite.py --nodes 10,100,1000 --output baseline.json
+
+The stub ipmi_sim does not answer IPMI, so the ipmi_sim backend only starts
+the BMCs; the builtin backend (default) also powers the VMs on and off.
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import struct
+import argparse
+import resource
+import tempfile
+import subprocess
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+STUBS_DIR = os.path.join(BENCH_DIR, 'stubs')
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+PHASES = ('create', 'start', 'list', 'stop', 'delete')
+
+BMC_PORT_BASE = 20000
+
+# missing from the socket module of python 2
+SO_PEERCRED = getattr(socket, 'SO_PEERCRED', 17)
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return {}
+
+    def rank(p):
+        return values[min(len(values) - 1, int(p / 100.0 * len(values)))]
+    return {'count': len(values), 'p50': rank(50), 'p90': rank(90), 'p99': rank(99),
+            'max': values[-1]}
+
+
+def peer_pid(path):
+    """Pid of the process serving the unix socket at path."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        creds = sock.getsockopt(socket.SOL_SOCKET, SO_PEERCRED, struct.calcsize('3i'))
+        return struct.unpack('3i', creds)[0]
+    except socket.error:
+        return None
+    finally:
+        sock.close()
+
+
+def peak_rss_kb(pid):
+    try:
+        with open('/proc/{}/status'.format(pid)) as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return None
+
+
+def phase_argv(phase, nodes, backend, workers):
+    if phase == 'create':
+        return ['create', '-n', str(nodes), '-b', 'lo', '--bmc-backend', backend,
+                '--qemu', os.path.join(STUBS_DIR, 'qemu-system-x86_64'),
+                '--ipmi-sim', os.path.join(STUBS_DIR, 'ipmi_sim'),
+                '--memory', '64', '--workers', str(workers)]
+    if phase == 'start':
+        argv = ['start', 'all', '--workers', str(workers)]
+        return argv + ['--vm'] if backend == 'builtin' else argv
+    if phase == 'list':
+        return ['list']
+    return [phase, 'all']
+
+
+def settle(bmcserver, timeout=60):
+    """Wait for the power actions queued in the BMC engine to finish."""
+    deadline = time.time() + timeout
+    while bmcserver.is_engine_running() and time.time() < deadline:
+        nodes = bmcserver.engine_request('status')['nodes']
+        if not any(node.get('pending') for node in nodes.values()):
+            return
+        time.sleep(0.05)
+
+
+def run_nodes(nodes, backend, workers):
+    """Run every phase on nodes nodes in this process, return the report."""
+    from virtbmc import models, optparse, metrics, bmcserver, supervisor, ports
+
+    models.init_db()
+    # room for every node whatever the defaults are
+    ports.set_range(ports.KIND_BMC, BMC_PORT_BASE,
+                    BMC_PORT_BASE + 2 * nodes * ports.BMC_PORTS_PER_NODE)
+    ports.set_range(ports.KIND_VNC, ports.VNC_BASE_PORT, ports.VNC_BASE_PORT + 2 * nodes)
+    queries = [0]
+    execute_sql = models.DB.execute_sql
+
+    def counting_execute_sql(*args, **kwargs):
+        queries[0] += 1
+        return execute_sql(*args, **kwargs)
+    models.DB.execute_sql = counting_execute_sql
+
+    samples = {}
+    observe = metrics.OPERATION_SECONDS.observe
+
+    def recording_observe(value, **labels):
+        samples.setdefault(labels.get('operation'), []).append(value)
+        observe(value, **labels)
+    metrics.OPERATION_SECONDS.observe = recording_observe
+
+    report = {'nodes': nodes, 'backend': backend, 'workers': workers, 'phases': {}}
+    parser = optparse.init_argparser()
+    stdout = sys.stdout
+    for phase in PHASES:
+        args = parser.parse_args(phase_argv(phase, nodes, backend, workers))
+        started = time.time()
+        before = queries[0]
+        error = None
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            args.func(args)
+            # chassis power requests return before the engine ran them
+            if phase in ('start', 'stop'):
+                settle(bmcserver)
+        except Exception as e:
+            error = str(e)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        wall = time.time() - started
+        report['phases'][phase] = {'wall_s': round(wall, 4),
+                                   'nodes_per_s': round(nodes / wall, 1) if wall else None,
+                                   'db_queries': queries[0] - before,
+                                   'error': error}
+
+    report['latency_s'] = dict((op, percentiles(values)) for op, values in samples.items())
+    report['peak_rss_kb'] = {'cli': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+    for name, path in (('bmc-engine', bmcserver.CONTROL_SOCKET),
+                       ('supervisor', supervisor.CONTROL_SOCKET)):
+        pid = peer_pid(path) if os.path.exists(path) else None
+        if pid:
+            report['peak_rss_kb'][name] = peak_rss_kb(pid)
+    if bmcserver.is_engine_running():
+        bmcserver.engine_request('shutdown')
+    if supervisor.is_running():
+        supervisor.supervisor_request('shutdown')
+    return report
+
+
+def spawn_run(nodes, args, workspace):
+    env = dict(os.environ)
+    env['VBMC_WORKSPACE'] = workspace
+    env['VBMC_NO_DAEMON'] = '1'
+    env['VBMC_STUB_STATE'] = os.path.join(env['VBMC_WORKSPACE'], 'ipmitool')
+    env['PATH'] = STUBS_DIR + os.pathsep + env.get('PATH', '')
+    cmd = [sys.executable, os.path.abspath(__file__), '--run', str(nodes),
+           '--backend', args.backend, '--workers', str(args.workers)]
+    out = subprocess.check_output(cmd, env=env)
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='vbmc-qemu benchmark suite')
+    parser.add_argument('--nodes', default='10,100,1000',
+                        help='comma separated node counts')
+    parser.add_argument('--backend', choices=('builtin', 'ipmi_sim'), default='builtin')
+    parser.add_argument('--workers', type=int, default=32)
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    parser.add_argument('--workdir', help='keep the workspaces here instead of a temp dir')
+    parser.add_argument('--run', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run is not None:
+        print(json.dumps(run_nodes(args.run, args.backend, args.workers)))
+        return
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='vbmc-bench-')
+    results = []
+    for i, nodes in enumerate([int(n) for n in args.nodes.split(',')]):
+        sys.stderr.write('Running {} nodes...\n'.format(nodes))
+        workspace = os.path.join(workdir, '{}-{}'.format(i, nodes))
+        results.append(spawn_run(nodes, args, workspace))
+    if not args.workdir:
+        subprocess.call(['rm', '-rf', workdir])
+    report = json.dumps({'host': os.uname()[1], 'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                         'results': results}, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,21 @@
 #!/usr/bin/env python
 
-from virtbmc import optparse
-from virtbmc.optparse import get_args, get_parser
-from virtbmc.clrlog import LOG
-import virtbmc.manager as manager
+import sys
+
+from virtbmc import client
 
 
 if __name__ == '__main__':
+    # served by a running vbmcd without importing the models here
+    code = client.forward(sys.argv[1:])
+    if code is not None:
+        sys.exit(code)
+
+    from virtbmc import optparse
+    from virtbmc import trace
+    from virtbmc.optparse import get_args
+    from virtbmc.clrlog import LOG
+
     try:
         optparse.init()
         args = get_args()
@@ -14,7 +23,15 @@ if __name__ == '__main__':
             import logging
             LOG.setLevel(logging.DEBUG)
             LOG.info('ARGS: {}'.format(args))
-        args.func(args)
+        if args.profile or args.profile_stats:
+            trace.enable(profile=bool(args.profile_stats))
+        try:
+            with trace.span(client.subcommand(sys.argv[1:]), trace.COMMAND):
+                args.func(args)
+        finally:
+            if trace.enabled():
+                count = trace.write(args.profile, args.profile_stats)
+                LOG.info('Wrote {} trace events'.format(count))
 
     except SystemExit as e:
         if e.code != 0:
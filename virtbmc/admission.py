@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+"""
+Power-on admission control against boot storms.
+
+A VM counts as booting for boot_window seconds after it was admitted. New
+power-ons wait while too many VMs boot, faster than the ramp rate, or while
+the host load average or available memory (read from /proc) is over the
+configured limits. A VM held back by the host limits for max_wait seconds
+is refused, they may never be met.
+"""
+
+import time
+import threading
+
+
+MB = 1024 * 1024
+POLL_INTERVAL = 0.5
+MAX_WAIT = 300
+
+
+class AdmissionTimeout(Exception):
+
+    def __init__(self, message, waited):
+        super(AdmissionTimeout, self).__init__(message)
+        self.waited = waited
+
+
+def read_loadavg():
+    with open('/proc/loadavg') as f:
+        return float(f.read().split()[0])
+
+
+def read_meminfo():
+    """/proc/meminfo in bytes."""
+    info = {}
+    with open('/proc/meminfo') as f:
+        for line in f:
+            key, value = line.split(':', 1)
+            info[key] = int(value.split()[0]) * 1024
+    return info
+
+
+def read_mem_available():
+    """MemAvailable in bytes, MemFree + Cached on kernels without it."""
+    info = read_meminfo()
+    if 'MemAvailable' in info:
+        return info['MemAvailable']
+    return info.get('MemFree', 0) + info.get('Cached', 0)
+
+
+class PowerOnGate(object):
+
+    def __init__(self, max_booting=0, ramp=0, boot_window=60,
+                 max_load=0, min_free_mem=0, max_wait=MAX_WAIT):
+        self.max_booting = max_booting
+        self.ramp = ramp
+        self.boot_window = boot_window
+        self.max_load = max_load
+        self.min_free_mem = min_free_mem * MB
+        self.max_wait = max_wait
+        self._booting = []
+        self._last = None
+        self._cond = threading.Condition()
+
+    def _wait_time(self, now, memory):
+        """Seconds to wait and the host limit waited for, if any."""
+        if self.max_booting and len(self._booting) >= self.max_booting:
+            return min(end for end, _ in self._booting) - now, None
+        if self.ramp and self._last is not None:
+            wait = 1.0 / self.ramp - (now - self._last)
+            if wait > 0:
+                return wait, None
+        if self.max_load:
+            load = read_loadavg()
+            if load > self.max_load:
+                return POLL_INTERVAL, 'load average {:.2f} over {}'.format(load, self.max_load)
+        if self.min_free_mem:
+            # booting guests have not touched most of their memory yet
+            pending = sum(mem for _, mem in self._booting)
+            available = read_mem_available() - pending - memory
+            if available < self.min_free_mem:
+                return POLL_INTERVAL, '{} MB left after power on, under {} MB'.format(
+                    available // MB, self.min_free_mem // MB)
+        return 0, None
+
+    def admit(self, memory=0):
+        """Block until a VM of memory MB may power on, return the seconds waited.
+
+        Raise AdmissionTimeout once the host limits held it back max_wait seconds.
+        """
+        started = time.time()
+        held = 0
+        with self._cond:
+            while True:
+                now = time.time()
+                self._booting = [item for item in self._booting if item[0] > now]
+                wait, limit = self._wait_time(now, memory * MB)
+                if wait <= 0:
+                    break
+                if limit is not None:
+                    if self.max_wait and held >= self.max_wait:
+                        raise AdmissionTimeout('Not admitted after {}s: {}'.format(
+                            self.max_wait, limit), time.time() - started)
+                    wait = min(wait, self.max_wait - held) if self.max_wait else wait
+                self._cond.wait(wait)
+                if limit is not None:
+                    held += time.time() - now
+            self._booting.append((now + self.boot_window, memory * MB))
+            self._last = now
+        return time.time() - started
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+
+"""
+Pure python AES-128-CBC, enough for the RMCP+ confidentiality payloads
+(cipher suite 3) without pulling a crypto library in.
+"""
+
+
+def _xtime(a):
+    a <<= 1
+    return (a ^ 0x11b) if a & 0x100 else a
+
+
+def _mul(a, b):
+    res = 0
+    while b:
+        if b & 1:
+            res ^= a
+        a = _xtime(a)
+        b >>= 1
+    return res
+
+
+def _make_sbox():
+    sbox = [0] * 256
+    inv = [0] * 256
+    # 3 generates GF(2^8)*, inverses come from its exp/log tables
+    exp = [0] * 255
+    log = [0] * 256
+    x = 1
+    for i in range(255):
+        exp[i] = x
+        log[x] = i
+        x = _mul(x, 3)
+    for i in range(256):
+        x = exp[(255 - log[i]) % 255] if i else 0
+        s = x
+        for _ in range(4):
+            x = ((x << 1) | (x >> 7)) & 0xff
+            s ^= x
+        s ^= 0x63
+        sbox[i] = s
+        inv[s] = i
+    return sbox, inv
+
+
+SBOX, INV_SBOX = _make_sbox()
+MUL2 = [_mul(x, 2) for x in range(256)]
+MUL3 = [_mul(x, 3) for x in range(256)]
+MUL9 = [_mul(x, 9) for x in range(256)]
+MUL11 = [_mul(x, 11) for x in range(256)]
+MUL13 = [_mul(x, 13) for x in range(256)]
+MUL14 = [_mul(x, 14) for x in range(256)]
+
+BLOCK_SIZE = 16
+
+
+class AES128(object):
+
+    def __init__(self, key):
+        key = bytearray(key)
+        if len(key) != 16:
+            raise ValueError('AES-128 key must be 16 bytes')
+        words = [list(key[i:i + 4]) for i in range(0, 16, 4)]
+        rcon = 1
+        for i in range(4, 44):
+            t = list(words[i - 1])
+            if i % 4 == 0:
+                t = [SBOX[b] for b in t[1:] + t[:1]]
+                t[0] ^= rcon
+                rcon = _xtime(rcon)
+            words.append([words[i - 4][j] ^ t[j] for j in range(4)])
+        self._round_keys = [sum(words[r * 4:r * 4 + 4], []) for r in range(11)]
+
+    def encrypt_block(self, block):
+        s = [b ^ k for b, k in zip(bytearray(block), self._round_keys[0])]
+        for rnd in range(1, 11):
+            s = [SBOX[b] for b in s]
+            s = [s[((c + r) % 4) * 4 + r] for c in range(4) for r in range(4)]
+            if rnd != 10:
+                m = []
+                for c in range(0, 16, 4):
+                    a0, a1, a2, a3 = s[c:c + 4]
+                    m += [MUL2[a0] ^ MUL3[a1] ^ a2 ^ a3,
+                          a0 ^ MUL2[a1] ^ MUL3[a2] ^ a3,
+                          a0 ^ a1 ^ MUL2[a2] ^ MUL3[a3],
+                          MUL3[a0] ^ a1 ^ a2 ^ MUL2[a3]]
+                s = m
+            s = [b ^ k for b, k in zip(s, self._round_keys[rnd])]
+        return bytes(bytearray(s))
+
+    def decrypt_block(self, block):
+        s = [b ^ k for b, k in zip(bytearray(block), self._round_keys[10])]
+        for rnd in range(9, -1, -1):
+            s = [s[((c - r) % 4) * 4 + r] for c in range(4) for r in range(4)]
+            s = [INV_SBOX[b] for b in s]
+            s = [b ^ k for b, k in zip(s, self._round_keys[rnd])]
+            if rnd:
+                m = []
+                for c in range(0, 16, 4):
+                    a0, a1, a2, a3 = s[c:c + 4]
+                    m += [MUL14[a0] ^ MUL11[a1] ^ MUL13[a2] ^ MUL9[a3],
+                          MUL9[a0] ^ MUL14[a1] ^ MUL11[a2] ^ MUL13[a3],
+                          MUL13[a0] ^ MUL9[a1] ^ MUL14[a2] ^ MUL11[a3],
+                          MUL11[a0] ^ MUL13[a1] ^ MUL9[a2] ^ MUL14[a3]]
+                s = m
+        return bytes(bytearray(s))
+
+
+def _xor(a, b):
+    return bytes(bytearray(x ^ y for x, y in zip(bytearray(a), bytearray(b))))
+
+
+def cbc_encrypt(key, iv, data):
+    if len(data) % BLOCK_SIZE:
+        raise ValueError('Data is not padded to the AES block size')
+    cipher = AES128(key)
+    out = b''
+    for i in range(0, len(data), BLOCK_SIZE):
+        iv = cipher.encrypt_block(_xor(data[i:i + BLOCK_SIZE], iv))
+        out += iv
+    return out
+
+
+def cbc_decrypt(key, iv, data):
+    if len(data) % BLOCK_SIZE:
+        raise ValueError('Data is not a multiple of the AES block size')
+    cipher = AES128(key)
+    out = b''
+    for i in range(0, len(data), BLOCK_SIZE):
+        block = data[i:i + BLOCK_SIZE]
+        out += _xor(cipher.decrypt_block(block), iv)
+        iv = block
+    return out
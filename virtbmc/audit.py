@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+
+"""
+Operation audit log of the nodes.
+
+Power, boot device and lifecycle operations of a node are appended as JSON
+lines to audit.log in its workspace by whoever runs them: the BMC engine,
+ipmi_sim_chassiscontrol or vbmc.py. A log is rotated when it reaches
+AUDIT_MAX_BYTES, AUDIT_BACKUPS older files are kept.
+
+The AuditRecord table of the database is the central index. ingest copies
+what was appended to the logs since it last ran, remembering the inode and
+offset reached in each, so history queries by node, operation and time
+without reading the logs again.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import fcntl
+import datetime
+import operator
+
+import virtbmc.config as config
+
+
+AUDIT_FILE = 'audit.log'
+
+# ipmi_sim chassis_control "set" parameter and value -> operation
+CHASSIS_OPS = {
+    ('power', '0'): 'power_off',
+    ('power', '1'): 'power_on',
+    ('shutdown', '1'): 'power_soft',
+    ('reset', '1'): 'power_reset',
+}
+
+_AGE = re.compile(r'^(\d+(?:\.\d+)?)([smhd])$')
+_AGE_SECONDS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+TIME_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d')
+
+
+def _rotate(path):
+    for i in range(config.AUDIT_BACKUPS - 1, 0, -1):
+        older = '{}.{}'.format(path, i)
+        if os.path.exists(older):
+            os.rename(older, '{}.{}'.format(path, i + 1))
+    if config.AUDIT_BACKUPS:
+        os.rename(path, path + '.1')
+    else:
+        os.remove(path)
+
+
+def _append(path, line):
+    while True:
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            size = os.fstat(fd).st_size
+            try:
+                rotated = os.stat(path).st_ino != os.fstat(fd).st_ino
+            except OSError:
+                rotated = True
+            if rotated:
+                # another writer rotated it while this one waited for the lock
+                continue
+            if size and size + len(line) > config.AUDIT_MAX_BYTES:
+                _rotate(path)
+                continue
+            os.write(fd, line)
+            return
+        finally:
+            os.close(fd)
+
+
+def record(path, node, number, op, source, user='', **detail):
+    """Append operation op of node to the audit log at path."""
+    entry = {'ts': round(time.time(), 6), 'node': node, 'number': int(number), 'op': op,
+             'source': source, 'user': user}
+    if detail:
+        entry['detail'] = detail
+    try:
+        _append(path, (json.dumps(entry, sort_keys=True) + '\n').encode('utf-8'))
+    except (IOError, OSError) as e:
+        # never fail the operation itself
+        sys.stderr.write('Audit {} of {} error: {}\n'.format(op, node, e))
+
+
+def chassis_ops(args):
+    """[(op, detail)] of the ipmi_sim chassis_control arguments "set parm val ..."."""
+    ops = []
+    parms = args[1:] if args[:1] == ['set'] else []
+    while len(parms) >= 2:
+        parm, val = parms[:2]
+        # identify takes an interval and a force flag
+        parms = parms[3:] if parm == 'identify' else parms[2:]
+        if parm == 'boot' and val not in ('none', 'bios'):
+            ops.append(('bootdev', {'device': 'disk' if val == 'default' else val}))
+        elif (parm, val) in CHASSIS_OPS:
+            ops.append((CHASSIS_OPS[(parm, val)], {}))
+    return ops
+
+
+def parse_time(value, now=None):
+    """Epoch seconds of value, given as epoch seconds, a local date and time
+    or an age like 30m, 2h or 7d."""
+    now = time.time() if now is None else now
+    match = _AGE.match(value)
+    if match:
+        return now - float(match.group(1)) * _AGE_SECONDS[match.group(2)]
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    for fmt in TIME_FORMATS:
+        try:
+            return time.mktime(datetime.datetime.strptime(value, fmt).timetuple())
+        except ValueError:
+            continue
+    raise Exception('Invalid time: {}, use epoch seconds, "YYYY-MM-DD[ HH:MM[:SS]]" '
+                    'or an age like 30m, 2h, 7d'.format(value))
+
+
+def _pending(path, inode, offset):
+    """[(file, offset)] holding what was appended since (inode, offset), oldest first."""
+    files = []
+    for name in ['{}.{}'.format(path, i) for i in range(config.AUDIT_BACKUPS, 0, -1)] + [path]:
+        try:
+            files.append((name, os.stat(name)))
+        except OSError:
+            continue
+    for i, (name, st) in enumerate(files):
+        if st.st_ino == inode:
+            start = offset if st.st_size >= offset else 0
+            return [(name, start)] + [(newer, 0) for newer, _ in files[i + 1:]]
+    # rotated out of the backups since, all that is left is new
+    return [(name, 0) for name, _ in files]
+
+
+def _read_new(path, inode, offset):
+    """Complete lines appended to the log at path since (inode, offset), and the
+    (inode, offset) they end at."""
+    lines = []
+    for name, start in _pending(path, inode, offset):
+        with open(name, 'rb') as f:
+            f.seek(start)
+            data = f.read()
+            if name == path:
+                # the last line may still be written
+                data = data[:data.rfind(b'\n') + 1]
+                inode, offset = os.fstat(f.fileno()).st_ino, start + len(data)
+        lines.extend(data.splitlines())
+    return lines, inode, offset
+
+
+def _row(line):
+    try:
+        entry = json.loads(line.decode('utf-8'))
+        return {
+            'ts': float(entry['ts']),
+            'node': entry['node'],
+            'number': int(entry['number']),
+            'op': entry['op'],
+            'source': entry.get('source', ''),
+            'user': entry.get('user', ''),
+            'detail': json.dumps(entry['detail'], sort_keys=True) if entry.get('detail') else '',
+        }
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+def ingest(logs):
+    """Index what was appended to the audit logs [(node, path)] since the last ingest.
+
+    A log unchanged since costs one stat. Return the number of new records.
+    """
+    from virtbmc import models
+    from virtbmc.models import AuditRecord, AuditCursor
+
+    cursors = {}
+    for chunk in models.chunks([node for node, _ in logs]):
+        for cursor in AuditCursor.select().where(AuditCursor.node << chunk):
+            cursors[cursor.node] = cursor
+    rows = []
+    moved = []
+    for node, path in logs:
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        cursor = cursors.get(node)
+        inode, offset = (cursor.inode, cursor.offset) if cursor else (None, 0)
+        if st.st_ino == inode and st.st_size == offset:
+            continue
+        lines, inode, offset = _read_new(path, inode, offset)
+        rows.extend(row for row in map(_row, lines) if row is not None)
+        moved.append((node, inode, offset))
+    if not moved:
+        return 0
+    with models.DB.atomic():
+        models.bulk_insert(AuditRecord, rows)
+        for node, inode, offset in moved:
+            if node in cursors:
+                AuditCursor.update(inode=inode, offset=offset).where(
+                    AuditCursor.node == node).execute()
+            else:
+                AuditCursor.create(node=node, inode=inode, offset=offset)
+    return len(rows)
+
+
+def forget(nodes):
+    """Drop the ingest positions of deleted nodes, their records stay indexed."""
+    from virtbmc import models
+    from virtbmc.models import AuditCursor
+    with models.DB.atomic():
+        for chunk in models.chunks(nodes):
+            AuditCursor.delete().where(AuditCursor.node << chunk).execute()
+
+
+def query(nodes=None, numbers=None, ops=None, since=None, until=None, limit=None):
+    """AuditRecords of the nodes (uuids), numbers ((first, last) ranges) and ops
+    between since and until, the last limit of them, oldest first."""
+    from virtbmc.models import AuditRecord
+
+    conds = []
+    selected = [AuditRecord.node << nodes] if nodes else []
+    selected += [AuditRecord.number.between(first, last) for first, last in numbers or []]
+    if selected:
+        conds.append(reduce(operator.or_, selected))
+    if ops:
+        conds.append(AuditRecord.op << ops)
+    if since is not None:
+        conds.append(AuditRecord.ts >= since)
+    if until is not None:
+        conds.append(AuditRecord.ts <= until)
+    q = AuditRecord.select()
+    if conds:
+        q = q.where(reduce(operator.and_, conds))
+    q = q.order_by(AuditRecord.ts.desc(), AuditRecord.id.desc())
+    if limit:
+        q = q.limit(limit)
+    return list(reversed(list(q)))
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) < 5 or argv[0] != 'chassis':
+        sys.stderr.write('usage: python -m virtbmc.audit chassis AUDIT_FILE UUID NUMBER '
+                         'DEVICE set PARM VAL ...\n')
+        return 1
+    path, node, number = argv[1:4]
+    for op, detail in chassis_ops(argv[5:]):
+        record(path, node, number, op, 'ipmi_sim', **detail)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,1035 @@
+#!/usr/bin/env python
+
+"""
+Multiplexed virtual BMC engine.
+
+One process serves the RMCP+ LAN channel of every VirtBMC row created with
+the ``builtin`` backend.  Chassis power, boot device and status requests are
+answered from in-memory node state, only real power and boot changes touch
+the node workspace (gen-bmc-env, qemu).  The ``ipmi_sim`` backend stays the
+full fidelity option: the builtin engine serves no in-band (KCS/BT) channel,
+no SOL and only lanplus sessions.
+
+The engine is also the chassis controller of ``ipmi_sim`` nodes. Their
+lan.conf chassis_control program is a small client forwarding each request
+over the chassis socket, answered from the same in-memory node state.
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import errno
+import shlex
+import signal
+import select
+import socket
+import struct
+import threading
+import subprocess
+import collections
+from multiprocessing.pool import ThreadPool as Pool
+
+from virtbmc import ipmi
+from virtbmc import qmp
+from virtbmc import procutils
+from virtbmc import netdev
+from virtbmc import warm
+from virtbmc import metrics
+from virtbmc import audit
+from virtbmc.clrlog import LOG
+import virtbmc.config as config
+import virtbmc.utils as utils
+
+
+BACKEND_IPMI_SIM = 'ipmi_sim'
+BACKEND_BUILTIN = 'builtin'
+BACKENDS = (BACKEND_IPMI_SIM, BACKEND_BUILTIN)
+
+CONTROL_SOCKET = os.path.join(config.WORKSPACE, 'bmc-engine.sock')
+# "<uuid> <chassis_control args>" lines of the ipmi_sim chassis clients
+CHASSIS_SOCKET = os.path.join(config.WORKSPACE, 'bmc-chassis.sock')
+STATE_FILE = os.path.join(config.WORKSPACE, 'bmc-engine.json')
+LOG_FILE = os.path.join(config.WORKSPACE, 'bmc-engine.log')
+
+SESSION_TIMEOUT = 60
+# seconds a control or chassis client has to send its request line and
+# read its reply
+CLIENT_TIMEOUT = 2
+MAX_SESSIONS = 32
+HOUSEKEEPING_INTERVAL = 5
+
+# never offer cipher suite 0, it logs in without a password
+SERVER_CIPHER_SUITES = dict((k, v) for k, v in ipmi.CIPHER_SUITES.items() if v[0])
+
+CC_OK = 0x00
+CC_PARAM_UNSUPPORTED = 0x80
+CC_PRIV_EXCEEDS_LIMIT = 0x81
+CC_INVALID_SESSION = 0x87
+CC_INVALID_CMD = 0xc1
+CC_REQ_LENGTH = 0xc7
+CC_INVALID_DATA = 0xcc
+CC_INSUFFICIENT_PRIV = 0xd4
+
+CMD_GET_DEVICE_ID = 0x01
+CMD_CHASSIS_IDENTIFY = 0x04
+CMD_GET_CHANNEL_AUTH_CAPS = 0x38
+CMD_GET_CHANNEL_CIPHER_SUITES = 0x54
+
+# boot flags device selector (bits 5:2) -> gen-bmc-env bootdev
+SELECTOR_BOOTDEV = {0x01: 'pxe', 0x02: 'disk', 0x03: 'disk', 0x05: 'cdrom'}
+BOOT_ORDER = {'pxe': 'nd', 'disk': 'd', 'cdrom': 'cdn'}
+# ipmi_sim chassis_control boot values of a bootdev
+CHASSIS_BOOT_VALUES = {'pxe': 'pxe', 'disk': 'default'}
+# chassis control action -> audit operation, named as the power command
+AUDIT_OPS = dict((action, 'power_' + name) for name, action in ipmi.POWER_ACTIONS.items())
+
+
+def unpack_ipmi_request(payload):
+    msg = bytearray(payload)
+    if len(msg) < 7 or ipmi.checksum(msg[:3]) != 0 or ipmi.checksum(msg[3:]) != 0:
+        raise ipmi.IPMIError('Malformed IPMI request')
+    return {
+        'netfn': msg[1] >> 2,
+        'rs_lun': msg[1] & 0x03,
+        'rq_addr': msg[3],
+        'rq_seq': msg[4],
+        'cmd': msg[5],
+        'data': ipmi._b(msg[6:-1]),
+    }
+
+
+def pack_ipmi_response(req, code, data=b''):
+    head = struct.pack('BB', req['rq_addr'], ((req['netfn'] | 1) << 2) | (req['rq_seq'] & 0x03))
+    body = struct.pack('BBBB', ipmi.BMC_ADDR, (req['rq_seq'] & 0xfc) | req['rs_lun'],
+                       req['cmd'], code) + ipmi._b(data)
+    return head + struct.pack('B', ipmi.checksum(head)) + body + struct.pack('B', ipmi.checksum(body))
+
+
+def pack_ipmi15(msg):
+    return ipmi.RMCP_HEADER + struct.pack('<BIIB', 0, 0, 0, len(msg)) + msg
+
+
+class ServerSession(object):
+
+    def __init__(self, bmc_id, console_id, algorithms, max_priv):
+        self.bmc_id = bmc_id
+        self.console_id = console_id
+        self.auth_alg, self.integrity_alg, self.conf_alg = algorithms
+        self.max_priv = max_priv
+        self.privilege = ipmi.PRIV_USER
+        self.active = False
+        self.seq = 0
+        self.rm = None
+        self.rc = None
+        self.role = None
+        self.k1 = None
+        self.k2 = None
+        self.last_seen = time.time()
+
+    def message(self, msg):
+        self.seq = (self.seq + 1) & 0xffffffff or 1
+        k1 = self.k1 if self.integrity_alg else None
+        k2 = self.k2 if self.conf_alg else None
+        return ipmi.pack_rmcpp(ipmi.PAYLOAD_IPMI, self.console_id, self.seq, msg, k1, k2)
+
+
+class BMCNode(object):
+
+    # (netfn, cmd) -> (handler, required privilege)
+    COMMANDS = {
+        (ipmi.NETFN_APP, CMD_GET_DEVICE_ID): ('_get_device_id', ipmi.PRIV_USER),
+        (ipmi.NETFN_APP, CMD_GET_CHANNEL_AUTH_CAPS): ('_get_channel_auth_caps', ipmi.PRIV_USER),
+        (ipmi.NETFN_APP, CMD_GET_CHANNEL_CIPHER_SUITES): ('_get_channel_cipher_suites', ipmi.PRIV_USER),
+        (ipmi.NETFN_APP, ipmi.CMD_SET_SESSION_PRIV): ('_set_session_priv', ipmi.PRIV_USER),
+        (ipmi.NETFN_APP, ipmi.CMD_CLOSE_SESSION): ('_close_session', ipmi.PRIV_USER),
+        (ipmi.NETFN_CHASSIS, ipmi.CMD_GET_CHASSIS_STATUS): ('_get_chassis_status', ipmi.PRIV_USER),
+        (ipmi.NETFN_CHASSIS, ipmi.CMD_CHASSIS_CONTROL): ('_chassis_control', ipmi.PRIV_OPERATOR),
+        (ipmi.NETFN_CHASSIS, CMD_CHASSIS_IDENTIFY): ('_chassis_identify', ipmi.PRIV_OPERATOR),
+        (ipmi.NETFN_CHASSIS, ipmi.CMD_SET_BOOT_OPTIONS): ('_set_boot_options', ipmi.PRIV_OPERATOR),
+        (ipmi.NETFN_CHASSIS, ipmi.CMD_GET_BOOT_OPTIONS): ('_get_boot_options', ipmi.PRIV_USER),
+    }
+
+    # commands answered outside of a session
+    PRESESSION = ((ipmi.NETFN_APP, CMD_GET_CHANNEL_AUTH_CAPS),
+                  (ipmi.NETFN_APP, CMD_GET_CHANNEL_CIPHER_SUITES))
+
+    def __init__(self, engine, unit):
+        self.engine = engine
+        self.unit = unit
+        self.uuid = unit.uuid
+        self.addr = (unit.listen_addr, int(unit.ipmi_port))
+        self.user = ipmi._to_bytes(unit.ipmiusr)
+        self.kuid = ipmi._to_bytes(unit.ipmipass)[:20].ljust(20, b'\x00')
+        self.guid = uuid.UUID(unit.uuid).bytes
+        self.sessions = {}
+        self.sock = None
+        # address of the LAN client whose packet is being handled
+        self.peer = None
+        self.lock = threading.Lock()
+        # power actions of this BMC, run one at a time in order
+        self.actions = collections.deque()
+        info = unit.get_vm_status_byfile()
+        self.power = info.get('power', 'off') != 'off'
+        self.bootdev = info.get('bootdev', 'pxe')
+
+    def bind(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.bind(self.addr)
+        except socket.error:
+            sock.close()
+            raise
+        sock.setblocking(False)
+        self.sock = sock
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        self.sessions.clear()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def status(self):
+        return {
+            'addr': '{}:{}'.format(*self.addr),
+            'power': 'on' if self.is_power_on() else 'off',
+            'bootdev': self.bootdev,
+            'sessions': len(self.sessions),
+            'pending': len(self.actions),
+        }
+
+    # --- VM state -----------------------------------------------------
+
+    def vm_alive(self):
+        pidfile = self.unit.qemu_pidfile
+        return os.path.exists(pidfile) and procutils.check_pid_alive(pidfile, 'qemu')
+
+    def is_power_on(self):
+        with self.lock:
+            if not self.power or self.actions:
+                return self.power
+        if self.vm_alive():
+            return True
+        # the guest powered itself off
+        with self.lock:
+            self.power = False
+        return False
+
+    def _run_action(self, func, *args):
+        with self.lock:
+            self.actions.append((func, args))
+            if len(self.actions) > 1:
+                return
+        self.engine.pool.apply_async(self._run_actions)
+
+    def _run_actions(self):
+        while True:
+            with self.lock:
+                func, args = self.actions[0]
+            self._action(func, *args)
+            with self.lock:
+                self.actions.popleft()
+                if not self.actions:
+                    return
+
+    def _action(self, func, *args):
+        try:
+            with metrics.timed(func.__name__.strip('_'), self.unit.number):
+                func(*args)
+        except Exception as e:
+            LOG.error('BMC {} action {} error: {}'.format(self.uuid, func.__name__, e))
+
+    def _gen_env(self, *opts):
+        utils.run_cmd([self.unit.bmc_env_file] + list(opts) +
+                      ['-c', self.unit.qemu_pidfile, self.unit.status_file])
+
+    def _power_on(self):
+        vm = warm.WarmVM.of_unit(self.unit)
+        if self.vm_alive() and not vm.is_member():
+            return
+        if self.unit.tap:
+            errors = netdev.ensure_taps([(self.unit.tap, self.unit.bridge)])
+            if errors:
+                raise Exception(errors[self.unit.tap])
+        self._gen_env('-p', 'on')
+        if vm.resume() or self.vm_alive():
+            return
+        cmd = self.unit.get_vm_status_byfile()['cmd']
+        utils.run_cmd(shlex.split(cmd))
+        vm.started()
+
+    def _power_off(self, soft=False):
+        vm = warm.WarmVM.of_unit(self.unit)
+        if not soft and vm.park():
+            self._gen_env('-p', 'off')
+            return
+        qmp_socket = self.unit.qmp_socket
+        if os.path.exists(qmp_socket):
+            if soft:
+                qmp.powerdown(qmp_socket)
+            else:
+                qmp.quit_vm(qmp_socket)
+        if self.vm_alive():
+            with open(self.unit.qemu_pidfile) as f:
+                pid = int(f.read().strip())
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError as e:
+                if e.errno != errno.ESRCH:
+                    raise
+        self._gen_env('-p', 'off')
+        if vm.is_member():
+            for _ in range(50):
+                if not self.vm_alive():
+                    break
+                time.sleep(0.1)
+            vm.launch()
+
+    def _power_cycle(self):
+        self._power_off()
+        vm = warm.WarmVM.of_unit(self.unit)
+        for _ in range(50):
+            if not self.vm_alive() or vm.is_standby():
+                break
+            time.sleep(0.1)
+        self._power_on()
+
+    def _set_bootdev(self, bootdev):
+        self._gen_env('-b', bootdev, '-o', BOOT_ORDER[bootdev])
+
+    def control(self, action):
+        """Queue the chassis control action, False when it is not supported."""
+        if action == ipmi.CHASSIS_POWER_ON:
+            with self.lock:
+                self.power = True
+            self._run_action(self._power_on)
+        elif action in (ipmi.CHASSIS_POWER_OFF, ipmi.CHASSIS_SOFT_OFF):
+            with self.lock:
+                self.power = False
+            self._run_action(self._power_off, action == ipmi.CHASSIS_SOFT_OFF)
+        elif action == ipmi.CHASSIS_HARD_RESET and os.path.exists(self.unit.qmp_socket):
+            self._run_action(qmp.reset, self.unit.qmp_socket)
+        elif action in (ipmi.CHASSIS_POWER_CYCLE, ipmi.CHASSIS_HARD_RESET):
+            with self.lock:
+                self.power = True
+            self._run_action(self._power_cycle)
+        else:
+            return False
+        return True
+
+    def set_bootdev(self, bootdev):
+        self.bootdev = bootdev
+        self._run_action(self._set_bootdev, bootdev)
+
+    def audit(self, op, source, user='', **detail):
+        audit.record(self.unit.audit_file, self.uuid, self.unit.number, op, source, user,
+                     **detail)
+
+    def audit_lan(self, op, **detail):
+        if self.peer is not None:
+            detail['client'] = '{}:{}'.format(*self.peer)
+        self.audit(op, 'lan', self.unit.ipmiusr, **detail)
+
+    # --- ipmi_sim chassis control -------------------------------------
+
+    def chassis(self, args):
+        """Output of the ipmi_sim chassis_control request "<device> get|set parm [val] ..."."""
+        if len(args) < 2:
+            raise Exception('No operation given')
+        op, parms = args[1], args[2:]
+        if op == 'get':
+            return ''.join('{}:{}\n'.format(parm, self._chassis_get(parm)) for parm in parms)
+        if op != 'set':
+            raise Exception('Invalid operation: {}'.format(op))
+        while parms:
+            if len(parms) < 2:
+                raise Exception('No value present for parameter {}'.format(parms[0]))
+            parm, val = parms[:2]
+            # identify takes an interval and a force flag
+            parms = parms[3:] if parm == 'identify' else parms[2:]
+            self._chassis_set(parm, val)
+        for op, detail in audit.chassis_ops(args[1:]):
+            self.audit(op, 'ipmi_sim', **detail)
+        return ''
+
+    def _chassis_get(self, parm):
+        if parm == 'power':
+            return 1 if self.is_power_on() else 0
+        if parm == 'boot':
+            return CHASSIS_BOOT_VALUES.get(self.bootdev, 'none')
+        raise Exception('Invalid parameter: {}'.format(parm))
+
+    def _chassis_set(self, parm, val):
+        if parm == 'power':
+            if val in ('0', '1'):
+                self.control(ipmi.CHASSIS_POWER_ON if val == '1' else ipmi.CHASSIS_POWER_OFF)
+        elif parm == 'shutdown':
+            if val == '1':
+                self.control(ipmi.CHASSIS_SOFT_OFF)
+        elif parm == 'reset':
+            if val == '1':
+                self.control(ipmi.CHASSIS_HARD_RESET)
+        elif parm == 'boot':
+            if val == 'default':
+                val = 'disk'
+            if val in BOOT_ORDER:
+                self.set_bootdev(val)
+            elif val not in ('none', 'bios'):
+                raise Exception('Invalid boot value: {}'.format(val))
+        elif parm != 'identify':
+            raise Exception('Invalid parameter: {}'.format(parm))
+
+    # --- RMCP+ --------------------------------------------------------
+
+    def _new_bmc_id(self):
+        while True:
+            sid = struct.unpack('<I', os.urandom(4))[0]
+            if sid and sid not in self.sessions:
+                return sid
+
+    def expire_sessions(self, now):
+        for sid, sess in list(self.sessions.items()):
+            if now - sess.last_seen > SESSION_TIMEOUT:
+                del self.sessions[sid]
+
+    def handle_packet(self, packet):
+        data = bytearray(packet)
+        if len(data) < 5 or data[0] != ipmi.RMCP_VERSION:
+            return None
+        if data[3] == ipmi.RMCP_CLASS_ASF:
+            return self._handle_asf(packet)
+        if data[3] != ipmi.RMCP_CLASS_IPMI:
+            return None
+        if data[4] == ipmi.AUTHTYPE_RMCPP:
+            return self._handle_rmcpp(packet)
+        if data[4] == 0x00:
+            return self._handle_ipmi15(data)
+        return None
+
+    def _handle_asf(self, packet):
+        msg_type, tag, _ = ipmi.unpack_asf(packet)
+        if msg_type != ipmi.ASF_PING:
+            return None
+        return ipmi.pack_asf_pong(tag)
+
+    def _handle_ipmi15(self, data):
+        if len(data) < 14:
+            return None
+        sid = struct.unpack('<I', ipmi._b(data[9:13]))[0]
+        if sid != 0:
+            return None
+        req = unpack_ipmi_request(data[14:14 + data[13]])
+        rsp = self._presession_command(req)
+        return pack_ipmi15(rsp) if rsp is not None else None
+
+    def _presession_command(self, req):
+        if (req['netfn'], req['cmd']) not in self.PRESESSION:
+            return None
+        handler = self.COMMANDS[(req['netfn'], req['cmd'])][0]
+        code, data = getattr(self, handler)(None, req['data'])
+        return pack_ipmi_response(req, code, data)
+
+    def _handle_rmcpp(self, packet):
+        ptype, sid, _, payload = ipmi.peek_rmcpp(packet)
+        ptype &= 0x3f
+        if ptype == ipmi.PAYLOAD_OPEN_SESSION_REQ:
+            return self._open_session(bytearray(payload))
+        if ptype == ipmi.PAYLOAD_RAKP1:
+            return self._rakp1(bytearray(payload))
+        if ptype == ipmi.PAYLOAD_RAKP3:
+            return self._rakp3(bytearray(payload))
+        if ptype != ipmi.PAYLOAD_IPMI:
+            return None
+        if sid == 0:
+            payload = ipmi.unpack_rmcpp(packet)[3]
+            rsp = self._presession_command(unpack_ipmi_request(payload))
+            return ipmi.pack_rmcpp(ipmi.PAYLOAD_IPMI, 0, 0, rsp) if rsp is not None else None
+        sess = self.sessions.get(sid)
+        if sess is None or not sess.active:
+            return None
+        _, _, _, payload, authenticated = ipmi.unpack_rmcpp(
+            packet, sess.k1 if sess.integrity_alg else None,
+            sess.k2 if sess.conf_alg else None)
+        if sess.integrity_alg and not authenticated:
+            return None
+        sess.last_seen = time.time()
+        req = unpack_ipmi_request(payload)
+        handler = self.COMMANDS.get((req['netfn'], req['cmd']))
+        if handler is None:
+            code, data = CC_INVALID_CMD, b''
+        elif sess.privilege < handler[1]:
+            code, data = CC_INSUFFICIENT_PRIV, b''
+        else:
+            code, data = getattr(self, handler[0])(sess, req['data'])
+        return sess.message(pack_ipmi_response(req, code, data))
+
+    def _open_session(self, p):
+        if len(p) < 8:
+            return None
+        tag, req_priv = p[0], p[1] & 0x0f
+        console_id = struct.unpack('<I', ipmi._b(p[4:8]))[0]
+        algorithms = list(ipmi.CIPHER_SUITES[ipmi.DEFAULT_CIPHER_SUITE])
+        for off in range(8, len(p) - 7, 8):
+            ptype, plen, alg = p[off], p[off + 3], p[off + 4]
+            if ptype < 3 and plen == 8:
+                algorithms[ptype] = alg & 0x3f
+        algorithms = tuple(algorithms)
+        self.expire_sessions(time.time())
+        status = 0
+        if algorithms not in SERVER_CIPHER_SUITES.values():
+            status = 0x11
+        elif req_priv > ipmi.PRIV_ADMIN:
+            status = 0x09
+        elif len(self.sessions) >= MAX_SESSIONS:
+            status = 0x01
+        if status:
+            return ipmi.pack_rmcpp(ipmi.PAYLOAD_OPEN_SESSION_RSP, 0, 0,
+                                   struct.pack('<BBBBI', tag, status, 0, 0, console_id))
+        max_priv = req_priv or ipmi.PRIV_ADMIN
+        sess = ServerSession(self._new_bmc_id(), console_id, algorithms, max_priv)
+        self.sessions[sess.bmc_id] = sess
+        body = struct.pack('<BBBBII', tag, 0, max_priv, 0, console_id, sess.bmc_id)
+        for ptype, alg in enumerate(algorithms):
+            body += struct.pack('<BHBBBH', ptype, 0, 8, alg, 0, 0)
+        return ipmi.pack_rmcpp(ipmi.PAYLOAD_OPEN_SESSION_RSP, 0, 0, body)
+
+    def _name_part(self, sess):
+        return struct.pack('<BB', sess.role, len(self.user)) + self.user
+
+    def _rakp1(self, p):
+        if len(p) < 28:
+            return None
+        tag = p[0]
+        sess = self.sessions.get(struct.unpack('<I', ipmi._b(p[4:8]))[0])
+        if sess is None or sess.active:
+            return ipmi.pack_rmcpp(ipmi.PAYLOAD_RAKP2, 0, 0, struct.pack('<BBHI', tag, 0x02, 0, 0))
+        role, ulen = p[24], p[27]
+        user = ipmi._b(p[28:28 + ulen])
+        status = 0
+        if ulen > 16:
+            status = 0x0c
+        elif user != self.user:
+            status = 0x0d
+        elif (role & 0x0f) > sess.max_priv:
+            status = 0x0a
+        if status:
+            del self.sessions[sess.bmc_id]
+            return ipmi.pack_rmcpp(ipmi.PAYLOAD_RAKP2, 0, 0,
+                                   struct.pack('<BBHI', tag, status, 0, sess.console_id))
+        sess.rm = ipmi._b(p[8:24])
+        sess.rc = os.urandom(16)
+        sess.role = role
+        sess.max_priv = (role & 0x0f) or sess.max_priv
+        authcode = ipmi._hmac_sha1(self.kuid, struct.pack('<II', sess.console_id, sess.bmc_id) +
+                                   sess.rm + sess.rc + self.guid + self._name_part(sess))
+        body = struct.pack('<BBHI', tag, 0, 0, sess.console_id) + sess.rc + self.guid + authcode
+        return ipmi.pack_rmcpp(ipmi.PAYLOAD_RAKP2, 0, 0, body)
+
+    def _rakp3(self, p):
+        if len(p) < 8:
+            return None
+        tag, status = p[0], p[1]
+        sess = self.sessions.get(struct.unpack('<I', ipmi._b(p[4:8]))[0])
+        if sess is None or sess.rc is None or sess.active:
+            return ipmi.pack_rmcpp(ipmi.PAYLOAD_RAKP4, 0, 0, struct.pack('<BBHI', tag, 0x02, 0, 0))
+        if status != 0:
+            del self.sessions[sess.bmc_id]
+            return None
+        namepart = self._name_part(sess)
+        expect = ipmi._hmac_sha1(self.kuid, sess.rc + struct.pack('<I', sess.console_id) + namepart)
+        if not ipmi.hmac.compare_digest(expect, ipmi._b(p[8:28])):
+            del self.sessions[sess.bmc_id]
+            return ipmi.pack_rmcpp(ipmi.PAYLOAD_RAKP4, 0, 0,
+                                   struct.pack('<BBHI', tag, 0x0f, 0, sess.console_id))
+        sik = ipmi._hmac_sha1(self.kuid, sess.rm + sess.rc + namepart)
+        sess.k1 = ipmi._hmac_sha1(sik, b'\x01' * 20)
+        sess.k2 = ipmi._hmac_sha1(sik, b'\x02' * 20)[:16]
+        sess.active = True
+        icv = ipmi._hmac_sha1(sik, sess.rm + struct.pack('<I', sess.bmc_id) + self.guid)[:12]
+        body = struct.pack('<BBHI', tag, 0, 0, sess.console_id) + icv
+        return ipmi.pack_rmcpp(ipmi.PAYLOAD_RAKP4, 0, 0, body)
+
+    # --- commands -----------------------------------------------------
+
+    def _get_device_id(self, sess, data):
+        return CC_OK, struct.pack('<BBBBBBBBBH', 0x20, 0x00, 0x01, 0x00, 0x02, 0x80, 0, 0, 0, 0)
+
+    def _get_channel_auth_caps(self, sess, data):
+        # IPMI v2.0 extended capabilities only, non-null user names
+        return CC_OK, struct.pack('BBBBBBBB', 0x01, 0x80, 0x08, 0x02, 0, 0, 0, 0)
+
+    def _get_channel_cipher_suites(self, sess, data):
+        data = bytearray(data)
+        if len(data) < 3:
+            return CC_REQ_LENGTH, b''
+        records = b''
+        for suite, (auth, integrity, conf) in sorted(SERVER_CIPHER_SUITES.items()):
+            records += struct.pack('BBBBB', 0xc0, suite, auth, 0x40 | integrity, 0x80 | conf)
+        index = data[2] & 0x3f
+        return CC_OK, struct.pack('B', 0x01) + records[index * 16:(index + 1) * 16]
+
+    def _set_session_priv(self, sess, data):
+        data = bytearray(data)
+        if len(data) < 1:
+            return CC_REQ_LENGTH, b''
+        priv = data[0] & 0x0f
+        if priv:
+            if priv > sess.max_priv:
+                return CC_PRIV_EXCEEDS_LIMIT, b''
+            sess.privilege = priv
+        return CC_OK, struct.pack('B', sess.privilege)
+
+    def _close_session(self, sess, data):
+        if len(data) < 4:
+            return CC_REQ_LENGTH, b''
+        sid = struct.unpack('<I', ipmi._b(data[:4]))[0]
+        if sid not in self.sessions:
+            return CC_INVALID_SESSION, b''
+        del self.sessions[sid]
+        return CC_OK, b''
+
+    def _get_chassis_status(self, sess, data):
+        return CC_OK, struct.pack('BBB', 0x01 if self.is_power_on() else 0x00, 0, 0)
+
+    def _chassis_control(self, sess, data):
+        data = bytearray(data)
+        if len(data) < 1:
+            return CC_REQ_LENGTH, b''
+        if not self.control(data[0] & 0x0f):
+            return CC_INVALID_DATA, b''
+        self.audit_lan(AUDIT_OPS[data[0] & 0x0f])
+        return CC_OK, b''
+
+    def _chassis_identify(self, sess, data):
+        return CC_OK, b''
+
+    def _set_boot_options(self, sess, data):
+        data = bytearray(data)
+        if len(data) < 1:
+            return CC_REQ_LENGTH, b''
+        param = data[0] & 0x7f
+        if param in (ipmi.BOOT_PARAM_SET_IN_PROGRESS, ipmi.BOOT_PARAM_INFO_ACK):
+            return CC_OK, b''
+        if param != ipmi.BOOT_PARAM_FLAGS:
+            return CC_PARAM_UNSUPPORTED, b''
+        if len(data) < 3:
+            return CC_REQ_LENGTH, b''
+        bootdev = SELECTOR_BOOTDEV.get((data[2] >> 2) & 0x0f)
+        if data[1] & ipmi.BOOT_FLAGS_VALID and bootdev is not None:
+            self.set_bootdev(bootdev)
+            if data[1] & ipmi.BOOT_FLAGS_PERSISTENT:
+                self.audit_lan('bootdev', device=bootdev, persistent=True)
+            else:
+                self.audit_lan('bootdev', device=bootdev)
+        return CC_OK, b''
+
+    def _get_boot_options(self, sess, data):
+        data = bytearray(data)
+        if len(data) < 1:
+            return CC_REQ_LENGTH, b''
+        param = data[0] & 0x7f
+        if param == ipmi.BOOT_PARAM_SET_IN_PROGRESS:
+            return CC_OK, struct.pack('BBB', 0x01, param, 0x00)
+        if param != ipmi.BOOT_PARAM_FLAGS:
+            return CC_PARAM_UNSUPPORTED, b''
+        selector = ipmi.BOOTDEV_SELECTOR.get(self.bootdev, 0x00)
+        return CC_OK, struct.pack('BBBBBBB', 0x01, param, 0xc0, selector << 2, 0, 0, 0)
+
+
+class BMCEngine(object):
+
+    def __init__(self, loader, control_socket=CONTROL_SOCKET,
+                 state_file=STATE_FILE, workers=8, chassis_socket=CHASSIS_SOCKET):
+        self.loader = loader
+        self.control_socket = control_socket
+        self.chassis_socket = chassis_socket
+        self.state_file = state_file
+        self.pool = Pool(processes=workers)
+        self.nodes = {}
+        # ipmi_sim nodes whose chassis control requests the engine answers
+        self.chassis_nodes = {}
+        # uuid -> [(conn, args)] of requests waiting for their node to load
+        self._loading = {}
+        self._chassis_lock = threading.Lock()
+        # fd -> [conn, received, deadline, handler] of clients still sending
+        self._clients = {}
+        # fd -> [conn, unsent, deadline] of control replies still sending
+        self._replies = {}
+        # (conn, units, error) of control start requests loaded on the pool
+        self._loaded = collections.deque()
+        self._wakeup = None
+        self._by_fd = {}
+        self._poller = select.poll()
+        self._control = None
+        self._chassis = None
+        self.running = False
+
+    def _save_state(self):
+        with open(self.state_file + '.tmp', 'w') as f:
+            json.dump(sorted(self.nodes), f)
+        os.rename(self.state_file + '.tmp', self.state_file)
+
+    def _load_state(self):
+        if not os.path.exists(self.state_file):
+            return []
+        with open(self.state_file) as f:
+            return json.load(f)
+
+    def start(self, uuids):
+        return self._serve(self.loader([u for u in uuids if u not in self.nodes]))
+
+    def _serve(self, units):
+        errors = {}
+        for unit in units:
+            if unit.uuid in self.nodes:
+                continue
+            if unit.bmc_backend != BACKEND_BUILTIN:
+                errors[unit.uuid] = 'BMC backend is {}'.format(unit.bmc_backend)
+                continue
+            node = BMCNode(self, unit)
+            try:
+                node.bind()
+            except socket.error as e:
+                errors[unit.uuid] = 'bind {}:{}: {}'.format(node.addr[0], node.addr[1], e)
+                continue
+            self.nodes[node.uuid] = node
+            self._by_fd[node.fileno()] = node
+            self._poller.register(node.fileno(), select.POLLIN)
+            LOG.info('Serve BMC {} on {}:{}'.format(node.uuid, *node.addr))
+        self._save_state()
+        return errors
+
+    def stop(self, uuids):
+        for _uuid in uuids:
+            with self._chassis_lock:
+                self.chassis_nodes.pop(_uuid, None)
+            node = self.nodes.pop(_uuid, None)
+            if node is None:
+                continue
+            self._poller.unregister(node.fileno())
+            del self._by_fd[node.fileno()]
+            node.close()
+            LOG.info('Stop serving BMC {}'.format(_uuid))
+        self._save_state()
+        return {}
+
+    def status(self):
+        return dict((_uuid, node.status()) for _uuid, node in self.nodes.items())
+
+    def chassis(self, conn, _uuid, args):
+        """Answer the chassis request of conn, loading its node on the pool
+        the first time, the database must not hold up the poll loop."""
+        node = self.nodes.get(_uuid)
+        with self._chassis_lock:
+            node = node or self.chassis_nodes.get(_uuid)
+            if node is None:
+                waiting = self._loading.setdefault(_uuid, [])
+                waiting.append((conn, args))
+                if len(waiting) == 1:
+                    self.pool.apply_async(self._load_chassis_node, (_uuid,))
+                return
+        _reply_chassis(conn, node, args)
+
+    def _load_chassis_node(self, _uuid):
+        node = None
+        error = 'Unknown BMC: {}'.format(_uuid)
+        try:
+            units = self.loader([_uuid])
+            if units:
+                node = BMCNode(self, units[0])
+        except Exception as e:
+            error = str(e)
+        with self._chassis_lock:
+            if node is not None:
+                self.chassis_nodes[_uuid] = node
+            waiting = self._loading.pop(_uuid, [])
+        for conn, args in waiting:
+            if node is None:
+                _send_reply(conn, '1\n{}\n'.format(error))
+            else:
+                _reply_chassis(conn, node, args)
+
+    def _listen(self, path):
+        utils.mkdir_of_file(path)
+        if os.path.exists(path):
+            os.unlink(path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(path)
+        # every ipmi_sim of the host may connect at once
+        sock.listen(128)
+        sock.setblocking(False)
+        self._poller.register(sock.fileno(), select.POLLIN)
+        return sock
+
+    def _listen_control(self):
+        self._control = self._listen(self.control_socket)
+        self._chassis = self._listen(self.chassis_socket)
+        # pool workers wake the poll loop up when a start request is loaded
+        self._wakeup = socket.socketpair()
+        for sock in self._wakeup:
+            sock.setblocking(False)
+        self._poller.register(self._wakeup[0].fileno(), select.POLLIN)
+
+    def _accept(self, listener, handler):
+        deadline = time.time() + CLIENT_TIMEOUT
+        while True:
+            try:
+                conn, _ = listener.accept()
+            except socket.error:
+                return
+            conn.setblocking(False)
+            self._clients[conn.fileno()] = [conn, b'', deadline, handler]
+            self._poller.register(conn.fileno(), select.POLLIN)
+
+    def _drop_client(self, fd):
+        self._poller.unregister(fd)
+        return self._clients.pop(fd)
+
+    def _on_client(self, fd):
+        item = self._clients[fd]
+        conn = item[0]
+        try:
+            chunk = conn.recv(65536)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            chunk = b''
+        item[1] += chunk
+        if chunk and not item[1].endswith(b'\n'):
+            return
+        self._drop_client(fd)
+        item[3](conn, item[1].decode('utf-8'))
+
+    def _expire_clients(self, now):
+        for fd, item in list(self._clients.items()):
+            if item[2] <= now:
+                self._drop_client(fd)
+                item[0].close()
+        for fd, item in list(self._replies.items()):
+            if item[2] <= now:
+                self._poller.unregister(fd)
+                del self._replies[fd]
+                item[0].close()
+
+    def _reply(self, conn, res):
+        """Send the control reply res without waiting for a slow reader."""
+        self._replies[conn.fileno()] = [conn, (json.dumps(res) + '\n').encode('utf-8'),
+                                        time.time() + CLIENT_TIMEOUT]
+        self._poller.register(conn.fileno(), select.POLLOUT)
+        self._on_writable(conn.fileno())
+
+    def _on_writable(self, fd):
+        item = self._replies[fd]
+        try:
+            item[1] = item[1][item[0].send(item[1]):]
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            item[1] = b''
+        if not item[1]:
+            self._poller.unregister(fd)
+            del self._replies[fd]
+            item[0].close()
+
+    def _load_units(self, conn, uuids):
+        units, error = [], None
+        try:
+            units = self.loader([u for u in uuids if u not in self.nodes])
+        except Exception as e:
+            error = str(e)
+        self._loaded.append((conn, units, error))
+        try:
+            self._wakeup[1].send(b'x')
+        except socket.error:
+            # full, the loop is woken up already
+            pass
+
+    def _on_loaded(self):
+        try:
+            self._wakeup[0].recv(4096)
+        except socket.error:
+            pass
+        while self._loaded:
+            conn, units, error = self._loaded.popleft()
+            if error is not None:
+                self._reply(conn, {'ok': False, 'error': error})
+                continue
+            try:
+                res = {'ok': True, 'errors': self._serve(units)}
+            except Exception as e:
+                res = {'ok': False, 'error': str(e)}
+            self._reply(conn, res)
+
+    def _on_control(self, conn, line):
+        try:
+            req = json.loads(line)
+            cmd = req.get('cmd')
+            if cmd == 'start':
+                # the database must not hold up the poll loop, load on the pool
+                self.pool.apply_async(self._load_units, (conn, req.get('uuids', [])))
+                return
+            elif cmd == 'stop':
+                res = {'ok': True, 'errors': self.stop(req.get('uuids', []))}
+            elif cmd == 'status':
+                res = {'ok': True, 'nodes': self.status()}
+            elif cmd == 'metrics':
+                res = {'ok': True, 'metrics': metrics.REGISTRY.snapshot()}
+            elif cmd == 'shutdown':
+                self.running = False
+                res = {'ok': True}
+            else:
+                res = {'ok': False, 'error': 'Unknown command: {}'.format(cmd)}
+        except Exception as e:
+            res = {'ok': False, 'error': str(e)}
+        self._reply(conn, res)
+
+    def _on_chassis(self, conn, line):
+        args = line.split()
+        if not args:
+            conn.close()
+            return
+        self.chassis(conn, args[0], args[1:])
+
+    def _on_node(self, node):
+        while node.sock is not None:
+            try:
+                packet, addr = node.sock.recvfrom(4096)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                continue
+            node.peer = addr
+            try:
+                reply = node.handle_packet(packet)
+            except ipmi.IPMIError as e:
+                LOG.debug('BMC {} bad packet from {}: {}'.format(node.uuid, addr, e))
+                continue
+            if reply is not None:
+                node.sock.sendto(reply, addr)
+
+    def _stop_running(self, *_):
+        self.running = False
+
+    def serve_forever(self):
+        metrics.PROCESS = 'bmc-engine'
+        self._listen_control()
+        signal.signal(signal.SIGTERM, self._stop_running)
+        signal.signal(signal.SIGINT, self._stop_running)
+        errors = self.start(self._load_state())
+        for _uuid, error in errors.items():
+            LOG.error('Serve BMC {} error: {}'.format(_uuid, error))
+        self.running = True
+        last_housekeeping = time.time()
+        try:
+            while self.running:
+                try:
+                    events = self._poller.poll(1000)
+                except (select.error, IOError) as e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+                for fd, _ in events:
+                    if fd == self._control.fileno():
+                        self._accept(self._control, self._on_control)
+                    elif fd == self._chassis.fileno():
+                        self._accept(self._chassis, self._on_chassis)
+                    elif fd == self._wakeup[0].fileno():
+                        self._on_loaded()
+                    elif fd in self._clients:
+                        self._on_client(fd)
+                    elif fd in self._replies:
+                        self._on_writable(fd)
+                    elif fd in self._by_fd:
+                        self._on_node(self._by_fd[fd])
+                now = time.time()
+                if self._clients or self._replies:
+                    self._expire_clients(now)
+                if now - last_housekeeping > HOUSEKEEPING_INTERVAL:
+                    for node in self.nodes.values():
+                        node.expire_sessions(now)
+                    last_housekeeping = now
+        finally:
+            for node in self.nodes.values():
+                node.close()
+            for item in list(self._clients.values()) + list(self._replies.values()):
+                item[0].close()
+            for sock, path in ((self._control, self.control_socket),
+                               (self._chassis, self.chassis_socket)):
+                sock.close()
+                os.unlink(path)
+            self.pool.close()
+            self.pool.join()
+            for conn, _, _ in self._loaded:
+                conn.close()
+            for sock in self._wakeup:
+                sock.close()
+
+
+def _send_reply(conn, output):
+    try:
+        conn.sendall(output.encode('utf-8'))
+    except socket.error:
+        pass
+    conn.close()
+
+
+def _reply_chassis(conn, node, args):
+    try:
+        output = '0\n' + node.chassis(args)
+    except Exception as e:
+        output = '1\n{}\n'.format(e)
+    _send_reply(conn, output)
+
+
+def _read_line(sock):
+    buf = b''
+    while not buf.endswith(b'\n'):
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        buf += chunk
+    return buf.decode('utf-8')
+
+
+def engine_request(cmd, timeout=10, **kwargs):
+    kwargs['cmd'] = cmd
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(CONTROL_SOCKET)
+        sock.sendall((json.dumps(kwargs) + '\n').encode('utf-8'))
+        res = json.loads(_read_line(sock))
+    finally:
+        sock.close()
+    if not res.get('ok'):
+        raise Exception('BMC engine {} error: {}'.format(cmd, res.get('error')))
+    return res
+
+
+def is_engine_running():
+    try:
+        engine_request('status', timeout=2)
+        return True
+    except (socket.error, ValueError):
+        return False
+
+
+def ensure_engine(wait=10):
+    if is_engine_running():
+        return
+    utils.mkdir_of_file(LOG_FILE)
+    cmd = [sys.executable, os.path.join(config.BASE_DIR, 'vbmc.py'), 'bmc-engine']
+    LOG.info('Spawn BMC engine: {}'.format(' '.join(cmd)))
+    with open(LOG_FILE, 'a') as log:
+        subprocess.Popen(cmd, stdin=open(os.devnull), stdout=log, stderr=subprocess.STDOUT,
+                         close_fds=True, preexec_fn=os.setsid)
+    deadline = time.time() + wait
+    while time.time() < deadline:
+        if is_engine_running():
+            return
+        time.sleep(0.1)
+    raise Exception('BMC engine not up after {}s, see {}'.format(wait, LOG_FILE))
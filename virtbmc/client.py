@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+"""
+Thin client of vbmcd.
+
+Kept free of the models and manager imports so that forwarding a command
+costs little more than the interpreter start.
+"""
+
+import os
+import sys
+import json
+import socket
+
+import virtbmc.config as config
+
+
+# subcommands vbmcd runs on behalf of vbmc.py
+SERVED_COMMANDS = ('create', 'start', 'stop', 'list', 'update', 'delete',
+                   'regen', 'ports', 'images', 'metrics', 'power', 'bootdev')
+
+
+class DaemonUnavailable(Exception):
+    pass
+
+
+def read_line(sock):
+    buf = b''
+    while not buf.endswith(b'\n'):
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        buf += chunk
+    return buf.decode('utf-8')
+
+
+def tcp_address(address):
+    """(host, port) of a HOST:PORT address, None for a unix socket path."""
+    host, _, port = address.rpartition(':')
+    if address.startswith('/') or not port.isdigit():
+        return None
+    return host or '127.0.0.1', int(port)
+
+
+def request(msg, timeout=None, path=None):
+    """Send msg to vbmcd at path (unix socket or HOST:PORT), return the reply."""
+    path = path or config.VBMCD_SOCKET
+    addr = tcp_address(path)
+    if addr is None:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        try:
+            sock.connect(addr or path)
+        except socket.error as e:
+            raise DaemonUnavailable(str(e))
+        sock.sendall((json.dumps(msg) + '\n').encode('utf-8'))
+        line = read_line(sock)
+    finally:
+        sock.close()
+    if not line:
+        raise Exception('vbmcd closed the connection')
+    return json.loads(line)
+
+
+def subcommand(argv):
+    for arg in argv:
+        if not arg.startswith('-'):
+            return arg
+    return None
+
+
+def forward(argv):
+    """Run argv through vbmcd, return the exit code or None to run locally."""
+    if os.environ.get('VBMC_NO_DAEMON') or subcommand(argv) not in SERVED_COMMANDS:
+        return None
+    # the profile is the one of this process
+    if any(arg.startswith('--profile') for arg in argv):
+        return None
+    if not os.path.exists(config.VBMCD_SOCKET):
+        return None
+    try:
+        res = request({'cmd': 'run', 'argv': argv, 'cwd': os.getcwd()})
+    except DaemonUnavailable:
+        return None
+    sys.stdout.write(res.get('output', ''))
+    sys.stderr.write(res.get('errors', ''))
+    if res.get('error'):
+        sys.stderr.write('{}\n'.format(res.get('error')))
+    return res.get('code', 0 if res.get('ok') else 1)
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+
+"""
+Coordinator of several vbmc-qemu hosts.
+
+Every host runs vbmcd as an agent, on its own workspace:
+
+    $ ./vbmc.py vbmcd --listen 0.0.0.0:7001 --token secret
+
+The coordinator keeps the agents in its database, places new nodes on the
+agents with the most free memory that still have room for them in memory
+and cpus, routes commands taking node uuids to the agents holding them and
+merges the output of list and the other commands run on every agent.
+"""
+
+import os
+import sys
+import json
+from multiprocessing.pool import ThreadPool as Pool
+
+from tabulate import tabulate
+
+from virtbmc.models import Agent
+import virtbmc.models as models
+from virtbmc import client
+from virtbmc.clrlog import LOG
+
+
+# commands taking node uuids or "all"
+ROUTED_COMMANDS = ('start', 'stop', 'delete', 'update', 'regen', 'warm', 'power',
+                   'bootdev')
+
+# commands run on every agent
+BROADCAST_COMMANDS = ('list', 'ports', 'images', 'history')
+
+# seconds to wait for an agent's capacity
+CAPACITY_TIMEOUT = 10
+
+# vcpus placed per host cpu
+CPU_OVERCOMMIT = 4.0
+
+
+class AgentClient(object):
+
+    def __init__(self, agent):
+        self.name = agent.name
+        self.address = agent.address
+        self.token = agent.token
+
+    def request(self, cmd, timeout=None, **kwargs):
+        kwargs['cmd'] = cmd
+        if self.token:
+            kwargs['token'] = self.token
+        try:
+            res = client.request(kwargs, timeout, self.address)
+        except client.DaemonUnavailable as e:
+            raise Exception('agent {} unavailable at {}: {}'.format(self.name, self.address, e))
+        if not res.get('ok') and cmd != 'run':
+            raise Exception('agent {} {} error: {}'.format(self.name, cmd, res.get('error')))
+        return res
+
+    def capacity(self):
+        return self.request('capacity', CAPACITY_TIMEOUT)
+
+    def nodes(self):
+        return self.request('nodes', CAPACITY_TIMEOUT)['nodes']
+
+    def run(self, argv):
+        return self.request('run', argv=argv, cwd=os.getcwd())
+
+
+def each(func, items):
+    """[(item, result, error)] of func applied to items concurrently."""
+    def _call(item):
+        try:
+            return item, func(item), None
+        except Exception as e:
+            return item, None, str(e)
+
+    if not items:
+        return []
+    pool = Pool(processes=len(items))
+    try:
+        return pool.map(_call, items)
+    finally:
+        pool.close()
+
+
+def load_agents(names=None):
+    query = Agent.select().order_by(Agent.name)
+    if names:
+        query = query.where(Agent.name << names)
+    agents = [AgentClient(agent) for agent in query]
+    missing = set(names or []) - set(agent.name for agent in agents)
+    if missing:
+        raise Exception('Unknown agent: {}'.format(', '.join(sorted(missing))))
+    if not agents:
+        raise Exception('No agent, add one with: vbmc.py agent --add NAME ADDRESS')
+    return agents
+
+
+def free_resources(cap, cpu_overcommit=CPU_OVERCOMMIT):
+    """Memory in MB and cpus an agent still has for new nodes."""
+    memory = min(cap['mem_available'], cap['mem_total'] - cap['mem_committed'])
+    return memory, cap['cpus'] * cpu_overcommit - cap['cpu_committed']
+
+
+def place(capacities, count, memory, ncpu, cpu_overcommit=CPU_OVERCOMMIT):
+    """Nodes of memory MB and ncpu cpus per agent name, count in total.
+
+    Each node goes to the agent with the largest share of its memory free
+    among those it fits on.
+    """
+    free = dict((name, list(free_resources(cap, cpu_overcommit)))
+                for name, cap in capacities.items())
+    res = dict.fromkeys(capacities, 0)
+    for placed in range(count):
+        fits = [name for name, (mem, cpus) in free.items() if mem >= memory and cpus >= ncpu]
+        if not fits:
+            raise Exception('No room for {} more nodes of {}MB and {} cpus after placing {}'.format(
+                count - placed, memory, ncpu, placed))
+        name = max(fits, key=lambda n: (free[n][0] / float(capacities[n]['mem_total']), n))
+        free[name][0] -= memory
+        free[name][1] -= ncpu
+        res[name] += 1
+    return res
+
+
+def with_number(argv, number):
+    """argv of create with -n replaced by number."""
+    res = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg in ('-n', '--number'):
+            skip = True
+        elif not (arg.startswith('--number=') or (arg.startswith('-n') and arg[2:].isdigit())):
+            res.append(arg)
+    return res + ['-n', str(number)]
+
+
+def with_ids(argv, ids, agent_ids):
+    """argv of a routed command with ids replaced by the ones of an agent."""
+    ids = set(ids)
+    pos = argv.index(client.subcommand(argv))
+    return argv[:pos + 1] + agent_ids + [arg for arg in argv[pos + 1:] if arg not in ids]
+
+
+def print_results(results):
+    failed = []
+    for agent, res, error in results:
+        if res is not None:
+            sys.stdout.write('[{}]\n{}'.format(agent.name, res.get('output', '')))
+            sys.stderr.write(res.get('errors', ''))
+            error = res.get('error') if not res.get('ok') else None
+        if error:
+            LOG.error('Agent {}: {}'.format(agent.name, error))
+            failed.append(agent.name)
+    if failed:
+        raise Exception('{} of {} agents failed: {}'.format(
+            len(failed), len(results), ', '.join(failed)))
+
+
+def create(agents, args, argv):
+    results = each(lambda agent: agent.capacity(), agents)
+    capacities = {}
+    for agent, cap, error in results:
+        if error:
+            LOG.warning('Skip agent {}: {}'.format(agent.name, error))
+        else:
+            capacities[agent.name] = cap
+    placement = place(capacities, args.number, args.memory, args.ncpu, args.cpu_overcommit)
+    data_series = []
+    for name in sorted(capacities):
+        mem, cpus = free_resources(capacities[name], args.cpu_overcommit)
+        data_series.append([name, capacities[name]['host'], placement[name], mem, cpus])
+    print(tabulate(data_series, ['Agent', 'Host', 'Nodes', 'FreeMem(MB)', 'FreeCPUs'],
+                   tablefmt="psql"))
+    counts = dict((agent, placement[agent.name]) for agent in agents if placement.get(agent.name))
+    print_results(each(lambda agent: agent.run(with_number(argv, counts[agent])), list(counts)))
+
+
+def route(agents, ids, argv):
+    if ids[:1] == ['all']:
+        print_results(each(lambda agent: agent.run(argv), agents))
+        return
+    owners = {}
+    for agent, nodes, error in each(lambda agent: agent.nodes(), agents):
+        if error:
+            raise Exception(error)
+        for _uuid in nodes:
+            owners[_uuid] = agent
+    missing = [_uuid for _uuid in ids if _uuid not in owners]
+    if missing:
+        raise Exception('Unknown BMC: {}'.format(', '.join(missing)))
+    by_agent = {}
+    for _uuid in ids:
+        by_agent.setdefault(owners[_uuid], []).append(_uuid)
+    print_results(each(lambda agent: agent.run(with_ids(argv, ids, by_agent[agent])),
+                       list(by_agent)))
+
+
+def list_nodes(agents, json_output, argv):
+    from virtbmc.manager import QemuBMCUnit
+    if '--json' not in argv:
+        argv = argv + ['--json']
+    rows = []
+    failed = []
+    for agent, res, error in each(lambda agent: agent.run(argv), agents):
+        if res is not None and res.get('ok'):
+            rows += [dict(row, Agent=agent.name) for row in json.loads(res['output'])]
+        else:
+            LOG.error('Agent {}: {}'.format(agent.name, error or res.get('error')))
+            failed.append(agent.name)
+    headers = ['Agent'] + QemuBMCUnit.list_headers
+    if json_output:
+        print(json.dumps(rows, indent=4))
+    else:
+        print(tabulate([[row.get(name) for name in headers] for row in rows], headers,
+                       tablefmt="psql"))
+    if failed:
+        raise Exception('{} of {} agents failed: {}'.format(
+            len(failed), len(agents), ', '.join(failed)))
+
+
+def manage(args):
+    from virtbmc import optparse
+    argv = args.argv
+    command = client.subcommand(argv)
+    if command not in ('create',) + ROUTED_COMMANDS + BROADCAST_COMMANDS:
+        raise Exception('Not a cluster command: {}'.format(command))
+    cmd_args = optparse.init_argparser().parse_args(argv)
+    cmd_args.cpu_overcommit = args.cpu_overcommit
+    agents = load_agents(args.agents)
+    if command == 'create':
+        create(agents, cmd_args, argv)
+    elif command == 'list':
+        list_nodes(agents, cmd_args.json, argv)
+    elif command in ROUTED_COMMANDS:
+        route(agents, getattr(cmd_args, 'id', None) or cmd_args.bmc, argv)
+    else:
+        print_results(each(lambda agent: agent.run(argv), agents))
+
+
+def manage_agents(args):
+    if args.add:
+        name, address = args.add
+        with models.DB.atomic():
+            updated = Agent.update(address=address, token=args.token or '').where(
+                Agent.name == name).execute()
+            if not updated:
+                Agent.create(name=name, address=address, token=args.token or '')
+    if args.remove:
+        Agent.delete().where(Agent.name == args.remove).execute()
+    agents = [AgentClient(agent) for agent in Agent.select().order_by(Agent.name)]
+    data_series = []
+    for agent, cap, error in each(lambda agent: agent.capacity(), agents):
+        if error:
+            data_series.append([agent.name, agent.address] + ['-'] * 5 + [error])
+            continue
+        data_series.append([agent.name, agent.address, cap['host'], cap['nodes'],
+                            '{}/{}'.format(cap['mem_committed'], cap['mem_total']),
+                            cap['mem_available'],
+                            '{}/{}'.format(cap['cpu_committed'], cap['cpus']), 'ok'])
+    print(tabulate(data_series, ['Agent', 'Address', 'Host', 'Nodes', 'Mem(MB)', 'MemAvail(MB)',
+                                 'CPUs', 'Status'], tablefmt="psql"))
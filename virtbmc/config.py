@@ -1,9 +1,25 @@
-import os.path
-from virtbmc import utils
+import os
 
-BASE_DIR = utils.dirname(__file__, 1)
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
 
 # WORKSPACE used to store QEMU/BMC config/script files
-WORKSPACE = os.path.join(BASE_DIR, 'workspace')
+WORKSPACE = os.environ.get('VBMC_WORKSPACE') or os.path.join(BASE_DIR, 'workspace')
 
 DB_FILE = os.path.join(WORKSPACE, 'virtbmc.db')
+
+# unix socket of the vbmcd daemon
+VBMCD_SOCKET = os.path.join(WORKSPACE, 'vbmcd.sock')
+
+# content addressed base images shared by qcow2 overlays
+IMAGE_CACHE_DIR = os.path.join(WORKSPACE, 'images')
+
+# unreferenced base images are evicted LRU first above this size
+IMAGE_CACHE_SIZE = 100 * 1024 ** 3
+
+# BMC presence ping results, trusted for HEALTH_TTL seconds
+HEALTH_CACHE_FILE = os.path.join(WORKSPACE, 'bmc-health.json')
+HEALTH_TTL = float(os.environ.get('VBMC_HEALTH_TTL') or 5)
+
+# node audit logs rotate at this size, AUDIT_BACKUPS older files are kept
+AUDIT_MAX_BYTES = int(os.environ.get('VBMC_AUDIT_MAX_BYTES') or 1024 ** 2)
+AUDIT_BACKUPS = 3
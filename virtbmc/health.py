@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+
+"""
+BMC liveness from ASF presence pings.
+
+One UDP socket pings every BMC at once and waits for their pongs, which both
+ipmi_sim and the builtin engine answer without a session. The results are
+kept in a small JSON file of the workspace for HEALTH_TTL seconds, so list,
+start and stop of any process share them and only stale BMCs get pinged.
+"""
+
+import os
+import json
+import time
+import errno
+import select
+import socket
+import tempfile
+
+import virtbmc.config as config
+from virtbmc import ipmi
+from virtbmc import trace
+
+
+PING_TIMEOUT = 1.0
+# pings sent to a silent BMC within PING_TIMEOUT
+PING_ATTEMPTS = 3
+# datagrams sent between two reads of the pongs
+SEND_BATCH = 64
+
+
+def _drain(sock, pending, sent, res):
+    while True:
+        try:
+            packet, addr = sock.recvfrom(512)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            # ICMP port unreachable of an earlier ping
+            continue
+        try:
+            msg_type, _, _ = ipmi.unpack_asf(packet)
+        except ipmi.IPMIError:
+            continue
+        if msg_type == ipmi.ASF_PONG and addr in pending:
+            pending.discard(addr)
+            res[addr] = time.time() - sent[addr]
+
+
+def presence_ping(addrs, timeout=PING_TIMEOUT, attempts=PING_ATTEMPTS):
+    """{(host, port): round trip seconds, None if no pong} of addrs."""
+    res = dict.fromkeys(addrs)
+    if not res:
+        return res
+    pending = set(res)
+    sent = {}
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setblocking(False)
+    try:
+        with trace.span('presence_ping', trace.OPERATION, bmcs=len(res)):
+            started = time.time()
+            deadline = started + timeout
+            for attempt in range(attempts):
+                for i, addr in enumerate(list(pending)):
+                    try:
+                        sock.sendto(ipmi.pack_asf(ipmi.ASF_PING, attempt), addr)
+                    except socket.error:
+                        continue
+                    sent.setdefault(addr, time.time())
+                    if i % SEND_BATCH == SEND_BATCH - 1:
+                        _drain(sock, pending, sent, res)
+                resend = min(deadline, started + timeout * (attempt + 1) / attempts)
+                while pending:
+                    wait = resend - time.time()
+                    if wait <= 0:
+                        break
+                    if select.select([sock], [], [], wait)[0]:
+                        _drain(sock, pending, sent, res)
+                if not pending:
+                    break
+    finally:
+        sock.close()
+    return res
+
+
+class HealthCache(object):
+    """Presence ping results by "host:port", fresh for ttl seconds."""
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _save(self, entries):
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path),
+                                   prefix='.{}.'.format(os.path.basename(self.path)))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entries, f)
+        os.rename(tmp, self.path)
+
+    def alive(self, addrs, max_age=None):
+        """{(host, port): bool} of addrs, pinging those not checked for max_age seconds."""
+        max_age = self.ttl if max_age is None else max_age
+        now = time.time()
+        entries = self._load()
+        res = {}
+        stale = []
+        for addr in set(addrs):
+            entry = entries.get('{}:{}'.format(*addr))
+            if entry is not None and now - entry[0] <= max_age:
+                res[addr] = entry[1]
+            else:
+                stale.append(addr)
+        if stale:
+            pongs = presence_ping(stale)
+            now = time.time()
+            self._update(entries, [(addr, pongs[addr] is not None) for addr in stale], now)
+            res.update((addr, pongs[addr] is not None) for addr in stale)
+        return res
+
+    def mark(self, addrs, alive):
+        """Record the state of BMCs just started or stopped."""
+        if addrs:
+            self._update(self._load(), [(addr, alive) for addr in addrs], time.time())
+
+    def _update(self, entries, results, now):
+        for addr, alive in results:
+            entries['{}:{}'.format(*addr)] = [now, alive]
+        # forget what no one asked about for a while
+        entries = dict((key, entry) for key, entry in entries.items()
+                       if now - entry[0] <= max(self.ttl, 1) * 100)
+        try:
+            self._save(entries)
+        except (IOError, OSError):
+            pass
+
+
+_cache = None
+
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        _cache = HealthCache(config.HEALTH_CACHE_FILE, config.HEALTH_TTL)
+    return _cache
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+
+"""
+Content addressed cache of golden base images.
+
+Node disks are qcow2 overlays on a read-only cached copy of the base image.
+Cached images are refcounted by the nodes backed by them, unreferenced ones
+are evicted least recently used first once the cache outgrows
+config.IMAGE_CACHE_SIZE.
+"""
+
+import os
+import re
+import json
+import hashlib
+import datetime
+import tempfile
+
+from peewee import fn
+from tabulate import tabulate
+
+from virtbmc.models import BaseImage, QemuVM
+import virtbmc.models as models
+import virtbmc.utils as utils
+import virtbmc.config as config
+from virtbmc.clrlog import LOG
+
+
+COPY_CHUNK = 4 * 1024 * 1024
+
+SIZE_UNITS = {'': 1, 'B': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4,
+              'P': 1024 ** 5, 'E': 1024 ** 6}
+
+
+def parse_size(size):
+    """Bytes of a qemu-img size like 20G, 1.5G, 512k or 10GiB."""
+    m = re.match(r'^(\d+(?:\.\d+)?)\s*(?:([KMGTPE])I?B?|(B?))$', str(size).strip().upper())
+    if not m:
+        raise Exception('Invalid image size: {}'.format(size))
+    return int(float(m.group(1)) * SIZE_UNITS[m.group(2) or m.group(3)])
+
+
+def image_info(path):
+    return json.loads('\n'.join(utils.run_cmd(['qemu-img', 'info', '--output=json', path])))
+
+
+def _import(path, fmt):
+    """Copy path into the cache named by its sha256, hashing while copying."""
+    utils.mkdir_p(config.IMAGE_CACHE_DIR)
+    sha = hashlib.sha256()
+    fd, tmp = tempfile.mkstemp(dir=config.IMAGE_CACHE_DIR, prefix='.import-')
+    try:
+        with os.fdopen(fd, 'wb') as dst, open(path, 'rb') as src:
+            while True:
+                chunk = src.read(COPY_CHUNK)
+                if not chunk:
+                    break
+                sha.update(chunk)
+                dst.write(chunk)
+        digest = sha.hexdigest()
+        cached = os.path.join(config.IMAGE_CACHE_DIR, '{}.{}'.format(digest, fmt))
+        os.chmod(tmp, 0o444)
+        os.rename(tmp, cached)
+    except Exception:
+        utils.rmfile(tmp)
+        raise
+    return digest, cached
+
+
+def add(path):
+    """Cache the base image at path, return its BaseImage."""
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    try:
+        # unchanged sources are not hashed again
+        image = BaseImage.get((BaseImage.source == path) &
+                              (BaseImage.source_size == st.st_size) &
+                              (BaseImage.source_mtime == st.st_mtime))
+        if os.path.exists(image.path):
+            return image
+    except BaseImage.DoesNotExist:
+        pass
+    info = image_info(path)
+    if info.get('backing-filename'):
+        raise Exception('Base image {} has a backing file, flatten it with '
+                        '"qemu-img convert" first'.format(path))
+    LOG.info('Import base image {} into {}'.format(path, config.IMAGE_CACHE_DIR))
+    digest, cached = _import(path, info['format'])
+    source = {'source': path, 'source_size': st.st_size, 'source_mtime': st.st_mtime}
+    with models.DB.atomic():
+        try:
+            image = BaseImage.get(BaseImage.digest == digest)
+            image.path = cached
+            for key, value in source.items():
+                setattr(image, key, value)
+            image.save()
+        except BaseImage.DoesNotExist:
+            image = BaseImage.create(digest=digest, path=cached, format=info['format'],
+                                     size=os.path.getsize(cached),
+                                     virtual_size=info['virtual-size'], **source)
+    return image
+
+
+def acquire(image, count=1):
+    BaseImage.update(refcount=BaseImage.refcount + count,
+                     last_used=datetime.datetime.now()).where(
+                         BaseImage.id == image.id).execute()
+
+
+def release(paths):
+    counts = {}
+    for path in paths:
+        if path:
+            counts[path] = counts.get(path, 0) + 1
+    with models.DB.atomic():
+        for path, count in counts.items():
+            BaseImage.update(refcount=fn.MAX(BaseImage.refcount - count, 0)).where(
+                BaseImage.path == path).execute()
+
+
+def recount():
+    """Recompute refcounts from the overlays recorded in QemuVM."""
+    query = QemuVM.select(QemuVM.base_image, fn.COUNT(QemuVM.id).alias('refs')).group_by(
+        QemuVM.base_image)
+    counts = dict((vm.base_image, vm.refs) for vm in query)
+    with models.DB.atomic():
+        for image in BaseImage.select():
+            image.refcount = counts.get(image.path, 0)
+            image.save()
+
+
+def evict(limit=None):
+    limit = config.IMAGE_CACHE_SIZE if limit is None else limit
+    victims = []
+    with models.DB.atomic():
+        images = list(BaseImage.select().order_by(BaseImage.last_used))
+        total = sum(image.size for image in images)
+        for image in images:
+            if total <= limit:
+                break
+            if image.refcount > 0:
+                continue
+            victims.append(image)
+            total -= image.size
+        if victims:
+            BaseImage.delete().where(BaseImage.id << [image.id for image in victims]).execute()
+    for image in victims:
+        LOG.info('Evict base image {} ({})'.format(image.digest[:12], image.source))
+        utils.rmfile(image.path)
+    return victims
+
+
+def overlay_size(image, image_size):
+    """Overlays never shrink the view of their base image."""
+    size = parse_size(image_size)
+    if size > image.virtual_size:
+        # in bytes, qemu-img does not take every spelling parse_size does
+        return str(size)
+    return str(image.virtual_size)
+
+
+def create_overlay(base, disk, size):
+    fmt = os.path.splitext(base)[1][1:]
+    utils.mkdir_of_file(disk)
+    utils.run_cmd(['qemu-img', 'create', '-f', 'qcow2', '-b', base, '-F', fmt, disk, size])
+
+
+def manage(args):
+    if args.add:
+        add(args.add)
+    if args.recount:
+        recount()
+    if args.evict:
+        evict()
+    data_series = []
+    for image in BaseImage.select().order_by(BaseImage.last_used.desc()):
+        data_series.append([image.digest[:12], image.format, image.size, image.virtual_size,
+                            image.refcount, image.last_used, image.source])
+    print(tabulate(data_series, ['Digest', 'Format', 'Size', 'VirtualSize', 'Refs',
+                                 'LastUsed', 'Source'], tablefmt="psql"))
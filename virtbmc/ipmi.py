@@ -0,0 +1,750 @@
+#!/usr/bin/env python
+
+"""
+Minimal IPMI v2.0 (RMCP+ / lanplus) client.
+
+All sessions share one UDP socket driven by a single select() loop, so
+requests to many BMCs are in flight at the same time instead of paying one
+``ipmitool`` fork and RAKP handshake per node.  Established sessions are
+cached per (host, port, user) and reused by later requests.  Threads calling
+execute() at the same time are served by the same loop: one of them drives
+it for all, the others wait for their own requests.
+
+Cipher suites 0 to 3 are implemented (HMAC-SHA1 authentication and
+integrity, AES-CBC-128 confidentiality).
+"""
+
+import os
+import hmac
+import time
+import errno
+import socket
+import select
+import struct
+import atexit
+import fcntl
+import hashlib
+import threading
+from collections import deque
+
+from virtbmc import aes
+from virtbmc.clrlog import LOG
+
+
+RMCP_VERSION = 0x06
+RMCP_NOACK = 0xff
+RMCP_CLASS_ASF = 0x06
+RMCP_CLASS_IPMI = 0x07
+RMCP_HEADER = struct.pack('BBBB', RMCP_VERSION, 0x00, RMCP_NOACK, RMCP_CLASS_IPMI)
+
+AUTHTYPE_RMCPP = 0x06
+
+# ASF presence ping/pong, answered outside of any session
+ASF_IANA = 4542
+ASF_PING = 0x80
+ASF_PONG = 0x40
+# pong supported entities: IPMI, ASF version 1.0
+ASF_ENTITIES_IPMI = 0x81
+
+PAYLOAD_IPMI = 0x00
+PAYLOAD_OPEN_SESSION_REQ = 0x10
+PAYLOAD_OPEN_SESSION_RSP = 0x11
+PAYLOAD_RAKP1 = 0x12
+PAYLOAD_RAKP2 = 0x13
+PAYLOAD_RAKP3 = 0x14
+PAYLOAD_RAKP4 = 0x15
+
+PAYLOAD_ENCRYPTED = 0x80
+PAYLOAD_AUTHENTICATED = 0x40
+
+BMC_ADDR = 0x20
+REMOTE_SWID = 0x81
+
+NETFN_CHASSIS = 0x00
+NETFN_APP = 0x06
+
+CMD_GET_CHASSIS_STATUS = 0x01
+CMD_CHASSIS_CONTROL = 0x02
+CMD_SET_BOOT_OPTIONS = 0x08
+CMD_GET_BOOT_OPTIONS = 0x09
+CMD_SET_SESSION_PRIV = 0x3b
+CMD_CLOSE_SESSION = 0x3c
+
+PRIV_USER = 0x02
+PRIV_OPERATOR = 0x03
+PRIV_ADMIN = 0x04
+
+# RAKP1 role bit: look the user up by name only
+ROLE_NAME_ONLY = 0x10
+
+CHASSIS_POWER_OFF = 0x00
+CHASSIS_POWER_ON = 0x01
+CHASSIS_POWER_CYCLE = 0x02
+CHASSIS_HARD_RESET = 0x03
+CHASSIS_SOFT_OFF = 0x05
+
+# ipmitool power actions
+POWER_ACTIONS = {
+    'on': CHASSIS_POWER_ON,
+    'off': CHASSIS_POWER_OFF,
+    'cycle': CHASSIS_POWER_CYCLE,
+    'reset': CHASSIS_HARD_RESET,
+    'soft': CHASSIS_SOFT_OFF,
+}
+
+BOOT_PARAM_SET_IN_PROGRESS = 0x00
+BOOT_PARAM_INFO_ACK = 0x04
+BOOT_PARAM_FLAGS = 0x05
+BOOT_FLAGS_VALID = 0x80
+BOOT_FLAGS_PERSISTENT = 0x40
+# boot flags device selector (bits 5:2) of gen-bmc-env bootdev
+BOOTDEV_SELECTOR = {'pxe': 0x01, 'disk': 0x02, 'cdrom': 0x05}
+
+# cipher suite id -> (authentication, integrity, confidentiality)
+CIPHER_SUITES = {
+    0: (0x00, 0x00, 0x00),
+    1: (0x01, 0x00, 0x00),
+    2: (0x01, 0x01, 0x00),
+    3: (0x01, 0x01, 0x01),
+}
+DEFAULT_CIPHER_SUITE = 2
+
+RMCPP_STATUS = {
+    0x01: 'insufficient resources to create a session',
+    0x02: 'invalid session ID',
+    0x03: 'invalid payload type',
+    0x04: 'invalid authentication algorithm',
+    0x05: 'invalid integrity algorithm',
+    0x08: 'inactive session ID',
+    0x09: 'invalid role',
+    0x0a: 'unauthorized role or privilege level requested',
+    0x0c: 'invalid name length',
+    0x0d: 'unauthorized name',
+    0x0f: 'invalid integrity check value',
+    0x10: 'invalid confidentiality algorithm',
+    0x11: 'no cipher suite match',
+    0x12: 'illegal or unrecognized parameter',
+}
+
+DEFAULT_TIMEOUT = 5.0
+RETRY_INTERVAL = 1.0
+# an active request resent this often without answer re-opens the session
+MAX_RESENDS = 2
+# ipmi_sim drops idle sessions, so re-handshake well before that happens
+SESSION_IDLE_TIMEOUT = 20.0
+
+STATE_IDLE = 'idle'
+STATE_OPENING = 'opening'
+STATE_RAKP1 = 'rakp1'
+STATE_RAKP3 = 'rakp3'
+STATE_PRIVILEGE = 'privilege'
+STATE_ACTIVE = 'active'
+
+
+class IPMIError(Exception):
+    pass
+
+
+class IPMITimeout(IPMIError):
+    pass
+
+
+def _to_bytes(s):
+    if s is None:
+        return b''
+    if isinstance(s, bytes):
+        return s
+    return s.encode('utf-8')
+
+
+def _b(data):
+    return bytes(bytearray(data))
+
+
+def _hmac_sha1(key, data):
+    return hmac.new(key, data, hashlib.sha1).digest()
+
+
+def checksum(data):
+    return -sum(bytearray(data)) & 0xff
+
+
+def pack_ipmi_request(netfn, cmd, rq_seq, data=b''):
+    head = struct.pack('BB', BMC_ADDR, netfn << 2)
+    body = struct.pack('BBB', REMOTE_SWID, (rq_seq & 0x3f) << 2, cmd) + _b(data)
+    return head + struct.pack('B', checksum(head)) + body + struct.pack('B', checksum(body))
+
+
+def unpack_ipmi_response(payload):
+    msg = bytearray(payload)
+    if len(msg) < 8:
+        raise IPMIError('Short IPMI message: {} bytes'.format(len(msg)))
+    netfn = msg[1] >> 2
+    rq_seq = msg[4] >> 2
+    cmd = msg[5]
+    code = msg[6]
+    return netfn, rq_seq, cmd, code, _b(msg[7:-1])
+
+
+def pack_asf(msg_type, tag, data=b''):
+    return struct.pack('>BBBBIBBBB', RMCP_VERSION, 0x00, RMCP_NOACK, RMCP_CLASS_ASF,
+                       ASF_IANA, msg_type, tag, 0x00, len(data)) + data
+
+
+def unpack_asf(packet):
+    """(message type, tag, data) of an RMCP ASF packet."""
+    if len(packet) < 12:
+        raise IPMIError('Short ASF packet')
+    version, _, _, rmcp_class, iana, msg_type, tag, _, length = \
+        struct.unpack('>BBBBIBBBB', packet[:12])
+    if version != RMCP_VERSION or rmcp_class != RMCP_CLASS_ASF or iana != ASF_IANA:
+        raise IPMIError('Not an ASF packet')
+    return msg_type, tag, packet[12:12 + length]
+
+
+def pack_asf_pong(tag):
+    return pack_asf(ASF_PONG, tag, struct.pack('>IIBB6x', ASF_IANA, 0, ASF_ENTITIES_IPMI, 0))
+
+
+def pack_rmcpp(payload_type, session_id, seq, payload, k1=None, k2=None):
+    if k2 is not None:
+        payload_type |= PAYLOAD_ENCRYPTED
+        pad = (aes.BLOCK_SIZE - (len(payload) + 1) % aes.BLOCK_SIZE) % aes.BLOCK_SIZE
+        iv = os.urandom(aes.BLOCK_SIZE)
+        payload = iv + aes.cbc_encrypt(k2, iv, payload + _b(range(1, pad + 1)) + struct.pack('B', pad))
+    if k1 is not None:
+        payload_type |= PAYLOAD_AUTHENTICATED
+    body = struct.pack('<BBIIH', AUTHTYPE_RMCPP, payload_type,
+                       session_id, seq, len(payload)) + payload
+    if k1 is not None:
+        pad = (4 - (len(body) + 2) % 4) % 4
+        body += b'\xff' * pad + struct.pack('BB', pad, RMCP_CLASS_IPMI)
+        body += _hmac_sha1(k1, body)[:12]
+    return RMCP_HEADER + body
+
+
+def peek_rmcpp(packet):
+    """Return (payload type, session id, raw payload) without any crypto."""
+    data = bytearray(packet)
+    if len(data) < 16 or data[0] != RMCP_VERSION or \
+            data[3] != RMCP_CLASS_IPMI or data[4] != AUTHTYPE_RMCPP:
+        raise IPMIError('Not an RMCP+ packet')
+    payload_type, session_id, seq, length = struct.unpack('<BIIH', _b(data[5:16]))
+    return payload_type, session_id, seq, _b(data[16:16 + length])
+
+
+def unpack_rmcpp(packet, k1=None, k2=None):
+    payload_type, session_id, seq, payload = peek_rmcpp(packet)
+    authenticated = bool(payload_type & PAYLOAD_AUTHENTICATED)
+    if authenticated and k1 is not None:
+        data = bytearray(packet)
+        expect = _hmac_sha1(k1, _b(data[4:-12]))[:12]
+        if not hmac.compare_digest(expect, _b(data[-12:])):
+            raise IPMIError('Integrity check failed')
+    if payload_type & PAYLOAD_ENCRYPTED:
+        if k2 is None or len(payload) < 2 * aes.BLOCK_SIZE:
+            raise IPMIError('Cannot decrypt payload')
+        plain = bytearray(aes.cbc_decrypt(k2, payload[:aes.BLOCK_SIZE], payload[aes.BLOCK_SIZE:]))
+        payload = _b(plain[:len(plain) - plain[-1] - 1])
+    return payload_type & 0x3f, session_id, seq, payload, authenticated
+
+
+def _parse_power_on(data):
+    return bool(bytearray(data)[0] & 0x01)
+
+
+class IPMIRequest(object):
+
+    def __init__(self, session, netfn, cmd, data=b'', parse=None, timeout=None):
+        self.session = session
+        self.netfn = netfn
+        self.cmd = cmd
+        self.data = _b(data)
+        self.parse = parse
+        self.timeout = timeout
+        self.deadline = None
+        self.started = None
+        self.latency = None
+        self.code = None
+        self.response = None
+        self.error = None
+        self.done = False
+
+    @property
+    def target(self):
+        return '{}:{}'.format(self.session.host, self.session.port)
+
+    def complete(self, code, data, now):
+        self.code = code
+        self.response = data
+        if code != 0:
+            self.error = IPMIError('{}: command 0x{:02x} failed with completion code 0x{:02x}'.format(
+                self.target, self.cmd, code))
+        self._finish(now)
+
+    def fail(self, error, now):
+        self.error = error
+        self._finish(now)
+
+    def _finish(self, now):
+        self.done = True
+        self.latency = now - self.started
+
+    def result(self):
+        if not self.done:
+            raise IPMIError('{}: request was not executed'.format(self.target))
+        if self.error is not None:
+            raise self.error
+        if self.parse is not None:
+            return self.parse(self.response)
+        return self.response
+
+
+class LanplusSession(object):
+
+    def __init__(self, host, port, user, password, console_id,
+                 privilege=PRIV_ADMIN, cipher_suite=DEFAULT_CIPHER_SUITE):
+        if cipher_suite not in CIPHER_SUITES:
+            raise IPMIError('Unsupported cipher suite: {}'.format(cipher_suite))
+        self.host = host
+        self.port = int(port)
+        self.addr = (host, self.port)
+        self.key = (host, self.port, user)
+        self.user = _to_bytes(user)
+        self.password = password
+        self.kuid = _to_bytes(password)[:20].ljust(20, b'\x00')
+        self.console_id = console_id
+        self.privilege = privilege
+        self.auth_alg, self.integrity_alg, self.conf_alg = CIPHER_SUITES[cipher_suite]
+        self.queue = deque()
+        self.reset()
+
+    def reset(self):
+        self.state = STATE_IDLE
+        self.bmc_id = 0
+        self.seq = 0
+        self.rq_seq = 0
+        self.tag = 0
+        self.rm = None
+        self.rc = None
+        self.guid = None
+        self.role = None
+        self.sik = None
+        self.k1 = None
+        self.k2 = None
+        self.last_active = 0
+        self._sent_at = None
+        self._tries = 0
+
+    @property
+    def active(self):
+        return self.state == STATE_ACTIVE
+
+    def _enter(self, state):
+        self.state = state
+        self._sent_at = None
+        self._tries = 0
+        if state in (STATE_OPENING, STATE_RAKP1, STATE_RAKP3):
+            self.tag = (self.tag + 1) & 0xff
+
+    def _fail_all(self, error, now):
+        while self.queue:
+            self.queue.popleft().fail(error, now)
+
+    def _expire(self, now):
+        if not self.queue:
+            return
+        head = self.queue[0]
+        alive = deque()
+        for req in self.queue:
+            if req.deadline <= now:
+                req.fail(IPMITimeout('{}: request timed out in state {}'.format(
+                    req.target, self.state)), now)
+            else:
+                alive.append(req)
+        self.queue = alive
+        if self.state == STATE_ACTIVE and (not alive or alive[0] is not head):
+            # forget the outstanding message so a late answer is ignored
+            self.rq_seq = (self.rq_seq + 1) & 0x3f
+            self._sent_at = None
+            self._tries = 0
+
+    def wake_time(self, retry_interval):
+        times = [req.deadline for req in self.queue]
+        if self._sent_at is not None:
+            times.append(self._sent_at + retry_interval)
+        return min(times) if times else None
+
+    def poll(self, now, retry_interval):
+        """Return the packet to send now for this session, if any."""
+        self._expire(now)
+        if not self.queue:
+            if self.state != STATE_ACTIVE:
+                self.reset()
+            return None
+        if self.state == STATE_ACTIVE and \
+                now - self.last_active > SESSION_IDLE_TIMEOUT:
+            LOG.debug('IPMI session {}:{} idle, reopen'.format(self.host, self.port))
+            self.reset()
+        if self.state == STATE_IDLE:
+            self._enter(STATE_OPENING)
+        if self._sent_at is not None:
+            if now - self._sent_at < retry_interval:
+                return None
+            self._tries += 1
+            if self._tries > MAX_RESENDS and self.state in (STATE_PRIVILEGE, STATE_ACTIVE):
+                LOG.debug('IPMI session {}:{} not answering, reopen'.format(self.host, self.port))
+                self.reset()
+                self._enter(STATE_OPENING)
+        self._sent_at = now
+        return self._step_packet()
+
+    def _step_packet(self):
+        if self.state == STATE_OPENING:
+            return self._open_session_request()
+        if self.state == STATE_RAKP1:
+            return self._rakp1()
+        if self.state == STATE_RAKP3:
+            return self._rakp3()
+        if self.state == STATE_PRIVILEGE:
+            return self.message(NETFN_APP, CMD_SET_SESSION_PRIV, [self.privilege])
+        req = self.queue[0]
+        return self.message(req.netfn, req.cmd, req.data)
+
+    def message(self, netfn, cmd, data=b''):
+        self.seq = (self.seq + 1) & 0xffffffff or 1
+        k1 = self.k1 if self.integrity_alg else None
+        k2 = self.k2 if self.conf_alg else None
+        return pack_rmcpp(PAYLOAD_IPMI, self.bmc_id, self.seq,
+                          pack_ipmi_request(netfn, cmd, self.rq_seq, data), k1, k2)
+
+    def _open_session_request(self):
+        payload = struct.pack('<BBHI', self.tag, 0, 0, self.console_id)
+        for ptype, alg in enumerate((self.auth_alg, self.integrity_alg, self.conf_alg)):
+            payload += struct.pack('<BHBBBH', ptype, 0, 8, alg, 0, 0)
+        return pack_rmcpp(PAYLOAD_OPEN_SESSION_REQ, 0, 0, payload)
+
+    def _rakp1(self):
+        payload = struct.pack('<BBHI', self.tag, 0, 0, self.bmc_id) + self.rm
+        payload += struct.pack('<BHB', self.role, 0, len(self.user)) + self.user
+        return pack_rmcpp(PAYLOAD_RAKP1, 0, 0, payload)
+
+    def _rakp3(self):
+        authcode = b''
+        if self.auth_alg:
+            authcode = _hmac_sha1(self.kuid, self.rc + struct.pack('<IBB', self.console_id, self.role,
+                                                                    len(self.user)) + self.user)
+        payload = struct.pack('<BBHI', self.tag, 0, 0, self.bmc_id) + authcode
+        return pack_rmcpp(PAYLOAD_RAKP3, 0, 0, payload)
+
+    def _check_handshake(self, payload, name):
+        if len(payload) < 8:
+            raise IPMIError('{}:{}: short {} payload'.format(self.host, self.port, name))
+        status = payload[1]
+        if status != 0:
+            raise IPMIError('{}:{}: {} failed: {}'.format(
+                self.host, self.port, name, RMCPP_STATUS.get(status, '0x{:02x}'.format(status))))
+
+    def _on_open_session(self, payload):
+        self._check_handshake(payload, 'open session')
+        if len(payload) < 36:
+            raise IPMIError('{}:{}: short open session response'.format(self.host, self.port))
+        self.bmc_id = struct.unpack('<I', _b(payload[8:12]))[0]
+        self.rm = os.urandom(16)
+        self.role = self.privilege | ROLE_NAME_ONLY
+        self._enter(STATE_RAKP1)
+
+    def _on_rakp2(self, payload):
+        self._check_handshake(payload, 'RAKP 2')
+        self.rc = _b(payload[8:24])
+        self.guid = _b(payload[24:40])
+        namepart = struct.pack('<BB', self.role, len(self.user)) + self.user
+        if self.auth_alg:
+            expect = _hmac_sha1(self.kuid, struct.pack('<II', self.console_id, self.bmc_id) +
+                                self.rm + self.rc + self.guid + namepart)
+            if not hmac.compare_digest(expect, _b(payload[40:60])):
+                raise IPMIError('{}:{}: RAKP 2 authentication failed, wrong password?'.format(
+                    self.host, self.port))
+            self.sik = _hmac_sha1(self.kuid, self.rm + self.rc + namepart)
+            self.k1 = _hmac_sha1(self.sik, b'\x01' * 20)
+            self.k2 = _hmac_sha1(self.sik, b'\x02' * 20)[:16]
+        self._enter(STATE_RAKP3)
+
+    def _on_rakp4(self, payload):
+        self._check_handshake(payload, 'RAKP 4')
+        if self.auth_alg:
+            expect = _hmac_sha1(self.sik, self.rm + struct.pack('<I', self.bmc_id) + self.guid)[:12]
+            if not hmac.compare_digest(expect, _b(payload[8:20])):
+                raise IPMIError('{}:{}: RAKP 4 integrity check failed'.format(self.host, self.port))
+        self._enter(STATE_PRIVILEGE)
+
+    def _on_message(self, payload, now):
+        netfn, rq_seq, cmd, code, data = unpack_ipmi_response(payload)
+        if rq_seq != self.rq_seq:
+            return
+        if self.state == STATE_PRIVILEGE:
+            if cmd != CMD_SET_SESSION_PRIV:
+                return
+            if code != 0:
+                raise IPMIError('{}:{}: set session privilege failed with completion code 0x{:02x}'.format(
+                    self.host, self.port, code))
+        else:
+            req = self.queue[0]
+            if cmd != req.cmd:
+                return
+            self.queue.popleft()
+            req.complete(code, data, now)
+        self.rq_seq = (self.rq_seq + 1) & 0x3f
+        self.last_active = now
+        self._enter(STATE_ACTIVE)
+
+    def handle(self, packet, now):
+        try:
+            k1 = self.k1 if self.integrity_alg else None
+            k2 = self.k2 if self.conf_alg else None
+            ptype, _, _, payload, authenticated = unpack_rmcpp(packet, k1, k2)
+            payload = bytearray(payload)
+            if ptype == PAYLOAD_OPEN_SESSION_RSP and self.state == STATE_OPENING:
+                self._on_open_session(payload)
+            elif ptype == PAYLOAD_RAKP2 and self.state == STATE_RAKP1:
+                self._on_rakp2(payload)
+            elif ptype == PAYLOAD_RAKP4 and self.state == STATE_RAKP3:
+                self._on_rakp4(payload)
+            elif ptype == PAYLOAD_IPMI and self.state in (STATE_PRIVILEGE, STATE_ACTIVE) and self.queue:
+                if self.integrity_alg and not authenticated:
+                    return
+                self._on_message(payload, now)
+        except IPMIError as e:
+            LOG.debug(str(e))
+            self._fail_all(e, now)
+            self.reset()
+
+
+class _Batch(object):
+    """Requests of one execute() call and the BMCs they are talking to."""
+
+    def __init__(self, requests, window):
+        self.pending = deque(requests)
+        self.window = window
+        self.inflight = []
+
+    def admit(self, now, timeout):
+        """Queue the requests the window allows, return their sessions."""
+        self.inflight = [req for req in self.inflight if not req.done]
+        sessions = set(req.session for req in self.inflight)
+        admitted = set()
+        while self.pending and (self.window is None or len(sessions) < self.window or
+                                self.pending[0].session in sessions):
+            req = self.pending.popleft()
+            req.started = now
+            req.deadline = now + (req.timeout or timeout)
+            req.session.queue.append(req)
+            self.inflight.append(req)
+            sessions.add(req.session)
+            admitted.add(req.session)
+        return admitted
+
+    @property
+    def done(self):
+        return not self.pending and all(req.done for req in self.inflight)
+
+
+class LanplusClient(object):
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, retry_interval=RETRY_INTERVAL,
+                 cipher_suite=DEFAULT_CIPHER_SUITE):
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+        self.cipher_suite = cipher_suite
+        self._sock = None
+        self._sessions = {}
+        self._by_id = {}
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._batches = []
+        # sessions with queued requests
+        self._busy = set()
+        self._driving = False
+        # wakes the select() of the driving thread up for a new batch
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        for fd in (self._wakeup_r, self._wakeup_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    def _socket(self):
+        if self._sock is None:
+            self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self._sock.setblocking(False)
+        return self._sock
+
+    def _new_console_id(self):
+        while True:
+            sid = struct.unpack('<I', os.urandom(4))[0]
+            if sid and sid not in self._by_id:
+                return sid
+
+    def session(self, host, port, user, password, privilege=PRIV_ADMIN):
+        key = (host, int(port), user)
+        with self._lock:
+            sess = self._sessions.get(key)
+            if sess is not None and (sess.password != password or sess.privilege != privilege):
+                self._drop(sess)
+                sess = None
+            if sess is None:
+                sess = LanplusSession(host, port, user, password, self._new_console_id(),
+                                      privilege, self.cipher_suite)
+                self._sessions[key] = sess
+                self._by_id[sess.console_id] = sess
+            return sess
+
+    def _drop(self, sess):
+        if sess.active:
+            self._send(sess, sess.message(NETFN_APP, CMD_CLOSE_SESSION, struct.pack('<I', sess.bmc_id)))
+        self._sessions.pop(sess.key, None)
+        self._by_id.pop(sess.console_id, None)
+
+    def request(self, target, netfn, cmd, data=b'', parse=None, timeout=None):
+        """target is a (host, port, user, password) tuple."""
+        host, port, user, password = target
+        return IPMIRequest(self.session(host, port, user, password),
+                           netfn, cmd, data, parse, timeout)
+
+    def _send(self, sess, packet):
+        try:
+            self._socket().sendto(packet, sess.addr)
+        except socket.error as e:
+            sess._fail_all(IPMIError('{}:{}: {}'.format(sess.host, sess.port, e)), time.time())
+            sess.reset()
+
+    def _recv_all(self, now):
+        sock = self._socket()
+        while True:
+            try:
+                packet, _ = sock.recvfrom(4096)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                # ICMP errors of earlier datagrams, nothing to attribute them to
+                continue
+            self._dispatch(packet, now)
+
+    def _dispatch(self, packet, now):
+        try:
+            ptype, sid, _, payload = peek_rmcpp(packet)
+        except IPMIError:
+            return
+        ptype &= 0x3f
+        if ptype in (PAYLOAD_OPEN_SESSION_RSP, PAYLOAD_RAKP2, PAYLOAD_RAKP4):
+            if len(payload) < 8:
+                return
+            sid = struct.unpack('<I', payload[4:8])[0]
+        sess = self._by_id.get(sid)
+        if sess is not None:
+            sess.handle(packet, now)
+
+    def execute(self, requests, window=None):
+        """Run requests concurrently until each is answered or timed out.
+
+        With a window, at most that many BMCs are talked to at once and the
+        next request starts when one of them is done. Timeouts count from
+        the start of each request.
+        """
+        batch = _Batch(requests, window)
+        with self._cond:
+            self._batches.append(batch)
+            self._wake()
+            try:
+                while not batch.done:
+                    if self._driving:
+                        self._cond.wait()
+                        continue
+                    self._driving = True
+                    try:
+                        self._drive(batch)
+                    finally:
+                        self._driving = False
+                        self._cond.notify_all()
+            finally:
+                self._batches.remove(batch)
+        return requests
+
+    def _wake(self):
+        try:
+            os.write(self._wakeup_w, b'x')
+        except OSError:
+            pass
+
+    def _drive(self, batch):
+        """Run the select loop for every batch until batch is done, called
+        with the lock held, it is released while waiting for packets."""
+        sock = self._socket()
+        while True:
+            now = time.time()
+            for other in self._batches:
+                self._busy.update(other.admit(now, self.timeout))
+            wake = None
+            for sess in list(self._busy):
+                packet = sess.poll(now, self.retry_interval)
+                if packet is not None:
+                    self._send(sess, packet)
+                sess_wake = sess.wake_time(self.retry_interval)
+                if sess_wake is None:
+                    self._busy.discard(sess)
+                elif wake is None or sess_wake < wake:
+                    wake = sess_wake
+            # requests of the other batches may have completed or expired
+            self._cond.notify_all()
+            if batch.done:
+                return
+            if wake is None:
+                continue
+            self._lock.release()
+            try:
+                r, _, _ = select.select([sock, self._wakeup_r], [], [],
+                                        max(0, wake - time.time()))
+            finally:
+                self._lock.acquire()
+            if self._wakeup_r in r:
+                try:
+                    os.read(self._wakeup_r, 4096)
+                except OSError:
+                    pass
+            if sock in r:
+                self._recv_all(time.time())
+
+    def power_status(self, targets, timeout=None, window=None):
+        return self.execute([self.request(t, NETFN_CHASSIS, CMD_GET_CHASSIS_STATUS,
+                                          parse=_parse_power_on, timeout=timeout)
+                             for t in targets], window)
+
+    def chassis_control(self, targets, action, timeout=None, window=None):
+        return self.execute([self.request(t, NETFN_CHASSIS, CMD_CHASSIS_CONTROL, [action],
+                                          timeout=timeout)
+                             for t in targets], window)
+
+    def set_bootdev(self, targets, bootdev, persistent=False, timeout=None, window=None):
+        flags = BOOT_FLAGS_VALID | (BOOT_FLAGS_PERSISTENT if persistent else 0)
+        data = [BOOT_PARAM_FLAGS, flags, BOOTDEV_SELECTOR[bootdev] << 2, 0, 0, 0]
+        return self.execute([self.request(t, NETFN_CHASSIS, CMD_SET_BOOT_OPTIONS, data,
+                                          timeout=timeout)
+                             for t in targets], window)
+
+    def close(self):
+        with self._lock:
+            for sess in list(self._sessions.values()):
+                self._drop(sess)
+            if self._sock is not None:
+                self._sock.close()
+                self._sock = None
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = LanplusClient()
+            atexit.register(_client.close)
+        return _client
@@ -1,24 +1,56 @@
 #!/usr/bin/env python
 
 import os
+import re
+import sys
+import time
+import socket
+import getpass
+import threading
+import multiprocessing
 
 from uuid import uuid4
+from contextlib import contextmanager
 from tabulate import tabulate
+from peewee import fn
 from multiprocessing.pool import ThreadPool as Pool
-from multiprocessing import Lock
 
 from virtbmc.models import VirtBMC, QemuVM
-from virtbmc.template import gen_template_content
+import virtbmc.models as models
+from virtbmc.template import render_to_file
 from virtbmc.clrlog import LOG
 import virtbmc.utils as utils
 import virtbmc.config as config
 from virtbmc import procutils
+from virtbmc import ipmi
+from virtbmc import bmcserver
+from virtbmc import ports
+from virtbmc import qmp
+from virtbmc import imagecache
+from virtbmc import netdev
+from virtbmc import health
+from virtbmc import profiles
+from virtbmc import warm
+from virtbmc import state
+from virtbmc import admission
+from virtbmc import supervisor
+from virtbmc import metrics
+from virtbmc import trace
+from virtbmc import audit
 
 
 RUNNING_STATUS = 'running'
 STOP_STATUS = 'stop'
 ERROR_STATUS = 'error'
 
+MAX_WORKERS = 32
+
+# BMCs a bulk power or bootdev command talks to at once
+IPMI_WINDOW = 256
+
+# seconds start --vm waits for new ipmi_sim BMCs to answer presence pings
+BMC_READY_TIMEOUT = 10
+
 
 class QemuBMCUnit(object):
 
@@ -46,11 +78,16 @@ class QemuBMCUnit(object):
         self.path_prefix = '{}/{}--{}'.format(workspace, self.uuid, self.number)
         self.lan_config_program = '{}/ipmi_sim_lancontrol'.format(self.path_prefix)
         self.chassis_control_program = '{}/ipmi_sim_chassiscontrol'.format(self.path_prefix)
+        self.chassis_client_program = '{}/ipmi_sim_chassisclient'.format(self.path_prefix)
+        self.chassis_socket = bmcserver.CHASSIS_SOCKET
         self.ipmi_sim = ipmi_sim
         self.ipmi_config_file = '{}/lan.conf'.format(self.path_prefix)
         self.bmc_env_file = '{}/gen-bmc-env'.format(self.path_prefix)
         self.status_file = '{}/vbmc_qemu.status'.format(self.path_prefix)
+        self.state_helper = '{}/vbmc-state'.format(self.path_prefix)
         self.ipmi_op_record_file = '{}/operate.record'.format(self.path_prefix)
+        self.audit_file = '{}/{}'.format(self.path_prefix, audit.AUDIT_FILE)
+        self.bmc_log = '{}/ipmi_sim.log'.format(self.path_prefix)
         self.ipmiusr = ipmiusr or 'root'
         self.ipmipass = ipmipass or 'test'
 
@@ -62,82 +99,135 @@ class QemuBMCUnit(object):
         self.ifup_script = '{}/qemu-ifup'.format(self.path_prefix)
         self.ifdown_script = '{}/qemu-ifdown'.format(self.path_prefix)
         self.qemu_pidfile = '{}/qemu.pid'.format(self.path_prefix)
+        self.qmp_socket = '{}/qmp.sock'.format(self.path_prefix)
+        self.warm_file = '{}/warm.cmd'.format(self.path_prefix)
+        self.python_bin = sys.executable
+        self.vbmc_base_dir = config.BASE_DIR
         self.controller_script = '{}/controller'.format(self.path_prefix)
         self.ifmac = kwargs.get('ifmac') or utils.random_mac()
         self.vncport = vncport
         self.bridge = bridge
+        self.bmc_backend = kwargs.get('bmc_backend') or bmcserver.BACKEND_IPMI_SIM
+        self.base_image = kwargs.get('base_image') or ''
+        self.tap = kwargs.get('tap') or ''
+        self.hw_profile = kwargs.get('hw_profile') or profiles.DEFAULT_PROFILE
+
+    def template_vars(self):
+        return dict(self.__dict__, **profiles.template_vars(self.hw_profile, self.disk))
+
+    def _create_template_content(self, temfile, outfile, executable=False):
+        utils.mkdir_of_file(outfile)
+        return render_to_file(temfile, outfile, self.template_vars(), executable)
 
-    def _create_template_content(self, temfile, outfile):
-        gen_template_content(temfile, outfile, self.__dict__)
+    def gen_state_helper(self, temfile):
+        return self._create_template_content(temfile, self.state_helper, True)
 
     def gen_bmc_env(self, temfile):
-        utils.mkdir_of_file(self.bmc_env_file)
-        self._create_template_content(temfile, self.bmc_env_file)
-        utils.make_executable(self.bmc_env_file)
+        return self._create_template_content(temfile, self.bmc_env_file, True)
 
     def gen_qemu_ifup(self, temfile):
-        utils.mkdir_of_file(self.ifup_script)
-        self._create_template_content(temfile, self.ifup_script)
-        utils.make_executable(self.ifup_script)
+        return self._create_template_content(temfile, self.ifup_script, True)
 
     def gen_qemu_ifdown(self, temfile):
-        utils.mkdir_of_file(self.ifdown_script)
-        self._create_template_content(temfile, self.ifdown_script)
-        utils.make_executable(self.ifdown_script)
+        return self._create_template_content(temfile, self.ifdown_script, True)
 
     def gen_ipmi_sim_chassiscontrol(self, temfile):
-        utils.mkdir_of_file(self.chassis_control_program)
-        self._create_template_content(temfile, self.chassis_control_program)
-        utils.make_executable(self.chassis_control_program)
+        return self._create_template_content(temfile, self.chassis_control_program, True)
+
+    def gen_ipmi_sim_chassisclient(self, temfile):
+        return self._create_template_content(temfile, self.chassis_client_program, True)
 
     def gen_ipmi_lancontrol(self, temfile):
-        utils.mkdir_of_file(self.lan_config_program)
-        self._create_template_content(temfile, self.lan_config_program)
-        utils.make_executable(self.lan_config_program)
+        return self._create_template_content(temfile, self.lan_config_program, True)
 
     def gen_ipmi_config(self, temfile):
-        utils.mkdir_of_file(self.ipmi_config_file)
-        self._create_template_content(temfile, self.ipmi_config_file)
+        return self._create_template_content(temfile, self.ipmi_config_file)
 
-    def gen_controller_script(self, temfile, tmux_cmd):
-        utils.mkdir_of_file(self.controller_script)
-        self._create_template_content(temfile, self.controller_script)
-        utils.make_executable(self.controller_script)
-        utils.cpto(tmux_cmd, self.path_prefix)
+    def gen_controller_script(self, temfile):
+        return self._create_template_content(temfile, self.controller_script, True)
 
     def gen_all_scripts(self, temdir):
-        self.gen_bmc_env('{}/{}'.format(temdir, 'gen-bmc-env.tem'))
-        self.gen_qemu_ifup('{}/{}'.format(temdir, 'qemu-ifup.tem'))
-        self.gen_qemu_ifdown('{}/{}'.format(temdir, 'qemu-ifdown.tem'))
-        self.gen_ipmi_sim_chassiscontrol('{}/{}'.format(temdir, 'ipmi_sim_chassiscontrol.tem'))
-        self.gen_ipmi_lancontrol('{}/{}'.format(temdir, 'ipmi_sim_lancontrol.tem'))
-        self.gen_ipmi_config('{}/{}'.format(temdir, 'lan.conf.tem'))
-        self.gen_controller_script('{}/{}'.format(temdir, 'controller.tem'),
-                              '{}/{}'.format(temdir, 'tmux-cmd'))
+        """Render the node scripts, return how many files were rewritten."""
+        return sum([
+            self.gen_state_helper('{}/{}'.format(temdir, 'vbmc-state.tem')),
+            self.gen_bmc_env('{}/{}'.format(temdir, 'gen-bmc-env.tem')),
+            self.gen_qemu_ifup('{}/{}'.format(temdir, 'qemu-ifup.tem')),
+            self.gen_qemu_ifdown('{}/{}'.format(temdir, 'qemu-ifdown.tem')),
+            self.gen_ipmi_sim_chassiscontrol('{}/{}'.format(temdir, 'ipmi_sim_chassiscontrol.tem')),
+            self.gen_ipmi_sim_chassisclient('{}/{}'.format(temdir, 'ipmi_sim_chassisclient.tem')),
+            self.gen_ipmi_lancontrol('{}/{}'.format(temdir, 'ipmi_sim_lancontrol.tem')),
+            self.gen_ipmi_config('{}/{}'.format(temdir, 'lan.conf.tem')),
+            self.gen_controller_script('{}/{}'.format(temdir, 'controller.tem')),
+        ])
 
     def create_qemu_image(self):
+        if self.base_image:
+            imagecache.create_overlay(self.base_image, self.disk, self.image_size)
+            return
         utils.mkdir_of_file(self.disk)
         cmd = ['qemu-img', 'create', '-f', 'qcow2', self.disk, self.image_size]
         utils.run_cmd(cmd)
 
     def run_bmc(self):
-        if not self.is_bmc_running():
-            cmd = [self.controller_script, 'start', self.ipmiusr, self.ipmipass]
-            utils.run_cmd(cmd)
-            LOG.info('Start BMC: {} DONE.'.format(self.bmcname))
-        else:
-            LOG.warning('BMC: {} already started.'.format(self.qemuname))
+        with metrics.timed('start_bmc', self.number):
+            if self.bmc_backend == bmcserver.BACKEND_BUILTIN:
+                bmcserver.ensure_engine()
+                errors = bmcserver.engine_request('start', uuids=[self.uuid])['errors']
+                if errors:
+                    raise Exception('Start BMC {} error: {}'.format(self.bmcname, errors[self.uuid]))
+                LOG.info('Start BMC: {} DONE.'.format(self.bmcname))
+            else:
+                self.stop_legacy_bmc()
+                ensure_chassis_controller()
+                errors = supervisor.start_programs([self.bmc_program()])
+                if errors:
+                    raise Exception('Start BMC {} error: {}'.format(self.bmcname, errors[self.uuid]))
+                LOG.info('Start BMC: {} DONE.'.format(self.bmcname))
+
+    def bmc_program(self):
+        return {'name': self.uuid, 'cwd': self.path_prefix, 'log': self.bmc_log,
+                'argv': [self.ipmi_sim, '-c', self.ipmi_config_file, '-n']}
+
+    def stop_legacy_bmc(self):
+        # nodes started before the supervisor run ipmi_sim in a tmux session
+        tmux_cmd = os.path.join(self.path_prefix, 'tmux-cmd')
+        if os.path.exists(tmux_cmd):
+            procutils.check_call_no_exception([tmux_cmd, self.tmux_name, 'stop'])
+            utils.rmfile(tmux_cmd)
+
+    def ipmi_target(self):
+        return (self.listen_addr, self.ipmi_port, self.ipmiusr, self.ipmipass)
+
+    def bmc_addr(self):
+        return (self.listen_addr, self.ipmi_port)
+
+    def audit(self, op, **detail):
+        audit.record(self.audit_file, self.uuid, self.number, op, 'cli', getpass.getuser(),
+                     **detail)
+
+    def is_supervised(self):
+        # builtin and tmux started BMCs are only seen through their LAN channel
+        return self.bmc_backend != bmcserver.BACKEND_BUILTIN and \
+            not os.path.exists(os.path.join(self.path_prefix, 'tmux-cmd'))
+
+    def chassis_control(self, action):
+        ipmi.get_client().chassis_control([self.ipmi_target()], action)[0].result()
 
     def run_vm(self):
-        try:
-            if not self.is_vm_running():
-                cmd = [self.controller_script, 'startvm', self.ipmiusr, self.ipmipass]
-                utils.run_cmd(cmd)
-                LOG.info('Starting VM: {} DONE.'.format(self.qemuname))
-            else:
-                LOG.warning('VM: {} already started.'.format(self.qemuname))
-        except Exception as e:
-            LOG.error("Run VM error: {}".format(e))
+        with metrics.timed('power_on', self.number) as span:
+            try:
+                if not self.is_vm_running():
+                    self.chassis_control(ipmi.CHASSIS_POWER_ON)
+                    LOG.info('Starting VM: {} DONE.'.format(self.qemuname))
+                    return 'powered on'
+                else:
+                    LOG.warning('VM: {} already started.'.format(self.qemuname))
+                    span['result'] = 'noop'
+                    return 'already on'
+            except Exception as e:
+                LOG.error("Run VM error: {}".format(e))
+                span['result'] = 'error'
+                return ERROR_STATUS
 
     def kill_qemu_by_pid(self):
         with open(self.qemu_pidfile, 'r') as f:
@@ -145,46 +235,45 @@ class QemuBMCUnit(object):
             procutils.check_call_no_exception(['kill', '-9', pid])
 
     def get_vm_status_byfile(self):
-        import re
-        info = {}
-        if not os.path.exists(self.status_file):
-            info['power'] = 'off'
-            info['bootdev'] = 'default'
-            return info
-        with open(self.status_file) as f:
-            for line in f.readlines():
-                power_m = re.search(r'^power: (.*)', line.strip())
-                bootdev_m = re.search(r'^bootdev: (.*)', line.strip())
-                if power_m:
-                    info['power'] = power_m.group(1)
-                if bootdev_m:
-                    info['bootdev'] = bootdev_m.group(1)
-        return info
-
-    def get_vm_status(self):
-        if not os.path.exists(self.status_file):
-            status = STOP_STATUS
-        else:
-            if self.get_vm_status_byfile().get('power', 'off') == 'off':
-                status = STOP_STATUS
-            else:
-                cmd = 'ipmitool -I lanplus -U {} -P {} -H {} -p {} chassis power status'.format(self.ipmiusr, self.ipmipass,
-                                                                                                self.listen_addr, self.ipmi_port).split()
-                try:
-                    output = utils.run_cmd(cmd)
-                    if 'Power is on' in ''.join(output):
-                        status = RUNNING_STATUS
-                    else:
-                        status = STOP_STATUS
-                except:
-                    status = ERROR_STATUS
-        return status
-
-    def get_bmc_status(self):
-        if utils.is_port_open(self.ipmi_port):
-            return RUNNING_STATUS
-        else:
+        return state.read_state(self.status_file)
+
+    def has_qmp(self):
+        return os.path.exists(self.qmp_socket)
+
+    def get_qmp_status(self):
+        status = qmp.query_status(self.qmp_socket)
+        if status is None:
             return STOP_STATUS
+        if status.get('status') in qmp.ERROR_STATES:
+            return ERROR_STATUS
+        return RUNNING_STATUS if status.get('running') else STOP_STATUS
+
+    def set_power_off(self):
+        utils.run_cmd([self.bmc_env_file, '-p', 'off', '-c', self.qemu_pidfile, self.status_file])
+
+    def refresh_state(self):
+        # rebuild the qemu command of the state file, keeping power and boot device
+        utils.run_cmd([self.bmc_env_file, '-c', self.qemu_pidfile, self.status_file])
+
+    def need_power_query(self, info=None):
+        info = info or self.get_vm_status_byfile()
+        return info['power'] != 'off'
+
+    def get_vm_status(self, power_status=None, info=None):
+        if not self.need_power_query(info):
+            return STOP_STATUS
+        if power_status is None:
+            power_status = query_power_status([self])[0]
+        return power_status
+
+    def get_bmc_status(self, program=None, alive=None):
+        if not self.is_supervised():
+            if alive is None:
+                alive = health.get_cache().alive([self.bmc_addr()])[self.bmc_addr()]
+            return RUNNING_STATUS if alive else STOP_STATUS
+        if program is None:
+            program = supervisor.program_status([self.uuid]).get(self.uuid, {})
+        return program_state(program)
 
     def is_vm_running(self):
             if self.get_vm_status() == RUNNING_STATUS:
@@ -198,87 +287,104 @@ class QemuBMCUnit(object):
         else:
             return False
 
-    def stop_vm(self):
-        if self.is_vm_running():
-            cmd = [self.controller_script, 'stopvm', self.ipmiusr, self.ipmipass]
-            utils.run_cmd(cmd)
-            LOG.info('Stop VM: {} DONE.'.format(self.qemuname))
-        if os.path.exists(self.qemu_pidfile):
-            if self.get_vm_status() == ERROR_STATUS or procutils.check_pid_alive(self.qemu_pidfile, 'qemu'):
-                self.kill_qemu_by_pid()
-                LOG.warning("VM: {} be killed".format(self.qemuname))
-        else:
-            LOG.warning('VM: {} already stopped.'.format(self.qemuname))
-
-    def stop_bmc(self):
-        if self.is_bmc_running:
-            cmd = [self.controller_script, 'stop', self.ipmiusr, self.ipmipass]
-            utils.run_cmd(cmd)
-            LOG.info('Stop BMC: {} DONE.'.format(self.qemuname))
-        else:
-            LOG.warning('BMC: {} already stopped.'.format(self.qemuname))
+    def stop_vm(self, timeout=qmp.POWERDOWN_TIMEOUT):
+        with metrics.timed('power_off', self.number):
+            if self.has_qmp():
+                if qmp.query_status(self.qmp_socket) is None:
+                    pass
+                elif not self.need_power_query():
+                    # warm standby of a powered off node
+                    qmp.quit_vm(self.qmp_socket)
+                else:
+                    # qmp bypasses the BMC, which audits the chassis power off below
+                    self.audit('power_off')
+                    if qmp.powerdown(self.qmp_socket, timeout):
+                        LOG.info('Stop VM: {} DONE.'.format(self.qemuname))
+                self.set_power_off()
+            elif self.is_vm_running():
+                self.chassis_control(ipmi.CHASSIS_POWER_OFF)
+                self.set_power_off()
+                LOG.info('Stop VM: {} DONE.'.format(self.qemuname))
+            if os.path.exists(self.qemu_pidfile):
+                if self.get_vm_status() == ERROR_STATUS or procutils.check_pid_alive(self.qemu_pidfile, 'qemu'):
+                    self.kill_qemu_by_pid()
+                    self.set_power_off()
+                    LOG.warning("VM: {} be killed".format(self.qemuname))
+            else:
+                LOG.warning('VM: {} already stopped.'.format(self.qemuname))
 
 
     def save_todb(self):
         qemuvm = QemuVM(**self.__dict__)
         vbmc = VirtBMC(vm=qemuvm, **self.__dict__)
-        qemuvm.save()
-        vbmc.save()
+        with models.DB.atomic():
+            qemuvm.save()
+            vbmc.save()
 
     def cleanup(self):
-        self.stop_vm()
-        self.stop_bmc()
-        utils.rmdirs(self.path_prefix)
+        with metrics.timed('delete', self.number):
+            utils.rmdirs(self.path_prefix)
 
 
-    list_headers = ['Order', 'UUID', 'TmuxSession',
+    list_headers = ['Order', 'UUID', 'BMCPid',
                     'ListenIp', 'IPMIPort', 'VncPort', 'VmMAC',
                     'IPMIUser', 'IPMIPassword', 'BMCStatus',
                     'VMStatus', 'BootDev']
 
-    def get_list_field(self):
+    def get_list_field(self, vm_status=None, info=None, program=None, alive=None):
+        info = info or self.get_vm_status_byfile()
+        if program is None and self.bmc_backend != bmcserver.BACKEND_BUILTIN:
+            program = supervisor.program_status([self.uuid]).get(self.uuid, {})
         return [
             self.number,
             self.uuid,
-            self.tmux_name,
+            (program or {}).get('pid') or '-',
             self.listen_addr,
             self.ipmi_port,
             5900+self.vncport,
             self.ifmac,
             self.ipmiusr,
             self.ipmipass,
-            self.get_bmc_status(),
-            self.get_vm_status(),
-            self.get_vm_status_byfile()['bootdev'],
+            self.get_bmc_status(program, alive),
+            vm_status or self.get_vm_status(info=info),
+            info['bootdev'],
         ]
 
 
-BMC_FREE_PORT = utils.get_free_port(9000, 9500)
-VNC_FREE_PORT = utils.get_free_port(5900, 6000)
+def program_state(program):
+    """BMC status of a supervisor program status, the exit code unless running."""
+    if not program:
+        return STOP_STATUS
+    if program['state'] == supervisor.RUNNING:
+        return RUNNING_STATUS
+    return '{}({})'.format(program['state'], program['exit_code'])
 
 
-def gen_config(args, num):
-    global BMC_FREE_PORT
-    global VNC_FREE_PORT
-    db_items = VirtBMC.select().order_by(VirtBMC.number)
-    if len(db_items) != 0:
-        used_bmc_port = [item.ipmi_port for item in db_items]
-        used_bmc_port += [item.ipmi_port for item in db_items]
-        used_bmc_port += [item.telnet_port for item in db_items]
-        used_vnc_port = [5900+item.vm.vncport for item in db_items]
+def query_power_status(units):
+    res = {}
+    # QMP answers from the VM itself, IPMI only for VMs started without it
+    ipmi_units = []
+    for unit in units:
+        if unit.has_qmp():
+            res[unit.uuid] = unit.get_qmp_status()
+        else:
+            ipmi_units.append(unit)
+    reqs = ipmi.get_client().power_status([unit.ipmi_target() for unit in ipmi_units])
+    for unit, req in zip(ipmi_units, reqs):
+        try:
+            res[unit.uuid] = RUNNING_STATUS if req.result() else STOP_STATUS
+        except ipmi.IPMIError as e:
+            LOG.warning('Query power status of {} error: {}'.format(unit.qemuname, e))
+            res[unit.uuid] = ERROR_STATUS
+    return [res[unit.uuid] for unit in units]
+
 
-        BMC_FREE_PORT = list(set(BMC_FREE_PORT)-set(used_bmc_port))
-        VNC_FREE_PORT = list(set(VNC_FREE_PORT)-set(used_vnc_port))
+def gen_config(args, num, node_ports, listen_addr=None):
     res = {}
     res['number'] = num
     res['ipmi_sim'] = args.ipmi_sim
-    res['listen_addr'] = utils.get_netiface_ip(args.bridge)
-    ipmi_udp_port = BMC_FREE_PORT.pop(0)
-    serial_tcp_port = ipmi_udp_port
-    res['ipmi_port'] = ipmi_udp_port
-    res['serial_port'] = serial_tcp_port
-    res['telnet_port'] = BMC_FREE_PORT.pop(0)
-    res['vncport'] = VNC_FREE_PORT.pop(0) - 5900
+    res['listen_addr'] = listen_addr or utils.get_netiface_ip(args.bridge)
+    res.update(node_ports)
     res['qemu_program'] = args.qemu
     res['memory'] = args.memory
     res['ncpu'] = args.ncpu
@@ -287,6 +393,8 @@ def gen_config(args, num):
     res['image_size'] = args.image_size
     res['ipmiusr'] = args.ipmi_user
     res['ipmipass'] = args.ipmi_password
+    res['bmc_backend'] = args.bmc_backend
+    res['hw_profile'] = args.hw_profile
 
     return res
 
@@ -300,44 +408,228 @@ def get_QemuBMC_unit(_uuid, **kwargs):
     if kwargs.get('ipmi_password', False) and vbmc.ipmipass != kwargs['ipmi_password']:
         vbmc.ipmipass = kwargs['ipmi_password']
         vbmc.save()
+    return unit_from_rows(vbmc, vm), vbmc, vm
+
+
+def unit_from_rows(vbmc, vm):
     res = vbmc.__dict__['_data'].copy()
     res.update(vm.__dict__['_data'])
     res['workspace'] = config.WORKSPACE
-    return QemuBMCUnit(**res), vbmc, vm
-
-
-def process_map(func, lst):
+    return QemuBMCUnit(**res)
+
+
+NUMBER_RANGE = re.compile(r'^(\d+)(?:-(\d+))?$')
+
+
+def select_numbers(ids):
+    """ids with the node numbers and ranges like 0-99 among them replaced by uuids."""
+    res = []
+    for _id in ids:
+        match = NUMBER_RANGE.match(_id)
+        if match is None:
+            res.append(_id)
+            continue
+        first = int(match.group(1))
+        last = int(match.group(2) or first)
+        uuids = [vbmc.uuid for vbmc in VirtBMC.select(VirtBMC.uuid).where(
+            VirtBMC.number.between(first, last)).order_by(VirtBMC.number)]
+        # an empty range is reported as unknown
+        res.extend(uuids or [_id])
+    seen = set()
+    return [_id for _id in res if not (_id in seen or seen.add(_id))]
+
+
+def load_units(ids, strict=True):
+    """Units of ids (or all of them ordered by number) from one joined query.
+
+    ids are uuids, node numbers or number ranges like 0-99. Unknown ids
+    raise unless strict is False.
+    """
+    query = VirtBMC.select(VirtBMC, QemuVM).join(QemuVM).order_by(VirtBMC.number)
+    if ids is None or ids[:1] == ['all']:
+        return [unit_from_rows(vbmc, vbmc.vm) for vbmc in query]
+    ids = select_numbers(ids)
+    found = {}
+    for chunk in models.chunks(ids):
+        for vbmc in query.clone().where(VirtBMC.uuid << chunk):
+            found[vbmc.uuid] = unit_from_rows(vbmc, vbmc.vm)
+    missing = [_uuid for _uuid in ids if _uuid not in found]
+    if missing and strict:
+        raise Exception('Unknown BMC: {}'.format(', '.join(missing)))
+    return [found[_uuid] for _uuid in ids if _uuid in found]
+
+
+def process_map(func, lst, workers=MAX_WORKERS):
     if len(lst) == 0:
         LOG.info("Empty list..., skip")
         return
-    pool = Pool(processes=len(lst))
-    return pool.map(func, lst)
+    pool = Pool(processes=min(len(lst), workers))
+    try:
+        with trace.span(func.__name__.strip('_'), trace.PHASE, items=len(lst)):
+            return pool.map(func, lst)
+    finally:
+        pool.close()
+
+
+class StageStats(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.busy = 0.0
+        self.started = None
+        self.finished = None
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def track(self, count=1):
+        started = time.time()
+        yield
+        finished = time.time()
+        with trace.locked(self._lock, 'stage stats'):
+            self.count += count
+            self.busy += finished - started
+            self.started = min(self.started or started, started)
+            self.finished = max(self.finished or finished, finished)
+
+    headers = ['Stage', 'Nodes', 'Wall(s)', 'Busy(s)', 'Nodes/s']
+
+    def row(self):
+        wall = max(self.finished - self.started, 1e-6) if self.count else 0
+        rate = self.count / wall if self.count else 0
+        return [self.name, self.count, '{:.2f}'.format(wall),
+                '{:.2f}'.format(self.busy), '{:.1f}'.format(rate)]
+
+
+def free_numbers(count):
+    used = set(item.number for item in VirtBMC.select(VirtBMC.number))
+    res = []
+    num = 0
+    while len(res) < count:
+        if num not in used:
+            res.append(num)
+        num += 1
+    return res
 
 
-def create(args):
+def unique_macs(count):
+    used = set(item.ifmac for item in QemuVM.select(QemuVM.ifmac))
+    res = []
+    while len(res) < count:
+        mac = utils.random_mac()
+        if mac not in used:
+            used.add(mac)
+            res.append(mac)
+    return res
 
-    def BMC_min_num():
-        db_items = VirtBMC.select().order_by(VirtBMC.number)
-        if len(db_items) == 0:
-            return 0
-        num_lst = [item.number for item in db_items]
-        min_con_range = list(utils.ranges(num_lst))[0]
-        if min_con_range[0] != 0:
-            return 0
-        else:
-            return min_con_range[-1] + 1
 
-    def _create(args, lock):
-        with lock:
-            res = gen_config(args, BMC_min_num())
-            unit = QemuBMCUnit(**res)
-            unit.save_todb()
-        LOG.info(unit.__dict__)
-        unit.gen_all_scripts(args.template)
-        unit.create_qemu_image()
+def unique_uuids(count, tap=False):
+    """count new node uuids, whose TAP names no node or host link has with tap."""
+    used = set(item.tap for item in QemuVM.select(QemuVM.tap).where(QemuVM.tap != '')) \
+        if tap else set()
+    res = []
+    while len(res) < count:
+        _uuid = str(uuid4())
+        if tap:
+            name = netdev.tap_name(_uuid)
+            if name in used or netdev.link_index(name) is not None:
+                continue
+            used.add(name)
+        res.append(_uuid)
+    return res
+
+
+def save_units(units):
+    models.bulk_insert(QemuVM, [models.model_row(QemuVM, unit.__dict__) for unit in units])
+    vm_ids = {}
+    for chunk in models.chunks([unit.uuid for unit in units]):
+        query = QemuVM.select(QemuVM.id, QemuVM.uuid).where(QemuVM.uuid << chunk)
+        vm_ids.update((vm.uuid, vm.id) for vm in query)
+    rows = []
+    for unit in units:
+        row = models.model_row(VirtBMC, unit.__dict__)
+        row['vm'] = vm_ids[unit.uuid]
+        rows.append(row)
+    models.bulk_insert(VirtBMC, rows)
+
+
+def allocate_units(args, count, base=None):
+    """Numbers, ports, MACs and UUIDs of count new nodes in one transaction."""
+    listen_addr = utils.get_netiface_ip(args.bridge)
+    with models.DB.atomic():
+        if base is not None:
+            imagecache.acquire(base, count)
+        uuids = unique_uuids(count, args.tap)
+        node_ports = ports.reserve_nodes(uuids)
+        units = []
+        for num, _uuid, node_port, mac in zip(free_numbers(count), uuids,
+                                              node_ports, unique_macs(count)):
+            res = gen_config(args, num, node_port, listen_addr)
+            if args.tap:
+                res['tap'] = netdev.tap_name(_uuid)
+            if base is not None:
+                res['base_image'] = base.path
+                res['image_size'] = imagecache.overlay_size(base, args.image_size)
+            units.append(QemuBMCUnit(uuid=_uuid, ifmac=mac, **res))
+        save_units(units)
+    return units
+
+
+def create(args):
+    if args.number <= 0:
+        LOG.info("Nothing to create, skip")
+        return
+
+    allocate_stats = StageStats('allocate')
+    render_stats = StageStats('render')
+    image_stats = StageStats('image')
 
-    lock = Lock()
-    process_map(lambda _: _create(args, lock), range(0, args.number))
+    def _build(unit):
+        try:
+            with render_stats.track(), metrics.timed('render', unit.number):
+                unit.gen_all_scripts(args.template)
+            with image_stats.track(), metrics.timed('create_image', unit.number):
+                unit.create_qemu_image()
+            unit.audit('create', hw_profile=unit.hw_profile)
+        except Exception as e:
+            LOG.error('Create {} error: {}'.format(unit.qemuname, e))
+            return unit.uuid
+
+    base = imagecache.add(args.base_image) if args.base_image else None
+    with allocate_stats.track(args.number), trace.span('allocate', trace.PHASE):
+        units = allocate_units(args, args.number, base)
+    failed = [_uuid for _uuid in process_map(_build, units, args.workers) if _uuid]
+    failed += [_uuid for _uuid in provision_taps(units) if _uuid not in failed]
+    print(tabulate([stats.row() for stats in [allocate_stats, render_stats, image_stats]],
+                   StageStats.headers, tablefmt="psql"))
+    if failed:
+        raise Exception('{} of {} nodes failed to build: {}'.format(
+            len(failed), len(units), ', '.join(failed)))
+
+
+def regen(args):
+    stats = StageStats('regen')
+
+    def _regen(unit_item):
+        with stats.track(), metrics.timed('regen', unit_item.number):
+            written = unit_item.gen_all_scripts(args.template)
+            if args.hw_profile and os.path.exists(unit_item.status_file):
+                unit_item.refresh_state()
+            if args.hw_profile:
+                unit_item.audit('regen', hw_profile=args.hw_profile)
+            return written
+
+    units = load_units(args.id)
+    if args.hw_profile:
+        with models.DB.atomic():
+            for chunk in models.chunks([unit.uuid for unit in units]):
+                QemuVM.update(hw_profile=args.hw_profile).where(QemuVM.uuid << chunk).execute()
+        for unit in units:
+            unit.hw_profile = args.hw_profile
+    written = process_map(_regen, units, args.workers) or []
+    print(tabulate([[len(written), len([n for n in written if n]), sum(written)] + stats.row()[2:]],
+                   ['Nodes', 'ChangedNodes', 'WrittenFiles'] + StageStats.headers[2:],
+                   tablefmt="psql"))
 
 
 def extract_ipmi_user_passwd(args):
@@ -350,15 +642,22 @@ def extract_ipmi_user_passwd(args):
 
 
 def list_all(args):
-    uuids = [bmc.uuid for bmc in VirtBMC.select().order_by(VirtBMC.number)]
-    print_table(uuids, args.json)
-
-def print_table(ids, json_output):
-    data_series = []
-
-    for _uuid in ids:
-        unit_item, _, _ = get_QemuBMC_unit(_uuid)
-        data_series.append(unit_item.get_list_field())
+    print_table(None, args.json, args.max_age)
+
+def print_table(ids, json_output, max_age=None):
+    units = load_units(ids)
+    states = state.read_states([unit.status_file for unit in units])
+    query_units = [unit for unit in units if unit.need_power_query(states[unit.status_file])]
+    programs = supervisor.program_status([unit.uuid for unit in units])
+    alive = health.get_cache().alive(
+        [unit.bmc_addr() for unit in units if not unit.is_supervised()], max_age)
+    vm_status = dict(zip([unit.uuid for unit in query_units],
+                         query_power_status(query_units)))
+    data_series = [unit.get_list_field(vm_status.get(unit.uuid, STOP_STATUS),
+                                       states[unit.status_file],
+                                       programs.get(unit.uuid, {}),
+                                       alive.get(unit.bmc_addr()))
+                   for unit in units]
 
     if json_output:
         import json
@@ -371,59 +670,344 @@ def print_table(ids, json_output):
 
 
 def update(args):
-
-    def _update(uuid):
-        kwargs = extract_ipmi_user_passwd(args)
-        unit_item, _, _ = get_QemuBMC_unit(uuid, **kwargs)
-
-    if args.id[0] == 'all':
-        update_list = [item.uuid for item in VirtBMC.select()]
-    else:
-        update_list = args.id
-
-    process_map(_update, update_list)
+    kwargs = extract_ipmi_user_passwd(args)
+    fields = {}
+    if 'ipmi_user' in kwargs:
+        fields['ipmiusr'] = kwargs['ipmi_user']
+    if 'ipmi_password' in kwargs:
+        fields['ipmipass'] = kwargs['ipmi_password']
+
+    update_list = [unit.uuid for unit in load_units(args.id)]
+    if fields:
+        with models.DB.atomic():
+            for chunk in models.chunks(update_list):
+                VirtBMC.update(**fields).where(VirtBMC.uuid << chunk).execute()
     print_table(update_list, args.json)
 
 
 def delete(args):
-    def _delete(uuid):
-        unit_item, bmc, vm = get_QemuBMC_unit(uuid)
-        unit_item.cleanup()
-        vm.delete_instance()
-        bmc.delete_instance()
-
-    if args.id[0] == 'all':
-        delete_list = [item.uuid for item in VirtBMC.select()]
-    else:
-        delete_list = args.id
-
-    process_map(_delete, delete_list)
+    def _delete(unit_item):
+        try:
+            unit_item.stop_vm()
+        except Exception as e:
+            LOG.error('Delete {} error: {}'.format(unit_item.qemuname, e))
+            return unit_item.uuid
+
+    units = load_units(args.id)
+    failed = set(process_map(_delete, units) or []) - set([None])
+    units = [unit for unit in units if unit.uuid not in failed]
+    stop_bmcs(units)
+    for unit in units:
+        unit.audit('delete')
+    # the logs go with the workspaces, their records stay in the index
+    audit.ingest([(unit.uuid, unit.audit_file) for unit in units])
+    for unit in units:
+        unit.cleanup()
+    for error in netdev.remove_taps([unit.tap for unit in units if unit.tap]).values():
+        LOG.error(error)
+    uuids = [unit.uuid for unit in units]
+    with models.DB.atomic():
+        for chunk in models.chunks(uuids):
+            VirtBMC.delete().where(VirtBMC.uuid << chunk).execute()
+            QemuVM.delete().where(QemuVM.uuid << chunk).execute()
+        ports.release(uuids)
+        audit.forget(uuids)
+    base_images = [unit.base_image for unit in units]
+    if any(base_images):
+        imagecache.release(base_images)
+        imagecache.evict()
+    if failed:
+        raise Exception('{} nodes failed to delete: {}'.format(len(failed), ', '.join(failed)))
 
 
 def stop(args):
-    def _stop(uuid):
-        unit_item, bmc, vm = get_QemuBMC_unit(uuid)
+    def _stop(unit_item):
         unit_item.stop_vm()
-        unit_item.stop_bmc()
 
-    if args.id[0] == 'all':
-        stop_list = [item.uuid for item in VirtBMC.select()]
-    else:
-        stop_list = args.id
+    units = load_units(args.id)
+    process_map(_stop, units)
+    stop_bmcs(units)
+
+
+def stop_bmcs(units):
+    """Stop the BMCs of units in one engine and one supervisor request."""
+    ipmi_sim = [unit for unit in units if unit.bmc_backend != bmcserver.BACKEND_BUILTIN]
+    if units and bmcserver.is_engine_running():
+        # also forgets the chassis state of ipmi_sim nodes
+        with metrics.timed('stop_bmcs'):
+            bmcserver.engine_request('stop', uuids=[unit.uuid for unit in units])
+    for unit in ipmi_sim:
+        unit.stop_legacy_bmc()
+    if ipmi_sim:
+        with metrics.timed('stop_bmcs'):
+            supervisor.stop_programs([unit.uuid for unit in ipmi_sim])
+    health.get_cache().mark([unit.bmc_addr() for unit in units], False)
+    for unit in units:
+        LOG.info('Stop BMC: {} DONE.'.format(unit.qemuname))
+
+
+def ensure_chassis_controller():
+    """Run the BMC engine answering the chassis control of ipmi_sim nodes."""
+    try:
+        bmcserver.ensure_engine()
+    except Exception as e:
+        LOG.warning('{}, ipmi_sim falls back to ipmi_sim_chassiscontrol'.format(e))
+
+
+def provision_taps(units):
+    """Create and bridge the missing TAPs of units, {uuid: error} of the failed ones."""
+    units = [unit for unit in units if unit.tap]
+    if not units:
+        return {}
+    with metrics.timed('provision_taps'):
+        errors = netdev.ensure_taps([(unit.tap, unit.bridge) for unit in units])
+    res = {}
+    for unit in units:
+        if unit.tap in errors:
+            LOG.error(errors[unit.tap])
+            res[unit.uuid] = errors[unit.tap]
+    return res
 
-    process_map(_stop, stop_list)
+
+def run_bmcs(units):
+    """Start the BMCs of units in one engine and one supervisor request."""
+    builtin = [unit for unit in units if unit.bmc_backend == bmcserver.BACKEND_BUILTIN]
+    ipmi_sim = [unit for unit in units if unit.bmc_backend != bmcserver.BACKEND_BUILTIN]
+    errors = {}
+    if builtin:
+        with metrics.timed('start_bmcs'):
+            bmcserver.ensure_engine()
+            errors.update(bmcserver.engine_request(
+                'start', uuids=[unit.uuid for unit in builtin])['errors'])
+        # the engine has bound their ports when it replies
+        health.get_cache().mark([unit.bmc_addr() for unit in builtin
+                                 if unit.uuid not in errors], True)
+    for unit in ipmi_sim:
+        unit.stop_legacy_bmc()
+    if ipmi_sim:
+        ensure_chassis_controller()
+        with metrics.timed('start_bmcs'):
+            errors.update(supervisor.start_programs([unit.bmc_program() for unit in ipmi_sim]))
+    for _uuid, error in errors.items():
+        LOG.error('Start BMC {} error: {}'.format(_uuid, error))
+    return errors
+
+
+def wait_bmcs(units, timeout=BMC_READY_TIMEOUT):
+    """Wait until the BMCs of units answer presence pings, at most timeout seconds."""
+    addrs = [unit.bmc_addr() for unit in units]
+    deadline = time.time() + timeout
+    max_age = None
+    with metrics.timed('wait_bmcs'):
+        while addrs:
+            alive = health.get_cache().alive(addrs, max_age)
+            addrs = [addr for addr in addrs if not alive[addr]]
+            if time.time() >= deadline:
+                break
+            max_age = 0
+    for addr in addrs:
+        LOG.warning('BMC {}:{} does not answer presence pings'.format(*addr))
 
 
 def start(args):
-    def _start(uuid):
-        unit_item, _, _ = get_QemuBMC_unit(uuid)
-        unit_item.run_bmc()
-        if args.autostart_vm:
-            unit_item.run_vm()
-
-    if args.bmc[0] == 'all':
-        bmc_list = [item.uuid for item in VirtBMC.select()]
+    gate = admission.PowerOnGate(max_booting=args.max_booting, ramp=args.ramp,
+                                 boot_window=args.boot_window, max_load=args.max_load,
+                                 min_free_mem=args.min_free_mem, max_wait=args.max_wait)
+
+    def _start(unit_item):
+        started = time.time()
+        if not args.autostart_vm:
+            return [unit_item.number, unit_item.uuid, 'started', '-', '-', '-']
+        if unit_item.is_vm_running():
+            return [unit_item.number, unit_item.uuid, 'started', 'already on', '-', '-']
+        if unit_item.uuid in tap_errors:
+            return [unit_item.number, unit_item.uuid, 'started', ERROR_STATUS, '-', '-']
+        try:
+            with metrics.timed('admission_wait', unit_item.number):
+                waited = gate.admit(unit_item.memory)
+        except admission.AdmissionTimeout as e:
+            LOG.error('Power on {} error: {}'.format(unit_item.qemuname, e))
+            return [unit_item.number, unit_item.uuid, 'started', ERROR_STATUS,
+                    '{:.2f}'.format(e.waited), '-']
+        result = unit_item.run_vm()
+        return [unit_item.number, unit_item.uuid, 'started', result,
+                '{:.2f}'.format(waited), '{:.2f}'.format(time.time() - started)]
+
+    units = load_units(args.bmc)
+    tap_errors = provision_taps(units) if args.autostart_vm else {}
+    bmc_errors = run_bmcs(units)
+    if args.autostart_vm:
+        wait_bmcs([unit for unit in units if unit.uuid not in bmc_errors])
+    data_series = process_map(_start, [unit for unit in units if unit.uuid not in bmc_errors],
+                              args.workers) or []
+    data_series += [[unit.number, unit.uuid, ERROR_STATUS, '-', '-', '-']
+                    for unit in units if unit.uuid in bmc_errors]
+    print(tabulate(sorted(data_series), ['Order', 'UUID', 'BMC', 'VM', 'Waited(s)', 'PowerOn(s)'],
+                   tablefmt="psql"))
+
+
+def warm_pool(args):
+    def _warm(unit_item):
+        vm = warm.WarmVM.of_unit(unit_item)
+        row = [unit_item.number, unit_item.uuid]
+        try:
+            powered_on = unit_item.need_power_query()
+            if unit_item.uuid not in members:
+                if vm.is_member():
+                    unit_item.audit('warm_leave')
+                vm.leave()
+                if not powered_on and vm.alive():
+                    qmp.quit_vm(unit_item.qmp_socket)
+                    return row + ['no', 'cooled']
+                return row + ['no', '-']
+            if not vm.is_member():
+                unit_item.audit('warm_join')
+            vm.join()
+            if powered_on:
+                return row + ['yes', 'on']
+            if not vm.alive():
+                with metrics.timed('warm', unit_item.number):
+                    unit_item.refresh_state()
+                    vm.launch()
+            return row + ['yes', 'standby']
+        except Exception as e:
+            LOG.error('Warm {} error: {}'.format(unit_item.qemuname, e))
+            return row + ['-', ERROR_STATUS]
+
+    units = load_units(args.id)
+    size = len(units) if args.size is None else args.size
+    members = set() if args.off else set(unit.uuid for unit in units[:size])
+    tap_errors = provision_taps([unit for unit in units if unit.uuid in members])
+    members -= set(tap_errors)
+    data_series = process_map(_warm, units, args.workers) or []
+    print(tabulate(sorted(data_series), ['Order', 'UUID', 'Warm', 'VM'], tablefmt="psql"))
+
+
+def bulk_ipmi(args, operation, send, describe):
+    """Run send(client, targets, options) over the nodes of args.id and print the
+    result describe() makes of each response, with its latency.
+    """
+    units = load_units(args.id)
+    started = time.time()
+    with metrics.timed(operation):
+        reqs = send(ipmi.get_client(), [unit.ipmi_target() for unit in units],
+                    {'timeout': args.timeout, 'window': args.workers})
+    elapsed = time.time() - started
+    headers = ['Order', 'UUID', 'Result', 'Latency(ms)', 'Error']
+    data_series = []
+    failed = 0
+    for unit, req in zip(units, reqs):
+        try:
+            result, error = describe(req.result()), ''
+        except ipmi.IPMIError as e:
+            result, error = ERROR_STATUS, str(e)
+            failed += 1
+        metrics.OPERATION_SECONDS.observe(req.latency, operation=operation, node=unit.number,
+                                          result='error' if error else 'ok')
+        data_series.append([unit.number, unit.uuid, result, round(req.latency * 1000, 1), error])
+
+    if args.json:
+        import json
+        print(json.dumps([dict(zip(headers, item)) for item in data_series], indent=4))
     else:
-        bmc_list = args.start_bmc
-
-    map(_start, bmc_list)
+        print(tabulate(data_series, headers, tablefmt="psql"))
+        print('{} nodes, {} ok, {} failed in {:.2f}s'.format(
+            len(units), len(units) - failed, failed, elapsed))
+    if failed:
+        raise Exception('{} of {} nodes failed'.format(failed, len(units)))
+
+
+def power(args):
+    if args.action == 'status':
+        bulk_ipmi(args, 'bulk_power_status',
+                  lambda client, targets, options: client.power_status(targets, **options),
+                  lambda on: 'on' if on else 'off')
+        return
+    action = ipmi.POWER_ACTIONS[args.action]
+    bulk_ipmi(args, 'bulk_power_{}'.format(args.action),
+              lambda client, targets, options: client.chassis_control(targets, action, **options),
+              lambda _: 'ok')
+
+
+def bootdev(args):
+    bulk_ipmi(args, 'bulk_bootdev',
+              lambda client, targets, options: client.set_bootdev(
+                  targets, args.device, args.persistent, **options),
+              lambda _: args.device)
+
+
+def _audit_detail(detail):
+    if not detail:
+        return ''
+    import json
+    return ' '.join('{}={}'.format(k, v) for k, v in sorted(json.loads(detail).items()))
+
+
+def history(args):
+    units = load_units(None)
+    with metrics.timed('audit_ingest'):
+        audit.ingest([(unit.uuid, unit.audit_file) for unit in units])
+    uuids, numbers = [], []
+    for _id in args.id:
+        match = NUMBER_RANGE.match(_id)
+        if match:
+            numbers.append((int(match.group(1)), int(match.group(2) or match.group(1))))
+        elif _id != 'all':
+            uuids.append(_id)
+    if 'all' in args.id:
+        uuids, numbers = [], []
+    since = audit.parse_time(args.since) if args.since else None
+    until = audit.parse_time(args.until) if args.until else None
+    records = audit.query(uuids, numbers, args.op, since, until, args.limit)
+
+    headers = ['Time', 'Order', 'UUID', 'Operation', 'Source', 'User', 'Detail']
+    if args.json:
+        import json
+        output = [dict(zip(headers, [rec.ts, rec.number, rec.node, rec.op, rec.source, rec.user,
+                                     json.loads(rec.detail) if rec.detail else {}]))
+                  for rec in records]
+        print(json.dumps(output, indent=4))
+        return
+    data_series = [[time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(rec.ts)), rec.number,
+                    rec.node, rec.op, rec.source, rec.user, _audit_detail(rec.detail)]
+                   for rec in records]
+    print(tabulate(data_series, headers, tablefmt="psql"))
+
+
+def collect_metrics():
+    """Prometheus text of this process and of the running engine and supervisor."""
+    snapshots = [({'process': metrics.PROCESS}, metrics.REGISTRY.snapshot())]
+    if bmcserver.is_engine_running():
+        snapshots.append(({'process': 'bmc-engine'}, bmcserver.engine_request('metrics')['metrics']))
+    if supervisor.is_running():
+        snapshots.append(({'process': 'supervisor'},
+                          supervisor.supervisor_request('metrics')['metrics']))
+    return metrics.render(snapshots)
+
+
+def capacity():
+    """Resources of this host in MB and cpus, and what the nodes reserve of them."""
+    count, memory, ncpu = QemuVM.select(
+        fn.COUNT(QemuVM.id), fn.SUM(QemuVM.memory), fn.SUM(QemuVM.ncpu)).scalar(as_tuple=True)
+    return {
+        'host': socket.gethostname(),
+        'nodes': count,
+        'mem_total': admission.read_meminfo()['MemTotal'] // admission.MB,
+        'mem_available': admission.read_mem_available() // admission.MB,
+        'mem_committed': memory or 0,
+        'cpus': multiprocessing.cpu_count(),
+        'cpu_committed': ncpu or 0,
+        'load': admission.read_loadavg(),
+    }
+
+
+def show_metrics(args):
+    sys.stdout.write(collect_metrics())
+
+
+def bmc_engine(args):
+    def loader(uuids):
+        return load_units(uuids, strict=False)
+
+    engine = bmcserver.BMCEngine(loader, workers=args.workers)
+    engine.serve_forever()
@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+
+"""
+In-process counters, gauges and latency histograms.
+
+Every process keeps its own registry.  vbmcd exports its registry together
+with the ones of the BMC engine and the supervisor (fetched over their
+control sockets and labelled with their process name) in the Prometheus
+text format, on its unix socket and optionally over HTTP.
+"""
+
+import time
+import threading
+import BaseHTTPServer
+import SocketServer
+from contextlib import contextmanager
+
+from virtbmc import trace
+
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Metric(object):
+
+    kind = None
+
+    def __init__(self, name, doc, labelnames=()):
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def snapshot(self):
+        with self._lock:
+            samples = [[dict(zip(self.labelnames, key)), self._copy(value)]
+                       for key, value in self._values.items()]
+        return {'name': self.name, 'type': self.kind, 'help': self.doc, 'samples': samples}
+
+    def _copy(self, value):
+        return value
+
+
+class Counter(Metric):
+
+    kind = COUNTER
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+
+    kind = GAUGE
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+
+    kind = HISTOGRAM
+
+    def __init__(self, name, doc, labelnames=(), buckets=LATENCY_BUCKETS):
+        Metric.__init__(self, name, doc, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = {'buckets': [0] * len(self.buckets),
+                                              'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts['buckets'][i] += 1
+            counts['sum'] += value
+            counts['count'] += 1
+
+    def snapshot(self):
+        res = Metric.snapshot(self)
+        res['bounds'] = list(self.buckets)
+        return res
+
+    def _copy(self, value):
+        return {'buckets': list(value['buckets']), 'sum': value['sum'], 'count': value['count']}
+
+
+class Registry(object):
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, doc, labelnames, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, doc, labelnames, **kwargs)
+            elif not isinstance(metric, cls):
+                raise Exception('Metric {} is a {}'.format(name, metric.kind))
+        return metric
+
+    def counter(self, name, doc, labelnames=()):
+        return self._get(Counter, name, doc, labelnames)
+
+    def gauge(self, name, doc, labelnames=()):
+        return self._get(Gauge, name, doc, labelnames)
+
+    def histogram(self, name, doc, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._get(Histogram, name, doc, labelnames, buckets=buckets)
+
+    def snapshot(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return [metric.snapshot() for metric in metrics]
+
+
+REGISTRY = Registry()
+
+# process label of this registry when exported
+PROCESS = 'vbmc'
+
+OPERATION_SECONDS = REGISTRY.histogram(
+    'vbmc_operation_seconds', 'Duration of node operations.',
+    ('operation', 'node', 'result'))
+OPERATIONS_IN_PROGRESS = REGISTRY.gauge(
+    'vbmc_operations_in_progress', 'Node operations currently running.', ('operation',))
+COMMAND_SECONDS = REGISTRY.histogram(
+    'vbmc_command_seconds', 'Duration of external commands.', ('command', 'result'))
+CLI_COMMANDS = REGISTRY.counter(
+    'vbmc_cli_commands_total', 'vbmc.py subcommands run.', ('command', 'result'))
+
+
+@contextmanager
+def timed(operation, node=''):
+    """Observe the duration of the block as an operation on node.
+
+    The result label is "error" when the block raises, or what the block
+    stores in the yielded dict's "result".
+    """
+    span = {'result': 'ok'}
+    OPERATIONS_IN_PROGRESS.inc(operation=operation)
+    started = time.time()
+    try:
+        with trace.span(operation, trace.OPERATION, node=node):
+            yield span
+    except Exception:
+        span['result'] = 'error'
+        raise
+    finally:
+        OPERATIONS_IN_PROGRESS.dec(operation=operation)
+        OPERATION_SECONDS.observe(time.time() - started, operation=operation,
+                                  node=node, result=span['result'])
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, _escape(v))
+                          for k, v in sorted(labels.items())) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def render(snapshots):
+    """Prometheus text of [(extra labels, registry snapshot)], merging equal names."""
+    families = {}
+    order = []
+    for extra, snapshot in snapshots:
+        for metric in snapshot:
+            if metric['name'] not in families:
+                families[metric['name']] = (metric, [])
+                order.append(metric['name'])
+            for labels, value in metric['samples']:
+                labels = dict(labels, **extra)
+                families[metric['name']][1].append((labels, value, metric.get('bounds')))
+    lines = []
+    for name in order:
+        metric, samples = families[name]
+        lines.append('# HELP {} {}'.format(name, metric['help']))
+        lines.append('# TYPE {} {}'.format(name, metric['type']))
+        for labels, value, bounds in sorted(samples, key=lambda item: sorted(item[0].items())):
+            if metric['type'] != HISTOGRAM:
+                lines.append('{}{} {}'.format(name, _labels(labels), _number(value)))
+                continue
+            for bound, count in zip(bounds + [float('inf')], value['buckets'] + [value['count']]):
+                lines.append('{}_bucket{} {}'.format(
+                    name, _labels(dict(labels, le=_number(float(bound)))), count))
+            lines.append('{}_sum{} {}'.format(name, _labels(labels), _number(value['sum'])))
+            lines.append('{}_count{} {}'.format(name, _labels(labels), value['count']))
+    return '\n'.join(lines) + '\n'
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.collect().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class MetricsHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, addr, collect):
+        BaseHTTPServer.HTTPServer.__init__(self, addr, _Handler)
+        self.collect = collect
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
@@ -3,20 +3,55 @@
 import datetime
 
 from peewee import *
+from playhouse.migrate import SqliteMigrator, migrate
 
 import virtbmc.utils as utils
+from virtbmc import trace
 from virtbmc.config import DB_FILE
 
 
 DB=None
 
+# SQLite binds at most 999 variables per statement
+SQLITE_MAX_VARIABLES = 999
+
+# seconds a connection waits for the write lock
+BUSY_TIMEOUT = 30
+
+# WAL lets CLI calls and worker threads read while one of them writes
+PRAGMAS = [
+    ('journal_mode', 'wal'),
+    ('synchronous', 'normal'),
+    ('busy_timeout', BUSY_TIMEOUT * 1000),
+    ('cache_size', -8000),
+]
+
+
+class VBMCDatabase(SqliteDatabase):
+    """Connection per thread, transactions take the write lock up front.
+
+    A deferred transaction that reads before it writes fails with
+    "database is locked" instead of waiting when another connection wrote
+    in between, every transaction here is a write transaction.
+    """
+
+    def begin(self, lock_type='IMMEDIATE'):
+        with trace.span('sqlite write lock', trace.LOCK, lock_type=lock_type):
+            super(VBMCDatabase, self).begin(lock_type)
+
+    def execute_sql(self, sql, params=None, require_commit=True):
+        if not trace.enabled():
+            return super(VBMCDatabase, self).execute_sql(sql, params, require_commit)
+        with trace.span(sql.split(' ', 1)[0], trace.DB, sql=sql):
+            return super(VBMCDatabase, self).execute_sql(sql, params, require_commit)
+
 
 def db_init():
     global DB
     if DB_FILE is None or len(DB_FILE) == 0:
         raise Exception("Database file is invaild: %s" % DB_FILE)
     utils.mkdir_of_file(DB_FILE)
-    DB = SqliteDatabase(DB_FILE)
+    DB = VBMCDatabase(DB_FILE, pragmas=PRAGMAS, threadlocals=True, timeout=BUSY_TIMEOUT)
     return DB
 
 
@@ -37,17 +72,21 @@ class QemuVM(BaseModel):
     controller_script = TextField()
     ifmac = TextField()
     vncport = IntegerField()
-    uuid = TextField()
+    uuid = TextField(unique=True)
     created_date = DateTimeField(default=datetime.datetime.now)
     qemu_program = TextField('qemu-system-x86_64')
     bridge = TextField(default='br0')
+    base_image = TextField(default='')
+    # persistent TAP of the VM, empty when qemu-ifup/qemu-ifdown plug it
+    tap = TextField(default='')
+    hw_profile = TextField(default='legacy')
 
 
 class VirtBMC(BaseModel):
     vm = ForeignKeyField(QemuVM, related_name='vm')
     bmcname = TextField(unique=True)
-    number = IntegerField()
-    uuid = TextField()
+    number = IntegerField(unique=True)
+    uuid = TextField(unique=True)
     tmux_name = TextField()
     created_date = DateTimeField(default=datetime.datetime.now)
     listen_addr = TextField(default='127.0.0.1')
@@ -63,15 +102,214 @@ class VirtBMC(BaseModel):
     ipmi_op_record_file = TextField()
     ipmiusr = TextField()
     ipmipass = TextField()
+    bmc_backend = TextField(default='ipmi_sim')
+
+
+class PortRange(BaseModel):
+    kind = TextField(unique=True)
+    start = IntegerField()
+    end = IntegerField()
+
+
+class PortAllocation(BaseModel):
+    port = IntegerField(unique=True)
+    kind = TextField()
+    owner = TextField(index=True)
+    created_date = DateTimeField(default=datetime.datetime.now)
+
+
+class BaseImage(BaseModel):
+    digest = TextField(unique=True)
+    path = TextField()
+    format = TextField()
+    size = IntegerField()
+    virtual_size = IntegerField()
+    source = TextField()
+    source_size = IntegerField()
+    source_mtime = FloatField()
+    refcount = IntegerField(default=0)
+    last_used = DateTimeField(default=datetime.datetime.now)
+    created_date = DateTimeField(default=datetime.datetime.now)
+
+
+class Agent(BaseModel):
+    name = TextField(unique=True)
+    # vbmcd unix socket path or HOST:PORT
+    address = TextField()
+    token = TextField(default='')
+    created_date = DateTimeField(default=datetime.datetime.now)
+
+
+class AuditRecord(BaseModel):
+    ts = FloatField()
+    node = TextField()
+    number = IntegerField()
+    op = TextField()
+    source = TextField()
+    user = TextField(default='')
+    # JSON object or empty
+    detail = TextField(default='')
+
+    class Meta:
+        indexes = (
+            (('node', 'ts'), False),
+            (('number', 'ts'), False),
+            (('op', 'ts'), False),
+        )
+
+
+class AuditCursor(BaseModel):
+    # how far audit.ingest read the log of node
+    node = TextField(unique=True)
+    inode = IntegerField()
+    offset = IntegerField()
+
+
+def bulk_insert(model, rows):
+    """insert_many in chunks that fit the SQLite variable limit."""
+    if not rows:
+        return
+    chunk = max(1, SQLITE_MAX_VARIABLES // len(rows[0]))
+    for i in range(0, len(rows), chunk):
+        model.insert_many(rows[i:i + chunk]).execute()
+
+
+def chunks(items, size=SQLITE_MAX_VARIABLES):
+    """Slices of items small enough for an IN clause."""
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
 
+def model_row(model, attrs):
+    """Column values of model picked out of attrs, defaults filled in."""
+    row = {}
+    for field in model._meta.sorted_fields:
+        if field.name in attrs:
+            row[field.name] = attrs[field.name]
+        elif field.default is not None:
+            row[field.name] = field.default() if callable(field.default) else field.default
+    return row
 
-def _create_tables(tables):
+
+def _create_tables(tables, safe=False):
     global DB
-    DB.create_tables(tables)
+    DB.create_tables(tables, safe=safe)
 
 
 def init_db():
-    _create_tables([VirtBMC, QemuVM])
+    with DB.atomic():
+        _create_tables([VirtBMC, QemuVM, PortRange, PortAllocation, BaseImage, Agent,
+                        AuditRecord, AuditCursor])
+        set_schema_version(SCHEMA_VERSION)
+
+
+def get_schema_version():
+    return DB.execute_sql('PRAGMA user_version').fetchone()[0]
+
+
+def set_schema_version(version):
+    DB.execute_sql('PRAGMA user_version = {:d}'.format(version))
+
+
+def _add_missing_columns(model):
+    global DB
+    table = model._meta.db_table
+    columns = [col.name for col in DB.get_columns(table)]
+    migrator = SqliteMigrator(DB)
+    ops = [migrator.add_column(table, field.db_column, field)
+           for field in model._meta.sorted_fields if field.db_column not in columns]
+    if ops:
+        migrate(*ops)
+
+
+def _add_missing_indexes(model):
+    global DB
+    table = model._meta.db_table
+    indexed = [tuple(index.columns) for index in DB.get_indexes(table) if index.unique]
+    migrator = SqliteMigrator(DB)
+    ops = []
+    for field in model._meta.sorted_fields:
+        if not field.unique or (field.db_column,) in indexed:
+            continue
+        dups = model.select(field).group_by(field).having(fn.COUNT(model._meta.primary_key) > 1)
+        values = [getattr(item, field.name) for item in dups]
+        if values:
+            raise Exception('Cannot index {}.{}, duplicated values: {}'.format(
+                table, field.db_column, values))
+        ops.append(migrator.add_index(table, [field.db_column], unique=True))
+    if ops:
+        migrate(*ops)
+
+
+def _backfill_port_allocations():
+    if PortAllocation.select().count() != 0:
+        return
+    rows = []
+    # only columns of the first schema, later migrations add the others
+    query = VirtBMC.select(VirtBMC.uuid, VirtBMC.ipmi_port, VirtBMC.telnet_port,
+                           QemuVM.vncport).join(QemuVM).naive()
+    for bmc in query:
+        rows.append({'port': bmc.ipmi_port, 'kind': 'bmc', 'owner': bmc.uuid})
+        rows.append({'port': bmc.telnet_port, 'kind': 'bmc', 'owner': bmc.uuid})
+        rows.append({'port': 5900 + bmc.vncport, 'kind': 'vnc', 'owner': bmc.uuid})
+    with DB.atomic():
+        bulk_insert(PortAllocation, rows)
+
+
+def _migrate_port_allocations():
+    _create_tables([PortRange, PortAllocation], safe=True)
+    _add_missing_columns(VirtBMC)
+    _backfill_port_allocations()
+
+
+def _migrate_base_images():
+    _create_tables([BaseImage], safe=True)
+    _add_missing_columns(QemuVM)
+
+
+def _migrate_unique_indexes():
+    for model in [QemuVM, VirtBMC]:
+        _add_missing_indexes(model)
+
+
+def _migrate_agents():
+    _create_tables([Agent], safe=True)
+
+
+def _migrate_taps():
+    _add_missing_columns(QemuVM)
+
+
+def _migrate_hw_profiles():
+    _add_missing_columns(QemuVM)
+
+
+def _migrate_audit():
+    _create_tables([AuditRecord, AuditCursor], safe=True)
+
+
+# schema version N is reached by MIGRATIONS[N - 1], append only
+MIGRATIONS = [
+    _migrate_port_allocations,
+    _migrate_base_images,
+    _migrate_unique_indexes,
+    _migrate_agents,
+    _migrate_taps,
+    _migrate_hw_profiles,
+    _migrate_audit,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def upgrade_db():
+    for version, migration in enumerate(MIGRATIONS, 1):
+        with DB.atomic():
+            # re-read under the write lock, another process may have migrated
+            if get_schema_version() >= version:
+                continue
+            migration()
+            set_schema_version(version)
 
 
 def remove_db():
@@ -81,5 +319,7 @@ def remove_db():
 def manage(args):
     if args.init:
         init_db()
+    if args.upgrade:
+        upgrade_db()
     if args.remove:
         remove_db()
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+
+"""
+Persistent TAP devices of the VMs, created and bridged through netlink.
+
+A node created with --tap owns one persistent TAP named after its uuid. The
+device is created, brought up and enslaved to the node bridge before the VM
+powers on and stays there across power cycles, qemu only opens it with
+ifname=...,script=no. Nothing forks `ip` or `brctl` and no rtnl lock is
+taken while VMs boot. The devices go away when their node is deleted.
+
+Everything below only needs CAP_NET_ADMIN and reads the links from sysfs,
+it runs the same in a network namespace:
+
+    $ ip netns exec vbmc-test python -m virtbmc.netdev ensure vbmctest br0
+"""
+
+import os
+import sys
+import errno
+import fcntl
+import socket
+import struct
+
+
+TAP_PREFIX = 'vbmc'
+
+TUN_DEVICE = '/dev/net/tun'
+TUNSETIFF = 0x400454ca
+TUNSETPERSIST = 0x400454cb
+IFF_TAP = 0x0002
+IFF_NO_PI = 0x1000
+
+IFF_UP = 0x1
+IFF_PROMISC = 0x100
+
+NETLINK_ROUTE = 0
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+NLMSG_ERROR = 2
+NLM_F_REQUEST = 0x1
+NLM_F_ACK = 0x4
+IFLA_MASTER = 10
+
+_NLMSGHDR = struct.Struct('=IHHII')
+_IFINFOMSG = struct.Struct('=BxHiII')
+_RTATTR = struct.Struct('=HH')
+
+SYS_CLASS_NET = '/sys/class/net'
+
+
+def tap_name(_uuid):
+    # interface names hold 15 characters, 44 bits of the uuid
+    return TAP_PREFIX + _uuid.replace('-', '')[:11]
+
+
+def link_index(name):
+    try:
+        with open(os.path.join(SYS_CLASS_NET, name, 'ifindex')) as f:
+            return int(f.read())
+    except IOError:
+        return None
+
+
+def link_master(name):
+    master = os.path.join(SYS_CLASS_NET, name, 'master')
+    if not os.path.islink(master):
+        return None
+    return os.path.basename(os.readlink(master))
+
+
+def link_is_up(name):
+    try:
+        with open(os.path.join(SYS_CLASS_NET, name, 'flags')) as f:
+            return bool(int(f.read(), 16) & IFF_UP)
+    except IOError:
+        return False
+
+
+def create_tap(name):
+    """Create the persistent TAP device name, owned by root."""
+    fd = os.open(TUN_DEVICE, os.O_RDWR)
+    try:
+        ifr = struct.pack('16sH22x', str(name), IFF_TAP | IFF_NO_PI)
+        fcntl.ioctl(fd, TUNSETIFF, ifr)
+        fcntl.ioctl(fd, TUNSETPERSIST, 1)
+    finally:
+        os.close(fd)
+
+
+class Netlink(object):
+    """Blocking rtnetlink socket sending one acknowledged request at a time."""
+
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+        self.sock.bind((0, 0))
+        self.seq = 0
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    def request(self, msg_type, payload):
+        self.seq += 1
+        self.sock.send(_NLMSGHDR.pack(_NLMSGHDR.size + len(payload), msg_type,
+                                      NLM_F_REQUEST | NLM_F_ACK, self.seq, 0) + payload)
+        while True:
+            data = self.sock.recv(65536)
+            offset = 0
+            while offset + _NLMSGHDR.size <= len(data):
+                length, reply_type, _, seq, _ = _NLMSGHDR.unpack_from(data, offset)
+                if reply_type == NLMSG_ERROR and seq == self.seq:
+                    code = -struct.unpack_from('=i', data, offset + _NLMSGHDR.size)[0]
+                    if code:
+                        raise OSError(code, os.strerror(code))
+                    return
+                offset += (length + 3) & ~3
+
+    def set_link(self, index, up=True, master=None):
+        """Bring link index up (or down) and enslave it to link master."""
+        flags = IFF_UP | IFF_PROMISC if up else 0
+        payload = _IFINFOMSG.pack(socket.AF_UNSPEC, 0, index, flags, IFF_UP | IFF_PROMISC)
+        if master is not None:
+            payload += _RTATTR.pack(_RTATTR.size + 4, IFLA_MASTER) + struct.pack('=I', master)
+        self.request(RTM_NEWLINK, payload)
+
+    def delete_link(self, index):
+        self.request(RTM_DELLINK, _IFINFOMSG.pack(socket.AF_UNSPEC, 0, index, 0, 0))
+
+
+def ensure_taps(taps):
+    """Create and bridge the missing ones of [(tap, bridge)].
+
+    Devices already up on their bridge cost two stats. Return {tap: error}.
+    """
+    errors = {}
+    nl = None
+    try:
+        for name, bridge in taps:
+            if link_master(name) == bridge and link_is_up(name):
+                continue
+            try:
+                master = link_index(bridge)
+                if master is None:
+                    raise Exception('bridge {} not found'.format(bridge))
+                if link_index(name) is None:
+                    create_tap(name)
+                nl = nl or Netlink()
+                nl.set_link(link_index(name), master=master)
+            except Exception as e:
+                errors[name] = 'TAP {} on {}: {}'.format(name, bridge, e)
+    finally:
+        if nl is not None:
+            nl.close()
+    return errors
+
+
+def remove_taps(names):
+    """Delete the devices of names that exist, return {tap: error}."""
+    errors = {}
+    indexes = [(name, link_index(name)) for name in names]
+    indexes = [(name, index) for name, index in indexes if index is not None]
+    if not indexes:
+        return errors
+    with Netlink() as nl:
+        for name, index in indexes:
+            try:
+                nl.delete_link(index)
+            except OSError as e:
+                if e.errno != errno.ENODEV:
+                    errors[name] = 'TAP {}: {}'.format(name, e)
+    return errors
+
+
+def tap_status(name, bridge):
+    if link_index(name) is None:
+        return 'missing'
+    if link_master(name) != bridge:
+        return 'detached'
+    return 'up' if link_is_up(name) else 'down'
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) == 3 and argv[0] == 'ensure':
+        errors = ensure_taps([(argv[1], argv[2])])
+    elif len(argv) == 2 and argv[0] == 'remove':
+        errors = remove_taps([argv[1]])
+    else:
+        sys.stderr.write('usage: python -m virtbmc.netdev ensure TAP BRIDGE | remove TAP\n')
+        return 1
+    for error in errors.values():
+        sys.stderr.write(error + '\n')
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
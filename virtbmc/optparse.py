@@ -8,6 +8,18 @@ import virtbmc.utils as utils
 from virtbmc.version import version
 from virtbmc import models
 from virtbmc import manager
+from virtbmc import bmcserver
+from virtbmc import ipmi
+from virtbmc import ports
+from virtbmc import imagecache
+from virtbmc import profiles
+from virtbmc import vbmcd
+from virtbmc import supervisor
+from virtbmc import cluster
+from virtbmc import admission
+
+
+DEFAULT_TEMPLATE_DIR = utils.dirname(__file__, 1) + os.sep + 'templates'
 
 
 def init_argparser():
@@ -24,6 +36,10 @@ def init_argparser():
     parent_parser = argparse.ArgumentParser(add_help=False)
     parent_parser.add_argument("-d", "--verbose", help="increase output verbosity",
                         action="store_true")
+    parent_parser.add_argument("--profile", metavar="TRACE_FILE",
+                        help="write a Chrome trace of this run to TRACE_FILE")
+    parent_parser.add_argument("--profile-stats", dest="profile_stats", metavar="PSTATS_FILE",
+                        help="also dump cProfile stats of all threads to PSTATS_FILE")
 
     # Database
     db_parser = subparsers.add_parser(
@@ -31,9 +47,33 @@ def init_argparser():
         help='Database management',
     )
     db_parser.add_argument('--init', action='store_true', help='Init sqlite database')
+    db_parser.add_argument('--upgrade', action='store_true', help='Add missing columns to an existing database')
     db_parser.add_argument('--remove', action='store_true', help='Remove sqlite database')
     db_parser.set_defaults(func=models.manage)
 
+    # Ports
+    ports_parser = subparsers.add_parser(
+        'ports', parents=[parent_parser],
+        help='Show or configure the BMC/VNC port ranges',
+    )
+    ports_parser.add_argument("--set-range", nargs=3, dest='set_range',
+                        metavar=('KIND', 'START', 'END'),
+                        help="set port range [START, END) of kind bmc or vnc")
+    ports_parser.set_defaults(func=ports.manage)
+
+    # Images
+    images_parser = subparsers.add_parser(
+        'images', parents=[parent_parser],
+        help='Manage the cached base images',
+    )
+    images_parser.add_argument("--add", type=str, metavar='PATH',
+                        help="import a base image into the cache")
+    images_parser.add_argument("--recount", action='store_true',
+                        help="recompute reference counts from the VMs")
+    images_parser.add_argument("--evict", action='store_true',
+                        help="evict unreferenced images over the cache size")
+    images_parser.set_defaults(func=imagecache.manage)
+
     # Create
     create_parser = subparsers.add_parser(
         'create', parents=[parent_parser],
@@ -47,18 +87,107 @@ def init_argparser():
                         default='20G', help="specified image size used by qemu/kvm")
     create_parser.add_argument("-b", "--bridge", type=str, default='br0',
                         help="bridge interface name")
+    create_parser.add_argument("--tap", action='store_true',
+                        help="plug the VM into a persistent TAP bridged through netlink "
+                             "instead of the qemu-ifup/qemu-ifdown scripts")
     create_parser.add_argument("--qemu", type=str, default='/opt/qemu2.7/bin/qemu-system-x86_64',
                         help="qemu binary execute path")
     create_parser.add_argument("--ipmi-sim", type=str, dest="ipmi_sim",
                         default='/opt/openipmi/bin/ipmi_sim', help="ipmi-sim binary execute path")
+    create_parser.add_argument("--bmc-backend", type=str, dest="bmc_backend",
+                        choices=bmcserver.BACKENDS, default=bmcserver.BACKEND_IPMI_SIM,
+                        help="ipmi_sim process per node or the shared builtin BMC engine")
     create_parser.add_argument("--memory", type=int, default=4096,
                         help="qemu VM memory size")
     create_parser.add_argument("--ncpu", type=int, default=1,
                         help="qemu VM cpu number")
-    create_parser.add_argument("--template", type=str, default=utils.dirname(__file__, 1)+os.sep+'templates',
+    create_parser.add_argument("--template", type=str, default=DEFAULT_TEMPLATE_DIR,
                         help="template scripts dirpath")
+    create_parser.add_argument("--base-image", type=str, dest='base_image',
+                        help="back each disk with a qcow2 overlay on this cached base image")
+    create_parser.add_argument("--hw-profile", dest='hw_profile', choices=profiles.names(),
+                        default=profiles.DEFAULT_PROFILE,
+                        help="VM hardware profile: NIC, disk controller and cache, CPU model, hugepages")
+    create_parser.add_argument("--workers", type=int, default=manager.MAX_WORKERS,
+                        help="worker threads rendering scripts and creating images")
     create_parser.set_defaults(func=manager.create)
 
+    # Regen
+    regen_parser = subparsers.add_parser(
+        'regen', parents=[parent_parser],
+        help='Regenerate node scripts after a template change',
+    )
+    regen_parser.add_argument('id', nargs='+',
+                               help='Regenerate specify BMCs, all for every node')
+    regen_parser.add_argument("--template", type=str, default=DEFAULT_TEMPLATE_DIR,
+                        help="template scripts dirpath")
+    regen_parser.add_argument("--hw-profile", dest='hw_profile', choices=profiles.names(),
+                        help="switch the nodes to this VM hardware profile")
+    regen_parser.add_argument("--workers", type=int, default=manager.MAX_WORKERS,
+                        help="worker threads rendering scripts")
+    regen_parser.set_defaults(func=manager.regen)
+
+    # BMC engine
+    engine_parser = subparsers.add_parser(
+        'bmc-engine', parents=[parent_parser],
+        help='Run the builtin BMC engine in foreground',
+    )
+    engine_parser.add_argument("--workers", type=int, default=8,
+                        help="worker threads for power and boot device changes")
+    engine_parser.set_defaults(func=manager.bmc_engine)
+
+    # vbmcd
+    vbmcd_parser = subparsers.add_parser(
+        'vbmcd', parents=[parent_parser],
+        help='Run the vbmcd daemon in foreground, vbmc.py forwards commands to it',
+    )
+    vbmcd_parser.add_argument("--workers", type=int, default=8,
+                        help="requests handled concurrently")
+    vbmcd_parser.add_argument("--shutdown", action='store_true',
+                        help="stop a running vbmcd")
+    vbmcd_parser.add_argument("--metrics-listen", dest="metrics_listen", metavar="[HOST:]PORT",
+                        help="serve Prometheus metrics over HTTP on HOST:PORT")
+    vbmcd_parser.add_argument("--listen", metavar="[HOST:]PORT",
+                        help="also serve TCP on HOST:PORT as an agent of a cluster coordinator")
+    vbmcd_parser.add_argument("--token",
+                        help="agent token TCP clients must send, required by --listen, "
+                             "default $VBMC_AGENT_TOKEN")
+    vbmcd_parser.set_defaults(func=vbmcd.manage)
+
+    # Cluster agents
+    agent_parser = subparsers.add_parser(
+        'agent', parents=[parent_parser],
+        help='Show or configure the vbmcd agents of the cluster coordinator',
+    )
+    agent_parser.add_argument("--add", nargs=2, metavar=('NAME', 'ADDRESS'),
+                        help="add or update an agent at a vbmcd socket path or HOST:PORT")
+    agent_parser.add_argument("--token", help="token of the added agent")
+    agent_parser.add_argument("--remove", metavar='NAME', help="forget an agent")
+    agent_parser.set_defaults(func=cluster.manage_agents)
+
+    # Cluster
+    cluster_parser = subparsers.add_parser(
+        'cluster', parents=[parent_parser],
+        help='Run create/start/stop/delete/list/... across the agents',
+    )
+    cluster_parser.add_argument("--agent", action='append', dest='agents', metavar='NAME',
+                        help="only use these agents, default all")
+    cluster_parser.add_argument("--cpu-overcommit", type=float, dest='cpu_overcommit',
+                        default=cluster.CPU_OVERCOMMIT,
+                        help="vcpus placed per host cpu")
+    cluster_parser.add_argument("argv", nargs=argparse.REMAINDER, metavar='COMMAND ...',
+                        help="vbmc.py command and its arguments")
+    cluster_parser.set_defaults(func=cluster.manage)
+
+    # Supervisor
+    supervisor_parser = subparsers.add_parser(
+        'supervisor', parents=[parent_parser],
+        help='Run the ipmi_sim supervisor in foreground',
+    )
+    supervisor_parser.add_argument("--shutdown", action='store_true',
+                        help="stop a running supervisor and its ipmi_sim processes")
+    supervisor_parser.set_defaults(func=supervisor.manage)
+
     # Start
     start_parser = subparsers.add_parser(
         'start', parents=[parent_parser],
@@ -69,8 +198,91 @@ def init_argparser():
     start_parser.add_argument("--vm", dest='autostart_vm',
                         help="autostart qemu vm when BMC run",
                         action="store_true")
+    start_parser.add_argument("--workers", type=int, default=manager.MAX_WORKERS,
+                        help="nodes started concurrently")
+    start_parser.add_argument("--max-booting", type=int, dest='max_booting', default=0,
+                        help="VMs booting at once, 0 for no limit")
+    start_parser.add_argument("--ramp", type=float, default=0,
+                        help="VM power-ons per second, 0 for no limit")
+    start_parser.add_argument("--boot-window", type=float, dest='boot_window', default=60,
+                        help="seconds a powered on VM counts as booting")
+    start_parser.add_argument("--max-load", type=float, dest='max_load', default=0,
+                        help="hold power-ons while the 1 minute loadavg is higher")
+    start_parser.add_argument("--min-free-mem", type=int, dest='min_free_mem', default=0,
+                        help="MB of available memory to keep after each power-on")
+    start_parser.add_argument("--max-wait", type=float, dest='max_wait',
+                        default=admission.MAX_WAIT,
+                        help="seconds a VM waits for --max-load and --min-free-mem before "
+                             "it fails, 0 waits forever (default %(default)s)")
     start_parser.set_defaults(func=manager.start)
 
+    # Bulk IPMI
+    ipmi_parent_parser = argparse.ArgumentParser(add_help=False)
+    ipmi_parent_parser.add_argument("--json", help="json output",
+                        action="store_true")
+    ipmi_parent_parser.add_argument("--workers", type=int, default=manager.IPMI_WINDOW,
+                        help="BMCs talked to at once")
+    ipmi_parent_parser.add_argument("--timeout", type=float, default=ipmi.DEFAULT_TIMEOUT,
+                        help="seconds to wait for each BMC")
+
+    power_parser = subparsers.add_parser(
+        'power', parents=[parent_parser, ipmi_parent_parser],
+        help='Power on/off/cycle/reset/soft or query many VMs through their BMC',
+    )
+    power_parser.add_argument("action", choices=sorted(ipmi.POWER_ACTIONS) + ['status'],
+                        help="chassis power action")
+    power_parser.add_argument('id', nargs='+',
+                              help='BMC uuids, node numbers or ranges like 0-99, all for every node')
+    power_parser.set_defaults(func=manager.power)
+
+    bootdev_parser = subparsers.add_parser(
+        'bootdev', parents=[parent_parser, ipmi_parent_parser],
+        help='Set the boot device of many VMs through their BMC',
+    )
+    bootdev_parser.add_argument("device", choices=sorted(ipmi.BOOTDEV_SELECTOR),
+                        help="boot device")
+    bootdev_parser.add_argument('id', nargs='+',
+                              help='BMC uuids, node numbers or ranges like 0-99, all for every node')
+    bootdev_parser.add_argument("--persistent", action='store_true',
+                        help="keep the boot device for all future boots")
+    bootdev_parser.set_defaults(func=manager.bootdev)
+
+    # Warm pool
+    warm_parser = subparsers.add_parser(
+        'warm', parents=[parent_parser],
+        help='Keep powered off VMs paused in qemu for instant power on',
+    )
+    warm_parser.add_argument('id', nargs='+',
+                              help='Warm specify BMCs, all for every node')
+    warm_parser.add_argument("--size", type=int,
+                        help="warm only the first SIZE of the nodes, cool down the others")
+    warm_parser.add_argument("--off", action='store_true',
+                        help="remove the nodes from the warm pool")
+    warm_parser.add_argument("--workers", type=int, default=manager.MAX_WORKERS,
+                        help="worker threads starting standby VMs")
+    warm_parser.set_defaults(func=manager.warm_pool)
+
+    # History
+    history_parser = subparsers.add_parser(
+        'history', parents=[parent_parser],
+        help='Query the operation audit log of the nodes',
+    )
+    history_parser.add_argument('id', nargs='*', default=['all'],
+                                help='uuids, numbers or ranges like 0-99 of the nodes, '
+                                     'deleted ones included (default all)')
+    history_parser.add_argument("--op", action='append',
+                        help="only this operation, e.g. power_on, power_off, power_reset, "
+                             "bootdev, create, delete (repeatable)")
+    history_parser.add_argument("--since",
+                        help="from this time: epoch seconds, 'YYYY-MM-DD[ HH:MM[:SS]]' "
+                             "or an age like 30m, 2h, 7d")
+    history_parser.add_argument("--until", help="up to this time, as --since")
+    history_parser.add_argument("--limit", type=int, default=1000,
+                        help="only the last LIMIT records, 0 for all (default 1000)")
+    history_parser.add_argument("--json", help="json output",
+                        action="store_true")
+    history_parser.set_defaults(func=manager.history)
+
     # List
     list_parser = subparsers.add_parser(
         'list', parents=[parent_parser],
@@ -78,8 +290,18 @@ def init_argparser():
     )
     list_parser.add_argument("--json", help="json output",
                         action="store_true")
+    list_parser.add_argument("--max-age", type=float, dest='max_age',
+                        help="seconds a cached BMC presence ping stays valid, "
+                             "0 pings every BMC (default $VBMC_HEALTH_TTL or 5)")
     list_parser.set_defaults(func=manager.list_all)
 
+    # Metrics
+    metrics_parser = subparsers.add_parser(
+        'metrics', parents=[parent_parser],
+        help='Dump operation metrics in Prometheus text format',
+    )
+    metrics_parser.set_defaults(func=manager.show_metrics)
+
     # Update
     update_parser = subparsers.add_parser(
         'update', parents=[parent_parser],
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+from peewee import IntegrityError
+from portpicker import is_port_free
+from tabulate import tabulate
+
+from virtbmc.models import PortRange, PortAllocation
+import virtbmc.models as models
+from virtbmc.clrlog import LOG
+
+
+KIND_BMC = 'bmc'
+KIND_VNC = 'vnc'
+
+DEFAULT_RANGES = {
+    KIND_BMC: (9000, 9500),
+    KIND_VNC: (5900, 6000),
+}
+
+VNC_BASE_PORT = 5900
+
+# ipmi/serial port and telnet port per node
+BMC_PORTS_PER_NODE = 2
+
+ALLOCATE_RETRIES = 3
+
+
+def get_range(kind):
+    try:
+        item = PortRange.get(PortRange.kind == kind)
+        return item.start, item.end
+    except PortRange.DoesNotExist:
+        return DEFAULT_RANGES[kind]
+
+
+def set_range(kind, start, end):
+    if kind not in DEFAULT_RANGES:
+        raise Exception('Unknown port kind: {}'.format(kind))
+    if not 0 < start < end <= 65536:
+        raise Exception('Invalid port range: {}-{}'.format(start, end))
+    with models.DB.atomic():
+        updated = PortRange.update(start=start, end=end).where(PortRange.kind == kind).execute()
+        if not updated:
+            PortRange.create(kind=kind, start=start, end=end)
+
+
+def _pick(kind, count):
+    start, end = get_range(kind)
+    query = PortAllocation.select(PortAllocation.port).where(
+        (PortAllocation.port >= start) & (PortAllocation.port < end))
+    used = set(item.port for item in query)
+    picked = []
+    for port in range(start, end):
+        if len(picked) == count:
+            break
+        # only probe candidates, reserved ports never hit the socket layer
+        if port not in used and is_port_free(port):
+            picked.append(port)
+    if len(picked) < count:
+        raise Exception('Not enough free {} ports in range {}-{}: need {}, found {}'.format(
+            kind, start, end, count, len(picked)))
+    return picked
+
+
+def reserve(demands):
+    """Reserve ports in one transaction.
+
+    demands is a list of (owner, kind, count), returns {owner: {kind: [ports]}}.
+    """
+    for attempt in range(ALLOCATE_RETRIES):
+        try:
+            with models.DB.atomic():
+                return _reserve(demands)
+        except IntegrityError as e:
+            # another process reserved one of our candidates first
+            LOG.warning('Port reservation conflict, retry: {}'.format(e))
+    raise Exception('Port reservation failed after {} attempts'.format(ALLOCATE_RETRIES))
+
+
+def _reserve(demands):
+    totals = {}
+    for _, kind, count in demands:
+        totals[kind] = totals.get(kind, 0) + count
+    pools = dict((kind, _pick(kind, count)) for kind, count in totals.items())
+    res = {}
+    rows = []
+    for owner, kind, count in demands:
+        ports, pools[kind] = pools[kind][:count], pools[kind][count:]
+        res.setdefault(owner, {})[kind] = ports
+        rows += [{'port': port, 'kind': kind, 'owner': owner} for port in ports]
+    models.bulk_insert(PortAllocation, rows)
+    return res
+
+
+def reserve_nodes(owners):
+    """Reserve the BMC and VNC ports of many nodes in one transaction."""
+    demands = []
+    for owner in owners:
+        demands.append((owner, KIND_BMC, BMC_PORTS_PER_NODE))
+        demands.append((owner, KIND_VNC, 1))
+    reserved = reserve(demands)
+    res = []
+    for owner in owners:
+        bmc_ports = reserved[owner][KIND_BMC]
+        res.append({
+            'ipmi_port': bmc_ports[0],
+            'serial_port': bmc_ports[0],
+            'telnet_port': bmc_ports[1],
+            'vncport': reserved[owner][KIND_VNC][0] - VNC_BASE_PORT,
+        })
+    return res
+
+
+def release(owners):
+    owners = list(owners)
+    with models.DB.atomic():
+        for chunk in models.chunks(owners):
+            PortAllocation.delete().where(PortAllocation.owner << chunk).execute()
+
+
+def manage(args):
+    if args.set_range:
+        kind, start, end = args.set_range
+        set_range(kind, int(start), int(end))
+    data_series = []
+    for kind in sorted(DEFAULT_RANGES):
+        start, end = get_range(kind)
+        used = PortAllocation.select().where(PortAllocation.kind == kind).count()
+        data_series.append([kind, start, end, used, end - start - used])
+    print(tabulate(data_series, ['Kind', 'Start', 'End', 'Reserved', 'Unreserved'],
+                   tablefmt="psql"))
@@ -4,29 +4,70 @@ import shlex
 import subprocess
 import logging
 import os
+import errno
 import fcntl
 import select
+import signal
+import threading
 import time
 
+from virtbmc import trace
+
+
+READ_SIZE = 65536
+# commands running longer than this get a thread waiting for their exit
+WATCH_DELAY = 0.05
+
+
+def _set_nonblock(fd):
+    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+
+def _spawn_kwargs(disassociate):
+    # a preexec_fn runs python in the forked child, which deadlocks on a lock
+    # (import, logging) another thread held at fork, keep it to setsid
+    kwargs = {'close_fds': True}
+    if disassociate:
+        kwargs['preexec_fn'] = os.setsid
+    return kwargs
+
+
+def _watch_exit(proc):
+    """Pipe becoming readable once proc has exited, and the thread reaping it."""
+    exit_r, exit_w = os.pipe()
+
+    def _wait():
+        try:
+            proc.wait()
+        finally:
+            os.write(exit_w, b'x')
+            os.close(exit_w)
+
+    waiter = threading.Thread(target=_wait)
+    waiter.daemon = True
+    waiter.start()
+    return exit_r, waiter
+
 
 class InteractiveProcess(object):
 
     def __init__(self, cmds, **kwargs):
-        timeout = kwargs.pop('timeout', -1)
-        if timeout > 0:
-            cmds = ['timeout', '--signal=KILL', '%ds' % timeout] + cmds
+        self.timeout = kwargs.pop('timeout', -1)
         self.cmds = map(str, cmds)
         self.disassociate = kwargs.pop('disassociate', False)
         self.redirect_file = kwargs.pop('redirect_file', None)
         self.is_redirect = False
+        self.timed_out = False
+        self.deadline = None
+        self.returncode = None
 
     def start(self):
         kwargs = {
             'stdin': subprocess.PIPE,
             'stdout': subprocess.PIPE,
             'stderr': subprocess.STDOUT,
-            'close_fds': True,
         }
+        kwargs.update(_spawn_kwargs(self.disassociate))
         if self.redirect_file is not None:
             if not hasattr(self.redirect_file, 'write'):
                 raise Exception('%s is not a opening file for IO redirect' % self.redirect_file)
@@ -34,44 +75,73 @@ class InteractiveProcess(object):
                 self.is_redirect = True
                 kwargs['stdout'] = self.redirect_file
                 kwargs['stderr'] = subprocess.PIPE
-        if self.disassociate:
-            kwargs['preexec_fn'] = os.setsid
         self.proc = subprocess.Popen(self.cmds, **kwargs)
+        if self.timeout > 0:
+            self.deadline = time.time() + self.timeout
 
-    def get_output_no_exception(self):
-        lines = ''
-        fd = self.proc.stdout if not self.is_redirect else self.proc.stderr
-        fdno = fd.fileno()
-        fl = fcntl.fcntl(fdno, fcntl.F_GETFL)
-        fcntl.fcntl(fdno, fcntl.F_SETFL, fl | os.O_NONBLOCK)
-        is_exit = False
-        while not is_exit:
+    def _output_file(self):
+        return self.proc.stdout if not self.is_redirect else self.proc.stderr
+
+    def _watch(self):
+        self._chunks = []
+        self._out = self._output_file().fileno()
+        _set_nonblock(self._out)
+        self._exit = None
+        self._waiter = None
+        self.watch_at = time.time() + WATCH_DELAY
+
+    def _start_waiter(self):
+        self._exit, self._waiter = _watch_exit(self.proc)
+
+    def _read(self):
+        """Buffer the pending output, return False at EOF."""
+        while True:
             try:
-                r, w, x = select.select([fdno], [], [fdno], 1)
-                if fdno in r:
-                    lines += fd.read()
-                elif fdno in x:
-                    break
-            except:
-                pass
-            is_exit = self.proc.poll() is not None
+                data = os.read(self._out, READ_SIZE)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.EAGAIN:
+                    return True
+                return False
+            if not data:
+                return False
+            self._chunks.append(data)
+
+    def _finish(self):
+        # children that inherited the output pipe may keep it open after the
+        # exit, only what is already buffered is read
+        self._read()
+        if self._waiter is not None:
+            self._waiter.join()
+            os.close(self._exit)
+        else:
+            self.proc.wait()
+        self._output_file().close()
+        self.proc.stdin.close()
+        self.returncode = self.proc.returncode
+
+    def _kill(self):
+        self.timed_out = True
         try:
-            extra = fd.read()
-            while extra:
-                lines += extra
-                time.sleep(0.001)
-                try:
-                    extra = fd.read()
-                except:
-                    pass
-        except:
+            if self.disassociate:
+                os.killpg(self.proc.pid, signal.SIGKILL)
+            else:
+                self.proc.kill()
+        except OSError:
             pass
-        ret = map(str.strip, lines.split('\n'))
-        return ret
+
+    def output_lines(self):
+        return map(str.strip, b''.join(self._chunks).split('\n'))
+
+    def get_output_no_exception(self):
+        communicate([self])
+        return self.output_lines()
 
     def get_output(self):
         ret = self.get_output_no_exception()
-        self.returncode = self.proc.poll()
+        if self.timed_out:
+            raise Exception('Timeout after %ss\n%s' % (self.timeout, '\n'.join(ret)))
         if self.returncode > 0:
             raise Exception('\n'.join(ret))
         return ret
@@ -96,15 +166,109 @@ class InteractiveProcess(object):
         return self.is_exit()
 
 
+def communicate(procs):
+    """Collect the output of started processes until all exited, in one poll loop.
+
+    A process closing its output is exiting and reaped right away. Processes
+    still running after WATCH_DELAY, or with a timeout, get a waiter thread
+    so that their exit is seen even while children keep the output open.
+    """
+    poller = select.poll()
+    by_fd = {}
+
+    def _add(fd, proc):
+        by_fd[fd] = proc
+        poller.register(fd, select.POLLIN)
+
+    def _remove(fd):
+        if fd in by_fd:
+            poller.unregister(fd)
+            del by_fd[fd]
+
+    def _done(proc):
+        _remove(proc._out)
+        _remove(proc._exit)
+        proc._finish()
+        pending.remove(proc)
+
+    for proc in procs:
+        proc._watch()
+        _add(proc._out, proc)
+    pending = set(procs)
+    while pending:
+        timers = [proc.deadline for proc in pending if proc.deadline and not proc.timed_out]
+        timers += [proc.watch_at for proc in pending if proc._exit is None]
+        wait = max(min(timers) - time.time(), 0) * 1000 if timers else -1
+        try:
+            events = poller.poll(wait)
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+        for fd, _ in events:
+            proc = by_fd.get(fd)
+            if proc not in pending:
+                continue
+            if fd == proc._exit:
+                _done(proc)
+            elif not proc._read():
+                _remove(fd)
+                if proc._exit is None and proc.deadline is None:
+                    _done(proc)
+                elif proc._exit is None:
+                    proc._start_waiter()
+                    _add(proc._exit, proc)
+        now = time.time()
+        for proc in pending:
+            if proc._exit is None and now >= proc.watch_at:
+                proc._start_waiter()
+                _add(proc._exit, proc)
+            if proc.deadline and not proc.timed_out and now >= proc.deadline:
+                proc._kill()
+
+
+def check_output_many(cmds_list, **kwargs):
+    """Run the commands concurrently, return (returncode, lines) of each in order.
+
+    Commands timing out get a None returncode.
+    """
+    procs = [InteractiveProcess(cmds, **dict(kwargs)) for cmds in cmds_list]
+    with trace.span('check_output_many', trace.SUBPROCESS, count=len(procs)):
+        for proc in procs:
+            proc.start()
+        communicate(procs)
+    return [(None if proc.timed_out else proc.returncode, proc.output_lines())
+            for proc in procs]
+
+
 def check_call(cmds, **kwargs):
     timeout = kwargs.pop('timeout', -1)
-    if timeout > 0:
-        cmds = ['timeout', '--signal=KILL', '%ds' % timeout] + cmds
     cmds = map(str, cmds)
-    params = {'close_fds': True}
-    if kwargs.get('disassociate', False):
-        params['preexec_fn'] = os.setsid
-    return subprocess.check_call(cmds, **params)
+    with trace.span(os.path.basename(cmds[0]), trace.SUBPROCESS, cmd=' '.join(cmds)):
+        return _check_call(cmds, timeout, kwargs)
+
+
+def _check_call(cmds, timeout, kwargs):
+    params = _spawn_kwargs(kwargs.get('disassociate', False))
+    if timeout <= 0:
+        return subprocess.check_call(cmds, **params)
+    proc = subprocess.Popen(cmds, **params)
+    exit_r, waiter = _watch_exit(proc)
+    try:
+        if not select.select([exit_r], [], [], timeout)[0]:
+            try:
+                if kwargs.get('disassociate', False):
+                    os.killpg(proc.pid, signal.SIGKILL)
+                else:
+                    proc.kill()
+            except OSError:
+                pass
+        waiter.join()
+    finally:
+        os.close(exit_r)
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, cmds)
+    return 0
 
 
 def check_call_no_exception(cmds, **kwargs):
@@ -122,10 +286,11 @@ def check_output(cmds, **kwargs):
     elif not hasattr(cmds, '__iter__'):
         raise Exception('Invalid type of commands: %s' % cmds)
     proc = InteractiveProcess(cmds, **kwargs)
-    proc.start()
-    if kwargs.get('ignore_exception', False):
-        return proc.get_output_no_exception()
-    return proc.get_output()
+    with trace.span(os.path.basename(cmds[0]), trace.SUBPROCESS, cmd=' '.join(cmds)):
+        proc.start()
+        if kwargs.get('ignore_exception', False):
+            return proc.get_output_no_exception()
+        return proc.get_output()
 
 
 def check_output_no_exception(cmds, **kwargs):
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+"""
+Hardware profiles of the VMs.
+
+A profile picks the NIC, disk controller, disk cache and aio mode, iothread,
+CPU model and hugepage memory of the qemu command line gen-bmc-env builds.
+vhost, the CPU model and hugepages are only used when the host has
+/dev/vhost-net, KVM and a hugetlbfs mount when the VM powers on.
+"""
+
+
+DEFAULT_PROFILE = 'legacy'
+
+HUGEPAGES_PATH = '/dev/hugepages'
+
+PROFILES = {
+    # emulated e1000 and virtio-scsi with the qemu default cache
+    'legacy': {
+        'nic': 'e1000', 'vhost': False, 'disk': 'virtio-scsi',
+        'cache': '', 'aio': '', 'iothread': False, 'cpu': '', 'hugepages': False,
+    },
+    'virtio': {
+        'nic': 'virtio-net-pci', 'vhost': True, 'disk': 'virtio-blk',
+        'cache': 'none', 'aio': 'native', 'iothread': True, 'cpu': 'host', 'hugepages': False,
+    },
+    'virtio-scsi': {
+        'nic': 'virtio-net-pci', 'vhost': True, 'disk': 'virtio-scsi',
+        'cache': 'none', 'aio': 'native', 'iothread': True, 'cpu': 'host', 'hugepages': False,
+    },
+    'virtio-hugepages': {
+        'nic': 'virtio-net-pci', 'vhost': True, 'disk': 'virtio-blk',
+        'cache': 'none', 'aio': 'native', 'iothread': True, 'cpu': 'host', 'hugepages': True,
+    },
+}
+
+
+def names():
+    return sorted(PROFILES)
+
+
+def get_profile(name):
+    if name not in PROFILES:
+        raise Exception('Unknown hardware profile {}, choose one of: {}'.format(
+            name, ', '.join(names())))
+    return PROFILES[name]
+
+
+def drive_args(profile, disk):
+    drive = 'if=none,id=hd0,file={}'.format(disk)
+    if profile['cache']:
+        drive += ',cache={}'.format(profile['cache'])
+    if profile['aio']:
+        drive += ',aio={}'.format(profile['aio'])
+    args = []
+    iothread = ''
+    if profile['iothread']:
+        args.append('-object iothread,id=iothread0')
+        iothread = ',iothread=iothread0'
+    args.append('-drive {}'.format(drive))
+    if profile['disk'] == 'virtio-blk':
+        args.append('-device virtio-blk-pci,drive=hd0{}'.format(iothread))
+    else:
+        args.append('-device virtio-scsi-pci,id=scsi0{}'.format(iothread))
+        args.append('-device scsi-hd,bus=scsi0.0,id=scsi0-0,drive=hd0')
+    return ' '.join(args)
+
+
+def template_vars(name, disk):
+    """gen-bmc-env template values of profile name for a node on disk."""
+    profile = get_profile(name)
+    return {
+        'drive_args': drive_args(profile, disk),
+        'nic_model': profile['nic'],
+        'vhost': 'on' if profile['vhost'] else '',
+        'cpu_model': profile['cpu'],
+        'hugepages_path': HUGEPAGES_PATH if profile['hugepages'] else '',
+    }
@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+
+"""
+QEMU Machine Protocol client with a per-socket connection pool.
+
+QEMU serves one QMP client per monitor at a time, so a reaper thread of the
+pool closes connections idle for IDLE_TIMEOUT to let other processes (CLI,
+BMC engine, chassis control) talk to the same VM. Those wait up to
+DEFAULT_TIMEOUT for the greeting, IDLE_TIMEOUT has to stay well below it.
+"""
+
+import sys
+import json
+import time
+import socket
+import atexit
+import argparse
+import threading
+from collections import deque
+
+from virtbmc.clrlog import LOG
+
+
+DEFAULT_TIMEOUT = 5
+IDLE_TIMEOUT = 1
+POWERDOWN_TIMEOUT = 60
+QUIT_TIMEOUT = 10
+POLL_INTERVAL = 0.5
+
+ERROR_STATES = ('internal-error', 'io-error', 'guest-panicked')
+
+
+class QMPError(Exception):
+    pass
+
+
+class QMPConnectionError(QMPError):
+    pass
+
+
+class QMPConnection(object):
+
+    def __init__(self, path, timeout=DEFAULT_TIMEOUT):
+        self.path = path
+        self.lock = threading.Lock()
+        self.events = deque(maxlen=32)
+        self.last_used = time.time()
+        self._buf = b''
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.settimeout(timeout)
+        try:
+            self._sock.connect(path)
+            greeting = self._read_message()
+            if 'QMP' not in greeting:
+                raise QMPConnectionError('{}: unexpected greeting {}'.format(path, greeting))
+            self.execute('qmp_capabilities')
+        except socket.error as e:
+            self.close()
+            raise QMPConnectionError('{}: {}'.format(path, e))
+        except QMPError:
+            self.close()
+            raise
+
+    def _read_message(self):
+        while b'\n' not in self._buf:
+            chunk = self._sock.recv(65536)
+            if not chunk:
+                raise QMPConnectionError('{}: connection closed'.format(self.path))
+            self._buf += chunk
+        line, self._buf = self._buf.split(b'\n', 1)
+        return json.loads(line.decode('utf-8'))
+
+    def execute(self, cmd, **arguments):
+        msg = {'execute': cmd}
+        if arguments:
+            msg['arguments'] = arguments
+        try:
+            self._sock.sendall((json.dumps(msg) + '\n').encode('utf-8'))
+            while True:
+                resp = self._read_message()
+                if 'event' in resp:
+                    self.events.append(resp)
+                elif 'error' in resp:
+                    raise QMPError('{}: {}: {}'.format(self.path, cmd, resp['error'].get('desc')))
+                elif 'return' in resp:
+                    self.last_used = time.time()
+                    return resp['return']
+        except socket.error as e:
+            raise QMPConnectionError('{}: {}: {}'.format(self.path, cmd, e))
+
+    def close(self):
+        try:
+            self._sock.close()
+        except socket.error:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+
+class QMPPool(object):
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, idle_timeout=IDLE_TIMEOUT):
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self._conns = {}
+        self._lock = threading.Lock()
+        self._reaper = None
+
+    def _get(self, path):
+        with self._lock:
+            conn = self._conns.get(path)
+        if conn is None:
+            conn = QMPConnection(path, self.timeout)
+            with self._lock:
+                self._conns[path] = conn
+                if self._reaper is None:
+                    self._reaper = threading.Thread(target=self._reap, name='qmp-reaper')
+                    self._reaper.daemon = True
+                    self._reaper.start()
+        return conn
+
+    def _reap(self):
+        while True:
+            time.sleep(self.idle_timeout / 2.0)
+            self.close_idle()
+            with self._lock:
+                if not self._conns:
+                    self._reaper = None
+                    return
+
+    def _discard(self, path, conn):
+        with self._lock:
+            if self._conns.get(path) is conn:
+                del self._conns[path]
+        conn.close()
+
+    def execute(self, path, cmd, **arguments):
+        for attempt in range(2):
+            conn = self._get(path)
+            try:
+                with conn.lock:
+                    return conn.execute(cmd, **arguments)
+            except QMPConnectionError:
+                # a stale pooled connection gets one fresh retry
+                self._discard(path, conn)
+                if attempt:
+                    raise
+
+    def close_idle(self):
+        now = time.time()
+        with self._lock:
+            idle = [(path, conn) for path, conn in self._conns.items()
+                    if now - conn.last_used > self.idle_timeout]
+        for path, conn in idle:
+            if conn.lock.acquire(False):
+                try:
+                    self._discard(path, conn)
+                finally:
+                    conn.lock.release()
+
+    def release(self, path):
+        """Close the pooled connection to path, if any."""
+        with self._lock:
+            conn = self._conns.pop(path, None)
+        if conn is not None:
+            with conn.lock:
+                conn.close()
+
+    def close(self):
+        with self._lock:
+            conns, self._conns = list(self._conns.values()), {}
+        for conn in conns:
+            conn.close()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = QMPPool()
+            atexit.register(_pool.close)
+        return _pool
+
+
+def query_status(path):
+    """query-status result, None when the VM does not answer."""
+    try:
+        return get_pool().execute(path, 'query-status')
+    except QMPConnectionError:
+        return None
+
+
+def _answers(path):
+    try:
+        with QMPConnection(path) as conn:
+            conn.execute('query-status')
+        return True
+    except QMPConnectionError:
+        return False
+
+
+def wait_exit(path, timeout):
+    # poll on short connections, the monitor stays free for others meanwhile
+    get_pool().release(path)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if not _answers(path):
+            return True
+        time.sleep(POLL_INTERVAL)
+    return False
+
+
+def quit_vm(path, timeout=QUIT_TIMEOUT):
+    try:
+        get_pool().execute(path, 'quit')
+    except QMPConnectionError:
+        return True
+    return wait_exit(path, timeout)
+
+
+def powerdown(path, timeout=POWERDOWN_TIMEOUT):
+    """ACPI shutdown, fall back to quit when the guest ignores it.
+
+    Return False if the VM is still alive after both.
+    """
+    try:
+        get_pool().execute(path, 'system_powerdown')
+    except QMPConnectionError:
+        return True
+    if wait_exit(path, timeout):
+        return True
+    LOG.warning('VM behind {} ignored powerdown for {}s, quit it'.format(path, timeout))
+    return quit_vm(path)
+
+
+def reset(path):
+    get_pool().execute(path, 'system_reset')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='qmp', description='QEMU QMP helper')
+    parser.add_argument('socket', help='QMP unix socket path')
+    parser.add_argument('action', choices=['status', 'powerdown', 'quit', 'reset'])
+    parser.add_argument('--timeout', type=int, default=POWERDOWN_TIMEOUT,
+                        help='seconds to wait for the guest to power down')
+    args = parser.parse_args(argv)
+    if args.action == 'status':
+        status = query_status(args.socket)
+        print(json.dumps(status or {'status': 'off', 'running': False}))
+        return 0
+    if args.action == 'reset':
+        reset(args.socket)
+        return 0
+    if args.action == 'quit':
+        ok = quit_vm(args.socket)
+    else:
+        ok = powerdown(args.socket, args.timeout)
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+
+"""
+Reader of the per-node state files written by the vbmc-state shell helper.
+
+A state file holds power/bootdev/order/cmd as key=value lines. Files written
+before that layout use "key: value" and are read the same way.
+"""
+
+import re
+import sys
+import json
+
+
+DEFAULT_STATE = {'power': 'off', 'bootdev': 'default'}
+
+_LINE = re.compile(r"^(power|bootdev|order|cmd)(?:=|: )'?(.*?)'?$")
+
+
+def parse_state(content):
+    info = dict(DEFAULT_STATE)
+    for line in content.splitlines():
+        m = _LINE.match(line)
+        if m:
+            info[m.group(1)] = m.group(2)
+    return info
+
+
+def read_state(path):
+    try:
+        with open(path) as f:
+            return parse_state(f.read())
+    except IOError:
+        return dict(DEFAULT_STATE)
+
+
+def read_states(paths):
+    """State of many nodes in one pass, {path: state}."""
+    return dict((path, read_state(path)) for path in paths)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv:
+        sys.stderr.write('usage: python -m virtbmc.state STATE_FILE [KEY]\n')
+        return 1
+    info = read_state(argv[0])
+    if len(argv) > 1:
+        print(info.get(argv[1], ''))
+    else:
+        print(json.dumps(info))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,495 @@
+#!/usr/bin/env python
+
+"""
+Supervisor of the ipmi_sim processes.
+
+One process spawns every ipmi_sim directly, reads their output into
+size-bounded logs and reaps them from a single poll loop.  Exited programs
+are restarted according to their policy with exponential backoff, the
+supervised set survives supervisor restarts through its state file.
+
+Control requests and replies are single JSON lines on CONTROL_SOCKET:
+    {"cmd": "start", "programs": [{"name": ..., "argv": [...], "cwd": ...}]}
+    {"cmd": "stop", "names": [...]}
+    {"cmd": "status", "names": [...]}
+"""
+
+import os
+import sys
+import json
+import time
+import errno
+import fcntl
+import select
+import signal
+import socket
+import argparse
+import subprocess
+
+import virtbmc.config as config
+import virtbmc.utils as utils
+from virtbmc import client
+from virtbmc import metrics
+from virtbmc.clrlog import LOG
+
+
+CONTROL_SOCKET = os.path.join(config.WORKSPACE, 'supervisor.sock')
+STATE_FILE = os.path.join(config.WORKSPACE, 'supervisor.json')
+LOG_FILE = os.path.join(config.WORKSPACE, 'supervisor.log')
+
+POLICY_ALWAYS = 'always'
+POLICY_ON_FAILURE = 'on-failure'
+POLICY_NEVER = 'never'
+POLICIES = (POLICY_ALWAYS, POLICY_ON_FAILURE, POLICY_NEVER)
+
+RUNNING = 'running'
+BACKOFF = 'backoff'
+STOPPING = 'stopping'
+EXITED = 'exited'
+
+BACKOFF_BASE = 1
+BACKOFF_MAX = 60
+# a program up this long is healthy again, its backoff restarts from BACKOFF_BASE
+STABLE_TIME = 30
+STOP_TIMEOUT = 5
+LOG_MAX_BYTES = 1024 * 1024
+LOG_TAIL_BYTES = 4096
+REAP_INTERVAL = 1
+
+PROGRAM_EXITS = metrics.REGISTRY.counter(
+    'vbmc_supervisor_exits_total', 'Unrequested exits of supervised programs.', ('program',))
+PROGRAMS = metrics.REGISTRY.gauge(
+    'vbmc_supervisor_programs', 'Supervised programs by state.', ('state',))
+
+
+class RingLog(object):
+    """Output log of one program, rotated to path.1 past max_bytes."""
+
+    def __init__(self, path, max_bytes=LOG_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.tail = b''
+
+    def write(self, data):
+        self.tail = (self.tail + data)[-LOG_TAIL_BYTES:]
+        if not self.path:
+            return
+        with open(self.path, 'ab') as f:
+            f.write(data)
+            size = f.tell()
+        if size > self.max_bytes:
+            os.rename(self.path, self.path + '.1')
+
+
+class Program(object):
+
+    def __init__(self, name, argv, cwd=None, log=None, policy=POLICY_ALWAYS):
+        if policy not in POLICIES:
+            raise Exception('Unknown restart policy: {}'.format(policy))
+        self.name = name
+        self.argv = argv
+        self.cwd = cwd
+        self.policy = policy
+        self.log = RingLog(log)
+        self.proc = None
+        self.fd = None
+        self.state = EXITED
+        self.started = None
+        self.restarts = 0
+        self.failures = 0
+        self.exit_code = None
+        self.next_start = None
+        self.kill_at = None
+
+    def spec(self):
+        return {'name': self.name, 'argv': self.argv, 'cwd': self.cwd,
+                'log': self.log.path, 'policy': self.policy}
+
+    def fileno(self):
+        return self.fd
+
+    def spawn(self, now):
+        self.next_start = None
+        with metrics.timed('spawn', self.name):
+            self.proc = subprocess.Popen(self.argv, cwd=self.cwd, stdin=open(os.devnull),
+                                         stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                         close_fds=True, preexec_fn=os.setsid)
+        self.fd = self.proc.stdout.fileno()
+        fl = fcntl.fcntl(self.fileno(), fcntl.F_GETFL)
+        fcntl.fcntl(self.fileno(), fcntl.F_SETFL, fl | os.O_NONBLOCK)
+        self.state = RUNNING
+        self.started = now
+        LOG.info('Spawn {} pid {}: {}'.format(self.name, self.proc.pid, ' '.join(self.argv)))
+
+    def exited(self, code, now):
+        """Record an unrequested exit and schedule the restart due by the policy."""
+        self.exit_code = code
+        self.state = EXITED
+        PROGRAM_EXITS.inc(program=self.name)
+        if self.policy == POLICY_NEVER or (self.policy == POLICY_ON_FAILURE and code == 0):
+            LOG.info('{} exited with {}'.format(self.name, code))
+            return
+        ran = now - self.started if self.started else 0
+        self.failures = 0 if ran >= STABLE_TIME else self.failures + 1
+        delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** max(self.failures - 1, 0))
+        self.state = BACKOFF
+        self.next_start = now + delay
+        LOG.warning('{} exited with {}, restart in {}s'.format(self.name, code, delay))
+
+    def restart(self, now):
+        if self.exit_code is not None:
+            self.restarts += 1
+        try:
+            self.spawn(now)
+        except OSError as e:
+            self.log.write('spawn {} error: {}\n'.format(self.argv[0], e).encode('utf-8'))
+            self.exited(-1, now)
+
+    def terminate(self, now):
+        self.next_start = None
+        if self.state != RUNNING:
+            self.state = EXITED
+            return
+        self.state = STOPPING
+        self.kill_at = now + STOP_TIMEOUT
+        self.signal(signal.SIGTERM)
+
+    def signal(self, signum):
+        try:
+            os.killpg(self.proc.pid, signum)
+        except OSError:
+            pass
+
+    def status(self):
+        running = self.state == RUNNING
+        return {'state': self.state,
+                'pid': self.proc.pid if running else None,
+                'exit_code': self.exit_code,
+                'restarts': self.restarts,
+                'uptime': int(time.time() - self.started) if running else 0}
+
+
+class Supervisor(object):
+
+    def __init__(self, control_socket=CONTROL_SOCKET, state_file=STATE_FILE):
+        self.control_socket = control_socket
+        self.state_file = state_file
+        self.programs = {}
+        # stopped programs waiting to be reaped
+        self.stopping = []
+        self._by_fd = {}
+        self._poller = select.poll()
+        self._control = None
+        self.running = False
+
+    def _save_state(self):
+        specs = [prog.spec() for prog in self.programs.values() if prog.state != EXITED]
+        with open(self.state_file + '.tmp', 'w') as f:
+            json.dump(sorted(specs, key=lambda spec: spec['name']), f)
+        os.rename(self.state_file + '.tmp', self.state_file)
+
+    def _load_state(self):
+        if not os.path.exists(self.state_file):
+            return []
+        with open(self.state_file) as f:
+            return json.load(f)
+
+    def _watch(self, prog):
+        self._by_fd[prog.fileno()] = prog
+        self._poller.register(prog.fileno(), select.POLLIN)
+
+    def _unwatch(self, prog):
+        # closed descriptors are reused by later spawns
+        if self._by_fd.get(prog.fileno()) is prog:
+            self._drain(prog)
+            del self._by_fd[prog.fileno()]
+            self._poller.unregister(prog.fileno())
+            prog.proc.stdout.close()
+
+    def start(self, specs):
+        errors = {}
+        now = time.time()
+        for spec in specs:
+            prog = self.programs.get(spec['name'])
+            if prog is not None and prog.state in (RUNNING, BACKOFF):
+                continue
+            try:
+                prog = Program(**spec)
+                if self._is_stopping(prog.name):
+                    # restarted before the old process is gone, spawn it once reaped
+                    prog.state = BACKOFF
+                    prog.next_start = now
+                else:
+                    prog.spawn(now)
+                    self._watch(prog)
+            except Exception as e:
+                errors[spec['name']] = str(e)
+                continue
+            self.programs[prog.name] = prog
+        self._save_state()
+        return errors
+
+    def stop(self, names):
+        now = time.time()
+        for name in names:
+            prog = self.programs.pop(name, None)
+            if prog is None:
+                continue
+            prog.terminate(now)
+            if prog.state == STOPPING:
+                self.stopping.append(prog)
+            LOG.info('Stop {}'.format(name))
+        self._save_state()
+        return {}
+
+    def _is_stopping(self, name):
+        return any(prog.name == name for prog in self.stopping)
+
+    def status(self, names=None):
+        if names is None:
+            names = self.programs.keys()
+        return dict((name, self.programs[name].status()) for name in names
+                    if name in self.programs)
+
+    def _read(self, prog):
+        """Log the pending output of prog, return False once it is closed."""
+        try:
+            data = os.read(prog.fileno(), 65536)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return True
+            data = b''
+        if data:
+            prog.log.write(data)
+        return bool(data)
+
+    def _drain(self, prog):
+        try:
+            while select.select([prog.fileno()], [], [], 0)[0] and self._read(prog):
+                pass
+        except select.error:
+            pass
+
+    def metrics(self):
+        states = dict((state, 0) for state in (RUNNING, BACKOFF, EXITED))
+        for prog in self.programs.values():
+            states[prog.state] += 1
+        states[STOPPING] = len(self.stopping)
+        for state, count in states.items():
+            PROGRAMS.set(count, state=state)
+        return metrics.REGISTRY.snapshot()
+
+    def _on_output(self, prog):
+        if not self._read(prog):
+            # output closed, most likely the program has exited
+            self._unwatch(prog)
+            self._reap(prog)
+
+    def _reap(self, prog):
+        """Collect the exit status of prog if it has exited, return True if so."""
+        if prog.proc.poll() is None:
+            return False
+        self._unwatch(prog)
+        if prog.state == STOPPING:
+            self.stopping.remove(prog)
+        else:
+            prog.exited(prog.proc.returncode, time.time())
+            self._save_state()
+        return True
+
+    def _housekeeping(self, now):
+        for prog in list(self.stopping):
+            if not self._reap(prog) and now > prog.kill_at:
+                prog.signal(signal.SIGKILL)
+        for prog in list(self.programs.values()):
+            if prog.state == RUNNING:
+                self._reap(prog)
+            elif prog.state == BACKOFF and now >= prog.next_start and \
+                    not self._is_stopping(prog.name):
+                prog.restart(now)
+                if prog.state == RUNNING:
+                    self._watch(prog)
+
+    def _listen_control(self):
+        if os.path.exists(self.control_socket):
+            try:
+                client.request({'cmd': 'status', 'names': []}, timeout=2,
+                               path=self.control_socket)
+                raise Exception('Supervisor already serves {}'.format(self.control_socket))
+            except client.DaemonUnavailable:
+                os.unlink(self.control_socket)
+        utils.mkdir_of_file(self.control_socket)
+        self._control = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._control.bind(self.control_socket)
+        self._control.listen(16)
+        self._poller.register(self._control.fileno(), select.POLLIN)
+
+    def _on_control(self):
+        conn, _ = self._control.accept()
+        try:
+            conn.settimeout(2)
+            req = json.loads(client.read_line(conn))
+            cmd = req.get('cmd')
+            if cmd == 'start':
+                res = {'ok': True, 'errors': self.start(req.get('programs', []))}
+            elif cmd == 'stop':
+                res = {'ok': True, 'errors': self.stop(req.get('names', []))}
+            elif cmd == 'status':
+                res = {'ok': True, 'programs': self.status(req.get('names'))}
+            elif cmd == 'metrics':
+                res = {'ok': True, 'metrics': self.metrics()}
+            elif cmd == 'shutdown':
+                self.running = False
+                res = {'ok': True}
+            else:
+                res = {'ok': False, 'error': 'Unknown command: {}'.format(cmd)}
+        except Exception as e:
+            res = {'ok': False, 'error': str(e)}
+        try:
+            conn.sendall((json.dumps(res) + '\n').encode('utf-8'))
+        except socket.error:
+            pass
+        conn.close()
+
+    def _shutdown_programs(self):
+        now = time.time()
+        for prog in self.programs.values():
+            prog.terminate(now)
+            if prog.state == STOPPING:
+                self.stopping.append(prog)
+        deadline = now + STOP_TIMEOUT
+        while self.stopping and time.time() < deadline:
+            for prog in list(self.stopping):
+                self._reap(prog)
+            time.sleep(0.1)
+        for prog in self.stopping:
+            prog.signal(signal.SIGKILL)
+            prog.proc.wait()
+
+    def _stop_running(self, *_):
+        self.running = False
+
+    def serve_forever(self):
+        metrics.PROCESS = 'supervisor'
+        self._listen_control()
+        signal.signal(signal.SIGTERM, self._stop_running)
+        signal.signal(signal.SIGINT, self._stop_running)
+        errors = self.start(self._load_state())
+        for name, error in errors.items():
+            LOG.error('Start {} error: {}'.format(name, error))
+        self.running = True
+        last_housekeeping = 0
+        try:
+            while self.running:
+                try:
+                    events = self._poller.poll(REAP_INTERVAL * 1000)
+                except (select.error, IOError) as e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+                for fd, _ in events:
+                    if fd == self._control.fileno():
+                        self._on_control()
+                    elif fd in self._by_fd:
+                        self._on_output(self._by_fd[fd])
+                now = time.time()
+                if now - last_housekeeping >= REAP_INTERVAL:
+                    self._housekeeping(now)
+                    last_housekeeping = now
+        finally:
+            self._control.close()
+            os.unlink(self.control_socket)
+            # the state file keeps the programs for the next supervisor
+            self._shutdown_programs()
+
+
+def supervisor_request(cmd, timeout=10, **kwargs):
+    kwargs['cmd'] = cmd
+    res = client.request(kwargs, timeout=timeout, path=CONTROL_SOCKET)
+    if not res.get('ok'):
+        raise Exception('Supervisor {} error: {}'.format(cmd, res.get('error')))
+    return res
+
+
+def is_running():
+    try:
+        supervisor_request('status', timeout=2, names=[])
+        return True
+    except (client.DaemonUnavailable, socket.error, ValueError):
+        return False
+
+
+def ensure_supervisor(wait=10):
+    if is_running():
+        return
+    utils.mkdir_of_file(LOG_FILE)
+    cmd = [sys.executable, os.path.join(config.BASE_DIR, 'vbmc.py'), 'supervisor']
+    LOG.info('Spawn supervisor: {}'.format(' '.join(cmd)))
+    with open(LOG_FILE, 'a') as log:
+        subprocess.Popen(cmd, stdin=open(os.devnull), stdout=log, stderr=subprocess.STDOUT,
+                         close_fds=True, preexec_fn=os.setsid)
+    deadline = time.time() + wait
+    while time.time() < deadline:
+        if is_running():
+            return
+        time.sleep(0.1)
+    raise Exception('Supervisor not up after {}s, see {}'.format(wait, LOG_FILE))
+
+
+def start_programs(specs):
+    if not specs:
+        return {}
+    ensure_supervisor()
+    return supervisor_request('start', timeout=60, programs=specs)['errors']
+
+
+def stop_programs(names):
+    if names and is_running():
+        supervisor_request('stop', timeout=60, names=names)
+
+
+def program_status(names=None):
+    """{name: status} of the supervised programs, empty without a supervisor."""
+    if not is_running():
+        return {}
+    return supervisor_request('status', timeout=60, names=names)['programs']
+
+
+def manage(args):
+    if args.shutdown:
+        try:
+            supervisor_request('shutdown', timeout=5)
+        except client.DaemonUnavailable:
+            LOG.warning('Supervisor is not running')
+        return
+    Supervisor().serve_forever()
+
+
+def main(argv=None):
+    """Command line used by the node controller scripts."""
+    parser = argparse.ArgumentParser(prog='python -m virtbmc.supervisor')
+    sub = parser.add_subparsers(dest='action')
+    start_parser = sub.add_parser('start')
+    start_parser.add_argument('name')
+    start_parser.add_argument('--cwd')
+    start_parser.add_argument('--log')
+    start_parser.add_argument('--policy', choices=POLICIES, default=POLICY_ALWAYS)
+    start_parser.add_argument('argv', nargs='+', help='command line, after --')
+    for action in ('stop', 'status'):
+        sub.add_parser(action).add_argument('name', nargs='*')
+    args = parser.parse_args(argv)
+    if args.action == 'start':
+        errors = start_programs([{'name': args.name, 'argv': args.argv, 'cwd': args.cwd,
+                                  'log': args.log, 'policy': args.policy}])
+        if errors:
+            sys.stderr.write('{}\n'.format(errors[args.name]))
+            return 1
+    elif args.action == 'stop':
+        stop_programs(args.name)
+    else:
+        print(json.dumps(program_status(args.name or None), indent=4))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
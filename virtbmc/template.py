@@ -1,22 +1,94 @@
 #!/usr/bin/env python
 
+import os
+import stat
+import hashlib
+import tempfile
+import threading
 from string import Template
 
+from virtbmc import trace
+
 
 class ScriptTemplate(Template):
     delimiter = '&'
 
 
+class TemplateRegistry(object):
+    """Compiled templates by path, reloaded only when the file changes."""
+
+    def __init__(self):
+        self._templates = {}
+        self._lock = threading.Lock()
+
+    def get(self, temfile):
+        path = os.path.abspath(temfile)
+        mtime = os.stat(path).st_mtime
+        with trace.locked(self._lock, 'template registry'):
+            item = self._templates.get(path)
+        if item is None or item[0] != mtime:
+            with open(path, 'r') as f:
+                item = (mtime, ScriptTemplate(f.read()))
+            with trace.locked(self._lock, 'template registry'):
+                self._templates[path] = item
+        return item[1]
+
+    def render(self, temfile, kw):
+        with trace.span(os.path.basename(temfile), trace.TEMPLATE):
+            return self.get(temfile).substitute(kw)
+
+
+_registry = TemplateRegistry()
+
+
+def get_registry():
+    return _registry
+
+
+def _digest(content):
+    return hashlib.sha1(content).hexdigest()
+
+
+def write_if_changed(outfile, content, executable=False):
+    """Atomically replace outfile unless it already holds content.
+
+    Return True when the file was written.
+    """
+    try:
+        with open(outfile, 'rb') as f:
+            unchanged = _digest(f.read()) == _digest(content)
+        mode = os.stat(outfile).st_mode
+        if unchanged and (not executable or mode & stat.S_IEXEC):
+            return False
+    except (IOError, OSError):
+        mode = None
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(outfile) or '.',
+                               prefix='.{}.'.format(os.path.basename(outfile)))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        if mode is None:
+            mode = 0o644
+        if executable:
+            mode |= stat.S_IEXEC
+        os.chmod(tmp, stat.S_IMODE(mode))
+        os.rename(tmp, outfile)
+    except Exception:
+        os.remove(tmp)
+        raise
+    return True
+
+
 def sub_template_string(content, kw):
     return ScriptTemplate(content).substitute(kw)
 
 
+def render_to_file(temfile, outfile, kw, executable=False):
+    return write_if_changed(outfile, _registry.render(temfile, kw), executable)
+
+
 def gen_template_content(temfile, outfile, kw):
-    with open(temfile, 'r') as f:
-        content = f.read()
-    gen_content = sub_template_string(content, kw)
-    with open(outfile, 'w') as f:
-        f.write(gen_content)
+    return render_to_file(temfile, outfile, kw)
 
 if __name__ == '__main__':
     ipmi_conf_temp = '../templates/lan.conf.tem'
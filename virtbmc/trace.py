@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+
+"""
+Spans of one CLI run, written in the Chrome trace event format.
+
+Tracing is off unless enable() was called: span() then returns a shared
+no-op context manager and locked() the lock itself, so the instrumented
+code paths only pay a global lookup. The trace opens in chrome://tracing
+or https://ui.perfetto.dev, the optional cProfile dump (all threads merged)
+in pstats or snakeviz.
+"""
+
+import os
+import sys
+import json
+import time
+import cProfile
+import pstats
+import threading
+
+
+# span categories
+COMMAND = 'command'
+PHASE = 'phase'
+OPERATION = 'operation'
+DB = 'db'
+TEMPLATE = 'template'
+SUBPROCESS = 'subprocess'
+LOCK = 'lock'
+
+# longest string kept in span args
+MAX_ARG_LEN = 200
+
+_events = None
+_epoch = 0
+_threads = {}
+_profiles = []
+_lock = threading.Lock()
+
+
+class _NullSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Span(object):
+
+    def __init__(self, name, cat, args):
+        self.name = name
+        self.cat = cat
+        self.args = args
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.args['error'] = str(exc) or exc_type.__name__
+        record(self.name, self.cat, self.started, time.time(), self.args)
+        return False
+
+
+class _TracedLock(object):
+    """Record the time spent waiting for a contended lock."""
+
+    def __init__(self, lock, name):
+        self.lock = lock
+        self.name = name
+
+    def __enter__(self):
+        if not self.lock.acquire(False):
+            started = time.time()
+            self.lock.acquire()
+            record(self.name, LOCK, started, time.time(), {})
+        return self
+
+    def __exit__(self, *exc_info):
+        self.lock.release()
+        return False
+
+
+def enabled():
+    return _events is not None
+
+
+def _short(value):
+    value = str(value)
+    if len(value) > MAX_ARG_LEN:
+        return value[:MAX_ARG_LEN] + '...'
+    return value
+
+
+def record(name, cat, started, finished, args):
+    if _events is None:
+        return
+    thread = threading.current_thread()
+    event = {
+        'name': name, 'cat': cat, 'ph': 'X',
+        'pid': os.getpid(), 'tid': thread.ident,
+        'ts': round((started - _epoch) * 1e6, 3),
+        'dur': round((finished - started) * 1e6, 3),
+    }
+    if args:
+        event['args'] = dict((k, _short(v)) for k, v in args.items())
+    with _lock:
+        _threads[thread.ident] = thread.name
+        _events.append(event)
+
+
+def span(name, cat=OPERATION, **args):
+    if _events is None:
+        return _NULL_SPAN
+    return Span(name, cat, args)
+
+
+def locked(lock, name):
+    """`with locked(lock, name):` holds lock, tracing contended waits."""
+    if _events is None:
+        return lock
+    return _TracedLock(lock, name)
+
+
+def _profile_thread(frame, event, arg):
+    # first profiler event of a new thread: hand over to its own cProfile
+    sys.setprofile(None)
+    profile = cProfile.Profile()
+    with _lock:
+        _profiles.append(profile)
+    profile.enable()
+
+
+def enable(profile=False):
+    """Start collecting spans, and cProfile stats of every thread if profile."""
+    global _events, _epoch
+    _epoch = time.time()
+    _events = []
+    if profile:
+        main = cProfile.Profile()
+        _profiles.append(main)
+        threading.setprofile(_profile_thread)
+        main.enable()
+
+
+def disable():
+    global _events
+    threading.setprofile(None)
+    for profile in _profiles:
+        profile.disable()
+    events, _events = _events, None
+    return events or []
+
+
+def write(trace_file=None, stats_file=None):
+    """Stop tracing, write the trace events and the merged cProfile stats."""
+    events = disable()
+    pid = os.getpid()
+    meta = [{'name': 'process_name', 'ph': 'M', 'pid': pid,
+             'args': {'name': 'vbmc {}'.format(' '.join(sys.argv[1:]))}}]
+    for tid, name in sorted(_threads.items()):
+        meta.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid,
+                     'args': {'name': name}})
+    if trace_file:
+        with open(trace_file, 'w') as f:
+            json.dump({'traceEvents': meta + events, 'displayTimeUnit': 'ms'}, f)
+    if stats_file and _profiles:
+        stats = pstats.Stats(_profiles[0])
+        for profile in _profiles[1:]:
+            stats.add(profile)
+        stats.dump_stats(stats_file)
+    return len(events)
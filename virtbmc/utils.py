@@ -2,6 +2,7 @@
 
 import os
 import stat
+import time
 import errno
 import subprocess
 import netifaces
@@ -11,6 +12,7 @@ from portpicker import is_port_free
 
 from virtbmc.clrlog import LOG
 from virtbmc import procutils
+from virtbmc import metrics
 
 def get_netiface_config(iface):
     if iface not in netifaces.interfaces():
@@ -101,11 +103,15 @@ def run_cmd(cmd):
         cmdstr = ' '.join(cmd)
     else:
         cmdstr = cmd
+    command = os.path.basename(cmdstr.split(' ', 1)[0])
+    started = time.time()
     try:
         LOG.info("Run command: %s" % cmdstr)
         res = procutils.check_output(cmd)
+        metrics.COMMAND_SECONDS.observe(time.time() - started, command=command, result='ok')
         return res
     except Exception as e:
+        metrics.COMMAND_SECONDS.observe(time.time() - started, command=command, result='error')
         e = Exception("Run command: '{}'\nError: {}".format(cmdstr, e))
         LOG.error(e)
         raise e
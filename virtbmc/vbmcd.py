@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+
+"""
+vbmcd keeps the database connections, the IPMI client and the QMP pool of
+one process warm and runs vbmc.py subcommands sent over a unix socket.
+
+Requests and replies are single JSON lines:
+    {"cmd": "run", "argv": ["list", "--json"], "cwd": "/home/user"}
+    {"ok": true, "code": 0, "output": "...", "errors": "..."}
+
+With --listen it also serves TCP as an agent of a cluster coordinator,
+TCP requests then have to carry the agent token. run executes any vbmc.py
+argv (create --qemu, --template), so TCP is never served without a token.
+"""
+
+import os
+import sys
+import hmac
+import json
+import errno
+import select
+import signal
+import socket
+import logging
+import threading
+import traceback
+from StringIO import StringIO
+from multiprocessing.pool import ThreadPool as Pool
+
+import virtbmc.config as config
+import virtbmc.utils as utils
+from virtbmc import client
+from virtbmc import metrics
+from virtbmc.clrlog import LOG
+
+
+# argparse destinations holding paths relative to the client cwd
+PATH_ARGS = ('template', 'base_image', 'add')
+
+# commands running concurrently with everything else
+READONLY_COMMANDS = ('list', 'metrics')
+
+
+class ThreadOutput(object):
+    """Stream sending each request thread's writes to its own buffer."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def capture(self):
+        self.local.buf = StringIO()
+
+    def release(self):
+        buf, self.local.buf = self.local.buf, None
+        return buf.getvalue()
+
+    def capturing(self):
+        return getattr(self.local, 'buf', None) is not None
+
+    def write(self, data):
+        if self.capturing():
+            self.local.buf.write(data)
+        else:
+            self.stream.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+class RequestLogFilter(logging.Filter):
+
+    def __init__(self, output):
+        logging.Filter.__init__(self)
+        self.output = output
+        self.local = threading.local()
+
+    def set_level(self, level):
+        self.local.level = level
+
+    def filter(self, record):
+        return self.output.capturing() and record.levelno >= getattr(self.local, 'level', logging.WARNING)
+
+
+class VBMCDaemon(object):
+
+    def __init__(self, path=None, workers=8, metrics_listen=None, listen=None, token=None):
+        self.path = path or config.VBMCD_SOCKET
+        self.metrics_listen = metrics_listen
+        self.listen = listen
+        self.token = token or ''
+        if listen and not self.token:
+            raise Exception('vbmcd --listen needs an agent token, set --token or '
+                            '$VBMC_AGENT_TOKEN')
+        self.pool = Pool(processes=workers)
+        self.lock = threading.Lock()
+        self.running = False
+        self._sock = None
+        self._tcp_sock = None
+        self.stdout = ThreadOutput(sys.stdout)
+        self.stderr = ThreadOutput(sys.stderr)
+        self.log_filter = RequestLogFilter(self.stderr)
+
+    def _setup_output(self):
+        sys.stdout, sys.stderr = self.stdout, self.stderr
+        handler = logging.StreamHandler(self.stderr)
+        handler.setFormatter(logging.Formatter('%(levelname)s: %(message)s'))
+        handler.addFilter(self.log_filter)
+        # the daemon log keeps INFO, requests get WARNING or DEBUG with -d
+        for h in LOG.handlers:
+            h.setLevel(logging.INFO)
+        LOG.addHandler(handler)
+        LOG.setLevel(logging.DEBUG)
+
+    def _listen(self):
+        if os.path.exists(self.path):
+            try:
+                client.request({'cmd': 'ping'}, timeout=2, path=self.path)
+                raise Exception('vbmcd already serves {}'.format(self.path))
+            except client.DaemonUnavailable:
+                os.unlink(self.path)
+        utils.mkdir_of_file(self.path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(self.path)
+        self._sock.listen(64)
+
+    def _listen_tcp(self):
+        addr = client.tcp_address(self.listen if ':' in self.listen else ':' + self.listen)
+        if addr is None:
+            raise Exception('Invalid listen address: {}'.format(self.listen))
+        self._tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._tcp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._tcp_sock.bind(addr)
+        self._tcp_sock.listen(64)
+
+    def run(self, argv, cwd):
+        from virtbmc import optparse
+        self.stdout.capture()
+        self.stderr.capture()
+        code = 0
+        error = None
+        try:
+            args = optparse.init_argparser().parse_args(argv)
+            self.log_filter.set_level(logging.DEBUG if args.verbose else logging.WARNING)
+            for name in PATH_ARGS:
+                if getattr(args, name, None):
+                    setattr(args, name, os.path.join(cwd, getattr(args, name)))
+            if client.subcommand(argv) in READONLY_COMMANDS:
+                args.func(args)
+            else:
+                with self.lock:
+                    args.func(args)
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                code = e.code or 0
+            else:
+                code = 1
+                error = str(e.code)
+        except Exception as e:
+            traceback.print_exc(file=self.stderr.stream)
+            code = 1
+            error = str(e)
+        finally:
+            output = self.stdout.release()
+            errors = self.stderr.release()
+        metrics.CLI_COMMANDS.inc(command=client.subcommand(argv),
+                                 result='ok' if code == 0 else 'error')
+        return {'ok': code == 0, 'code': code, 'error': error,
+                'output': output, 'errors': errors}
+
+    def _handle(self, conn, remote=False):
+        try:
+            req = json.loads(client.read_line(conn))
+            cmd = req.get('cmd')
+            if remote and (not self.token or not hmac.compare_digest(
+                    str(req.get('token', '')), str(self.token))):
+                res = {'ok': False, 'error': 'Invalid agent token'}
+            elif cmd == 'run':
+                res = self.run(req.get('argv', []), req.get('cwd', '/'))
+            elif cmd == 'ping':
+                res = {'ok': True, 'pid': os.getpid()}
+            elif cmd == 'metrics':
+                res = {'ok': True, 'output': collect_metrics()}
+            elif cmd == 'capacity':
+                res = dict(capacity(), ok=True)
+            elif cmd == 'nodes':
+                res = {'ok': True, 'nodes': node_uuids()}
+            elif cmd == 'shutdown':
+                self.running = False
+                res = {'ok': True}
+            else:
+                res = {'ok': False, 'error': 'Unknown command: {}'.format(cmd)}
+        except Exception as e:
+            res = {'ok': False, 'error': str(e)}
+        try:
+            conn.sendall((json.dumps(res) + '\n').encode('utf-8'))
+        except socket.error:
+            pass
+        conn.close()
+
+    def _stop_running(self, *_):
+        self.running = False
+
+    def _serve_metrics(self):
+        host, _, port = self.metrics_listen.rpartition(':')
+        server = metrics.MetricsHTTPServer((host or '127.0.0.1', int(port)), collect_metrics)
+        server.start()
+        LOG.info('vbmcd metrics on http://{}:{}/metrics'.format(*server.server_address))
+        return server
+
+    def serve_forever(self):
+        metrics.PROCESS = 'vbmcd'
+        self._listen()
+        if self.listen:
+            self._listen_tcp()
+        self._setup_output()
+        server = self._serve_metrics() if self.metrics_listen else None
+        signal.signal(signal.SIGTERM, self._stop_running)
+        signal.signal(signal.SIGINT, self._stop_running)
+        self.running = True
+        LOG.info('vbmcd serving {}'.format(self.path))
+        socks = [sock for sock in (self._sock, self._tcp_sock) if sock is not None]
+        try:
+            while self.running:
+                try:
+                    readable, _, _ = select.select(socks, [], [], 1)
+                except (select.error, IOError) as e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+                for sock in readable:
+                    conn, _ = sock.accept()
+                    conn.setblocking(True)
+                    self.pool.apply_async(self._handle, (conn, sock is self._tcp_sock))
+        finally:
+            if server is not None:
+                server.shutdown()
+            if self._tcp_sock is not None:
+                self._tcp_sock.close()
+            self._sock.close()
+            os.unlink(self.path)
+            self.pool.close()
+            self.pool.join()
+
+
+def collect_metrics():
+    from virtbmc import manager
+    return manager.collect_metrics()
+
+
+def capacity():
+    from virtbmc import manager
+    return manager.capacity()
+
+
+def node_uuids():
+    from virtbmc.models import VirtBMC
+    return [item.uuid for item in VirtBMC.select(VirtBMC.uuid)]
+
+
+def manage(args):
+    if args.shutdown:
+        try:
+            client.request({'cmd': 'shutdown'}, timeout=5)
+        except client.DaemonUnavailable:
+            LOG.warning('vbmcd is not running')
+        return
+    VBMCDaemon(workers=args.workers, metrics_listen=args.metrics_listen, listen=args.listen,
+               token=args.token or os.environ.get('VBMC_AGENT_TOKEN')).serve_forever()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+
+"""
+Warm standby of powered off VMs.
+
+A node of the warm pool keeps its qemu process while it is powered off,
+paused before the firmware runs (-S). Power on is then a QMP boot_set and
+cont instead of a cold start, and power off stops and resets the VM back to
+that state instead of killing it. The disk keeps what the guest wrote, as
+it does across a real power cycle.
+
+The warm file of a node marks it as a member of the pool and holds the
+qemu command its process was started with. A standby started before the
+command changed (regen, hardware profile) is replaced by a cold start, only
+the boot order is set on the paused VM.
+"""
+
+import os
+import re
+import sys
+import time
+import shlex
+
+from virtbmc import qmp
+from virtbmc import state
+from virtbmc import procutils
+
+
+_BOOT_ORDER = re.compile(r' -boot \S+')
+
+
+def same_hardware(cmd, other):
+    return _BOOT_ORDER.sub('', cmd or '') == _BOOT_ORDER.sub('', other or '')
+
+
+class WarmVM(object):
+
+    def __init__(self, qmp_socket, warm_file, status_file, qemu_pidfile):
+        self.qmp_socket = qmp_socket
+        self.warm_file = warm_file
+        self.status_file = status_file
+        self.qemu_pidfile = qemu_pidfile
+
+    @classmethod
+    def of_unit(cls, unit):
+        return cls(unit.qmp_socket, unit.warm_file, unit.status_file, unit.qemu_pidfile)
+
+    def is_member(self):
+        return os.path.exists(self.warm_file)
+
+    def join(self):
+        if not self.is_member():
+            self._write('')
+
+    def leave(self):
+        if self.is_member():
+            os.remove(self.warm_file)
+
+    def _write(self, cmd):
+        with open(self.warm_file, 'w') as f:
+            f.write(cmd)
+
+    def _started_cmd(self):
+        try:
+            with open(self.warm_file) as f:
+                return f.read().strip()
+        except IOError:
+            return None
+
+    def alive(self):
+        return os.path.exists(self.qemu_pidfile) and \
+            procutils.check_pid_alive(self.qemu_pidfile, 'qemu')
+
+    def _execute(self, cmd, **arguments):
+        # a connection of our own would wait for the monitor held by the pool
+        return qmp.get_pool().execute(self.qmp_socket, cmd, **arguments)
+
+    def is_standby(self):
+        """A member whose qemu waits paused for power on."""
+        if not self.is_member() or not self.alive():
+            return False
+        try:
+            return not self._execute('query-status').get('running')
+        except qmp.QMPError:
+            return False
+
+    def started(self):
+        """Record the command of a member just cold started."""
+        if self.is_member():
+            self._write(state.read_state(self.status_file).get('cmd', ''))
+
+    def resume(self):
+        """Power the standby on, False when there is none for the current command.
+
+        Raise QMPError when the standby does not answer, its qemu still runs
+        and must not be cold started a second time.
+        """
+        if not self.is_member() or not self.alive():
+            return False
+        info = state.read_state(self.status_file)
+        if self._execute('query-status').get('running'):
+            return False
+        if same_hardware(self._started_cmd(), info.get('cmd')):
+            self._execute('human-monitor-command',
+                          **{'command-line': 'boot_set {}'.format(info.get('order', 'nd'))})
+            self._execute('cont')
+            return True
+        try:
+            self._execute('quit')
+        except qmp.QMPConnectionError:
+            pass
+        # the monitor goes away right before the process does
+        deadline = time.time() + qmp.QUIT_TIMEOUT
+        while self.alive():
+            if time.time() > deadline:
+                raise qmp.QMPError('{}: outdated standby did not quit'.format(self.qmp_socket))
+            time.sleep(qmp.POLL_INTERVAL)
+        return False
+
+    def park(self):
+        """Stop and reset the VM of a member back to standby."""
+        if not self.is_member() or not self.alive():
+            return False
+        try:
+            self._execute('stop')
+            # reset of a stopped VM leaves it in prelaunch, as started with -S
+            self._execute('system_reset')
+        except qmp.QMPError:
+            return False
+        return True
+
+    def launch(self):
+        """Start the standby of a powered off member without a qemu process."""
+        if not self.is_member() or self.alive():
+            return False
+        info = state.read_state(self.status_file)
+        if info.get('power') != 'off' or not info.get('cmd'):
+            return False
+        procutils.check_output(shlex.split(info['cmd']) + ['-S'])
+        self._write(info['cmd'])
+        return True
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    actions = ('resume', 'park', 'launch', 'started')
+    if len(argv) != 5 or argv[0] not in actions:
+        sys.stderr.write('usage: python -m virtbmc.warm {} QMP_SOCKET WARM_FILE STATUS_FILE '
+                         'QEMU_PIDFILE\n'.format('|'.join(actions)))
+        return 2
+    try:
+        res = getattr(WarmVM(*argv[1:]), argv[0])()
+    except qmp.QMPError as e:
+        sys.stderr.write('Warm {} error: {}\n'.format(argv[0], e))
+        return 1
+    return 1 if res is False else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())